@@ -12,6 +12,21 @@ a = Analysis(
         ('requirements.txt', '.'),  # 包含依赖文件
         ('ssh_manager.py', '.'),  # 包含Python文件
         ('upgrade_manager.py', '.'),  # 包含Python文件
+        ('upgrade_engine.py', '.'),  # 包含Python文件
+        ('scheduler.py', '.'),  # 包含Python文件
+        ('concurrency.py', '.'),  # 包含Python文件
+        ('artifact.py', '.'),  # 包含Python文件
+        ('distribution.py', '.'),  # 包含Python文件
+        ('compression.py', '.'),  # 包含Python文件
+        ('host_log.py', '.'),  # 包含Python文件
+        ('task_table.py', '.'),  # 包含Python文件
+        ('reachability.py', '.'),  # 包含Python文件
+        ('metrics.py', '.'),  # 包含Python文件
+        ('history_store.py', '.'),  # 包含Python文件
+        ('connection_pool.py', '.'),  # 包含Python文件
+        ('retry_policy.py', '.'),  # 包含Python文件
+        ('sharding.py', '.'),  # 包含Python文件
+        ('batch_command.py', '.'),  # 包含Python文件
         ('ui\main_window.ui', 'ui'),  # 包含UI文件
         ('resources', 'resources')
     ],
@@ -20,22 +35,16 @@ a = Analysis(
         'asyncssh',
         'cffi',
         'cryptography',
-        'numpy',
-        'pandas',
         'pycparser',
         'PyQt5',
         'PyQt5-Qt5',
         'PyQt5_sip',
-        'python-dateutil',
-        'pytz',
-        'six',
-        'typing_extensions',
-        'tzdata'
+        'typing_extensions'
     ],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    excludes=['pandas', 'numpy'],  # 界面不再依赖 pandas，避免被打包进应用
     noarchive=False,
     optimize=0,
 )
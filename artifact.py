@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import mmap
+import os
+
+# 已计算的摘要缓存：(路径, 大小, 修改时间, 分块大小) -> (sha256, 前缀摘要字典)，
+# 使同一文件在多次批量升级（例如重试失败主机）之间只计算一次
+_DIGEST_CACHE = {}
+# 已计算的分块摘要缓存：(路径, 大小, 修改时间, 分块大小) -> 每个分块的 SHA-256 列表
+_BLOCK_DIGEST_CACHE = {}
+
+
+class Artifact:
+    """
+    以只读内存映射方式打开的本地文件。
+
+    同一次批量升级中的所有主机共享同一个映射，上传时直接从映射中切出
+    memoryview 分块发送，本地文件只需读取一次（由页缓存提供），内存占用与主机数量无关。
+
+    参数:
+    - path: 本地文件路径。
+    """
+
+    def __init__(self, path):
+        """
+        初始化Artifact实例并建立内存映射。
+        """
+        self.path = path
+        self.name = os.path.basename(path)
+        self._file = open(path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.sha256 = None  # 整个文件的 SHA-256
+        self.prefix_digests = {}  # 前缀长度 -> 前缀的 SHA-256，长度为 chunk_size 的整数倍或文件大小
+        self._digest_future = None
+        self._block_digest_futures = {}  # 分块大小 -> 计算分块摘要的 Future
+        if self.size:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.buffer = memoryview(self._mmap)
+        else:
+            # 空文件无法建立内存映射
+            self._mmap = None
+            self.buffer = memoryview(b'')
+
+    def view(self, offset, length):
+        """
+        返回从 offset 开始、最长 length 字节的只读切片（不复制数据）。
+        """
+        return self.buffer[offset:offset + length]
+
+    def compute_digests(self, chunk_size):
+        """
+        一次遍历计算整个文件和每个 chunk_size 边界处前缀的 SHA-256。
+        """
+        cache_key = (self.path, self.size, self.mtime_ns, chunk_size)
+        cached = _DIGEST_CACHE.get(cache_key)
+        if cached is None:
+            digest = hashlib.sha256()
+            prefix_digests = {0: digest.hexdigest()}
+            for offset in range(0, self.size, chunk_size):
+                digest.update(self.view(offset, chunk_size))
+                prefix_digests[min(offset + chunk_size, self.size)] = digest.hexdigest()
+            cached = _DIGEST_CACHE[cache_key] = (digest.hexdigest(), prefix_digests)
+        self.sha256, self.prefix_digests = cached
+
+    async def ensure_digests_async(self, chunk_size):
+        """
+        在线程池中计算摘要（每个 Artifact 只计算一次，多个主机并发等待同一次计算）。
+        """
+        if self._digest_future is None:
+            loop = asyncio.get_running_loop()
+            self._digest_future = loop.run_in_executor(None, self.compute_digests, chunk_size)
+        await asyncio.shield(self._digest_future)
+
+    def compute_block_digests(self, block_size):
+        """
+        返回每个按 block_size 对齐的分块（最后一块可能较短）的 SHA-256 列表，用于差量上传。
+        """
+        cache_key = (self.path, self.size, self.mtime_ns, block_size)
+        digests = _BLOCK_DIGEST_CACHE.get(cache_key)
+        if digests is None:
+            digests = _BLOCK_DIGEST_CACHE[cache_key] = [hashlib.sha256(self.view(offset, block_size)).hexdigest()
+                                                        for offset in range(0, self.size, block_size)]
+        return digests
+
+    async def block_digests_async(self, block_size):
+        """
+        在线程池中计算分块摘要（每个 Artifact 和分块大小只计算一次）。
+        """
+        future = self._block_digest_futures.get(block_size)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._block_digest_futures[block_size] = loop.run_in_executor(
+                None, self.compute_block_digests, block_size)
+        return await asyncio.shield(future)
+
+    def close(self):
+        """
+        释放内存映射和文件句柄。
+        """
+        try:
+            self.buffer.release()
+            if self._mmap is not None:
+                self._mmap.close()
+        except BufferError:
+            # 仍有切片在使用中（例如被取消的上传），映射将在切片释放后由垃圾回收关闭
+            pass
+        self._file.close()
+
+
+class ArtifactStore:
+    """
+    按本地路径缓存 Artifact，保证一次批量升级中每个文件只打开和映射一次。
+    """
+
+    def __init__(self):
+        self._artifacts = {}
+
+    def get(self, path):
+        """
+        获取指定路径的 Artifact，首次访问时打开。
+        """
+        artifact = self._artifacts.get(path)
+        if artifact is None:
+            artifact = Artifact(path)
+            self._artifacts[path] = artifact
+        return artifact
+
+    def close(self):
+        """
+        关闭所有已打开的 Artifact。
+        """
+        for artifact in self._artifacts.values():
+            artifact.close()
+        self._artifacts.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,218 @@
+import asyncio
+import hashlib
+
+
+class CommandConfig:
+    """
+    批量命令参数。
+
+    参数:
+    - timeout: 单个主机上命令的最长执行时间（秒），超时的主机记为失败。
+    - max_output: 每组输出中 stdout 和 stderr 各自保留的最大字符数，超出的部分只参与分组，不保存。
+    """
+
+    DEFAULTS = {
+        'timeout': 60.0,
+        'max_output': 65536,
+    }
+
+    def __init__(self, **kwargs):
+        """
+        初始化CommandConfig实例，未指定的参数使用 DEFAULTS 中的默认值。
+        """
+        for name, default in self.DEFAULTS.items():
+            value = kwargs.get(name, default)
+            setattr(self, name, type(default)(value))
+        self.max_output = max(0, self.max_output)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        从配置字典创建实例，忽略未知的键。
+        """
+        return cls(**{name: value for name, value in (data or {}).items() if name in cls.DEFAULTS})
+
+    def to_dict(self):
+        """
+        转换为可写入 config.json 的字典。
+        """
+        return {name: getattr(self, name) for name in self.DEFAULTS}
+
+
+class OutputGroup:
+    """
+    输出完全相同（stdout、stderr 和退出码都相同）的一组主机，输出内容只保存一份。
+
+    参数:
+    - digest: 输出的哈希值，作为分组的标识。
+    - exit_status: 退出码，命令没有执行（例如连接失败）时为 None。
+    - stdout/stderr: 输出内容，最多保留 CommandConfig.max_output 个字符。
+    - truncated: 输出是否被截断。
+    """
+
+    __slots__ = ('digest', 'exit_status', 'stdout', 'stderr', 'truncated', 'count', 'label')
+
+    LABEL_LENGTH = 80  # 标签的最大长度
+
+    def __init__(self, digest, exit_status, stdout, stderr, truncated=False):
+        self.digest = digest
+        self.exit_status = exit_status
+        self.stdout = stdout
+        self.stderr = stderr
+        self.truncated = truncated
+        self.count = 0  # 属于该组的主机数
+        self.label = self._make_label()
+
+    @property
+    def ok(self):
+        return self.exit_status == 0 and not self.stderr
+
+    def _make_label(self):
+        """
+        返回用于界面显示的一行摘要：优先使用 stderr 的第一行非空内容，其次是 stdout；
+        成功且没有输出时为 OK。
+        """
+        line = next((line.strip() for text in (self.stderr, self.stdout)
+                     for line in text.splitlines() if line.strip()), '')
+        if len(line) > self.LABEL_LENGTH:
+            line = line[:self.LABEL_LENGTH - 3] + '...'
+        if self.exit_status == 0:
+            return line or 'OK'
+        if self.exit_status is None:
+            return line or 'Not run'
+        return f'{line} (exit {self.exit_status})' if line else f'Exit {self.exit_status}'
+
+
+class OutputGroups:
+    """
+    按输出分组的批量命令结果。
+
+    同一组的主机共用一个 OutputGroup，占用的内存与不同输出的数量成正比，与主机数量无关。
+    """
+
+    def __init__(self):
+        self._groups = {}  # 摘要 -> OutputGroup
+
+    def __len__(self):
+        return len(self._groups)
+
+    def add(self, collector):
+        """
+        把一台主机的输出（OutputCollector）计入对应的组，返回该组的 OutputGroup。
+        """
+        digest = collector.digest()
+        group = self._groups.get(digest)
+        if group is None:
+            group = self._groups[digest] = OutputGroup(digest, collector.exit_status, collector.text('stdout'),
+                                                       collector.text('stderr'), collector.truncated)
+        group.count += 1
+        return group
+
+    def add_error(self, host, message):
+        """
+        把一台命令没有执行的主机（例如连接失败）按错误消息计入对应的组，
+        消息中的主机地址替换为 <host>，使不同主机的同一种错误归入同一组。
+        """
+        collector = OutputCollector()
+        collector.on_line('stderr', message.replace(host, '<host>'))
+        return self.add(collector)
+
+    def groups(self):
+        """
+        按主机数从多到少返回所有 OutputGroup。
+        """
+        return sorted(self._groups.values(), key=lambda group: -group.count)
+
+    def format_summary(self, limit=20):
+        """
+        返回每组一行的统计文本，例如 "742 hosts: OK"，最多 limit 行。
+        """
+        groups = self.groups()
+        lines = [f'{group.count} hosts: {group.label}' for group in groups[:limit]]
+        if len(groups) > limit:
+            lines.append(f'... {len(groups) - limit} more groups')
+        return '\n'.join(lines)
+
+    def format_details(self):
+        """
+        返回所有组的完整输出，每组只出现一次。
+        """
+        sections = []
+        for group in self.groups():
+            section = [f'== {group.count} hosts, exit status {group.exit_status} ==']
+            if group.stdout:
+                section += ['[stdout]', group.stdout]
+            if group.stderr:
+                section += ['[stderr]', group.stderr]
+            if group.truncated:
+                section.append('[output truncated]')
+            sections.append('\n'.join(section))
+        return '\n\n'.join(sections)
+
+
+class OutputCollector:
+    """
+    逐行接收一台主机的命令输出，边接收边计算哈希，只保留每个流的前 max_output 个字符。
+
+    参数:
+    - max_output: 每个流保留的最大字符数。
+    """
+
+    def __init__(self, max_output=CommandConfig.DEFAULTS['max_output']):
+        self.max_output = max_output
+        self.exit_status = None
+        self.truncated = False
+        self._hashes = {'stdout': hashlib.sha256(), 'stderr': hashlib.sha256()}
+        self._kept = {'stdout': [], 'stderr': []}
+        self._sizes = {'stdout': 0, 'stderr': 0}
+
+    def on_line(self, stream, line):
+        """
+        SSHManager.stream_command_async 的行回调。
+        """
+        line += '\n'
+        self._hashes[stream].update(line.encode('utf-8', 'replace'))
+        room = self.max_output - self._sizes[stream]
+        if room <= 0:
+            self.truncated = True
+            return
+        if len(line) > room:
+            line = line[:room]
+            self.truncated = True
+        self._kept[stream].append(line)
+        self._sizes[stream] += len(line)
+
+    def text(self, stream):
+        """
+        返回保留的输出，去掉末尾的换行符。
+        """
+        return ''.join(self._kept[stream]).rstrip('\n')
+
+    def digest(self):
+        """
+        返回由完整 stdout、stderr 和退出码计算的摘要，两台主机的输出完全相同时摘要相同。
+        """
+        combined = hashlib.sha256()
+        combined.update(str(self.exit_status).encode())
+        for stream in ('stdout', 'stderr'):
+            combined.update(self._hashes[stream].digest())
+        return combined.hexdigest()
+
+
+async def run_command(ssh_manager, command, config):
+    """
+    在已创建的 SSHManager 上连接并执行命令，返回 OutputCollector；连接或执行失败时抛出异常。
+    """
+    collector = OutputCollector(config.max_output)
+    await ssh_manager.connect_async()
+    reuse = False
+    try:
+        collector.exit_status = await asyncio.wait_for(
+            ssh_manager.stream_command_async(command, collector.on_line), config.timeout)
+        reuse = True
+    except asyncio.TimeoutError:
+        raise Exception(f'Command timed out after {config.timeout:g}s.')
+    finally:
+        # 超时或被取消时连接上可能还有未结束的会话，不放回连接池
+        await ssh_manager.close_async(reuse=reuse)
+    return collector
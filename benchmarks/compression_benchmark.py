@@ -0,0 +1,82 @@
+"""
+压缩传输基准测试。
+
+对给定文件测量每种压缩算法和级别的压缩耗时、压缩率和解压耗时，并估算在不同链路速率下
+每台主机相对直接传输节省的时间（本地压缩只进行一次，耗时分摊到 --hosts 台主机），
+用于判断某个升级文件在目标链路上是否值得启用 transfer.compression。
+解压耗时在本机测量，作为目标主机解压耗时的近似值。
+
+用法:
+    python benchmarks/compression_benchmark.py 升级文件 [--hosts 100] [--links 10,100,1000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compression import COMPRESSORS, compress_file  # noqa: E402
+
+DECOMPRESSORS = {
+    'gzip': 'gzip',
+    'bzip2': 'bz2',
+    'xz': 'lzma',
+}
+
+
+def measure(path, algorithm, level, output_dir):
+    """
+    返回 (压缩耗时, 压缩后大小, 解压耗时)。
+    """
+    output_path = os.path.join(output_dir, f'{algorithm}-{level}')
+    start = time.perf_counter()
+    compress_file(path, algorithm, level, output_path)
+    compress_time = time.perf_counter() - start
+
+    module = __import__(DECOMPRESSORS[algorithm])
+    start = time.perf_counter()
+    with module.open(output_path, 'rb') as f:
+        while f.read(1024 * 1024):
+            pass
+    decompress_time = time.perf_counter() - start
+    size = os.path.getsize(output_path)
+    os.remove(output_path)
+    return compress_time, size, decompress_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark compressed upgrade file transfer.')
+    parser.add_argument('file', help='upgrade file to benchmark')
+    parser.add_argument('--hosts', type=int, default=100, help='number of hosts the compression cost is shared by')
+    parser.add_argument('--links', default='10,100,1000', help='comma separated link speeds in Mbit/s')
+    parser.add_argument('--levels', default='1,6,9', help='comma separated compression levels')
+    args = parser.parse_args()
+
+    links = [float(link) for link in args.links.split(',')]
+    levels = [int(level) for level in args.levels.split(',')]
+    raw_size = os.path.getsize(args.file)
+
+    header = f"{'algorithm':<10}{'level':>6}{'ratio':>8}{'comp s':>9}{'decomp s':>10}"
+    header += ''.join(f"{f'{link:g}Mb/s':>14}" for link in links)
+    print(f'file: {args.file} ({raw_size} bytes), hosts: {args.hosts}')
+    print('link columns: per-host wall time saved vs. raw transfer, seconds (negative = slower)')
+    print(header)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        for algorithm in COMPRESSORS:
+            for level in levels:
+                compress_time, size, decompress_time = measure(args.file, algorithm, level, output_dir)
+                row = f'{algorithm:<10}{level:>6}{raw_size / max(size, 1):>8.2f}'
+                row += f'{compress_time:>9.2f}{decompress_time:>10.2f}'
+                for link in links:
+                    bytes_per_second = link * 1000 * 1000 / 8
+                    raw_time = raw_size / bytes_per_second
+                    packed_time = size / bytes_per_second + decompress_time + compress_time / args.hosts
+                    row += f'{raw_time - packed_time:>14.2f}'
+                print(row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""
+本地 SSH 服务器集群，供基准测试模拟大量目标主机。
+
+每台模拟主机是同一进程内的一个 asyncssh 服务器，前面挂一个 TCP 代理模拟链路：
+- latency: 往返延迟（秒），每个方向延迟一半。
+- bandwidth: 每台主机每个方向的带宽上限（字节/秒），0 表示不限速。
+- auth_delay: 密码认证的额外耗时（秒）。
+- failure_rate: 新连接被直接断开的概率，用于模拟不稳定的主机。
+
+每台主机的文件系统是临时目录下的独立子目录：SFTP 以该目录为根，远程命令中的 /tmp/ 路径
+被映射到该目录下的 tmp/，命令本身在本机的 shell 中执行。集群运行在独立线程的事件循环中，
+避免服务器端的处理占用被测客户端的事件循环。
+"""
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import threading
+
+import asyncssh
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+PIPE_CHUNK_SIZE = 65536
+PIPE_QUEUE_SIZE = 64  # 每个方向在途的最大数据块数量，超过时停止读取，形成背压
+
+
+class _Server(asyncssh.SSHServer):
+    def __init__(self, auth_delay):
+        self.auth_delay = auth_delay
+
+    def begin_auth(self, username):
+        return True
+
+    def password_auth_supported(self):
+        return True
+
+    async def validate_password(self, username, password):
+        if self.auth_delay:
+            await asyncio.sleep(self.auth_delay)
+        return username == USERNAME and password == PASSWORD
+
+
+class SSHFarm:
+    """
+    在本机启动 hosts 台模拟主机。
+
+    参数:
+    - hosts: 模拟主机数量。
+    - latency/bandwidth/auth_delay/failure_rate: 链路和主机参数，见模块说明。
+    - seed: failure_rate 使用的随机数种子，相同的种子得到相同的断开序列。
+
+    用法:
+        with SSHFarm(100, latency=0.05) as farm:
+            for host, port in farm.addresses: ...
+    """
+
+    def __init__(self, hosts, latency=0.0, bandwidth=0, auth_delay=0.0, failure_rate=0.0, seed=0):
+        self.hosts = hosts
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.auth_delay = auth_delay
+        self.failure_rate = failure_rate
+        self.addresses = []  # 每台模拟主机的 (地址, 代理端口)
+        self.root = None
+        self._random = random.Random(seed)
+        self._servers = []
+        self._connections = set()  # 正在转发的代理任务；事件循环只弱引用任务，读取暂停时可能被回收
+        self._loop = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """
+        启动集群线程和所有模拟主机。
+        """
+        self.root = tempfile.mkdtemp(prefix='sshfarm-')
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='SSHFarm', daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+
+    def stop(self):
+        """
+        关闭所有模拟主机并删除它们的文件。
+        """
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    async def _start(self):
+        host_key = asyncssh.generate_private_key('ssh-ed25519')
+        for index in range(self.hosts):
+            host_root = os.path.join(self.root, f'host{index}')
+            os.makedirs(os.path.join(host_root, 'tmp'))
+            server = await asyncssh.create_server(
+                lambda: _Server(self.auth_delay), '127.0.0.1', 0,
+                server_host_keys=[host_key],
+                process_factory=lambda process, root=host_root: self._run_command(process, root),
+                sftp_factory=lambda chan, root=host_root: asyncssh.SFTPServer(chan, chroot=root.encode()),
+                encoding=None)
+            ssh_port = server.sockets[0].getsockname()[1]
+            proxy = await asyncio.start_server(
+                lambda reader, writer, port=ssh_port: self._proxy(reader, writer, port), '127.0.0.1', 0)
+            self._servers += [server, proxy]
+            self.addresses.append(('127.0.0.1', proxy.sockets[0].getsockname()[1]))
+
+    async def _stop(self):
+        for server in self._servers:
+            server.close()
+        await asyncio.gather(*(server.wait_closed() for server in self._servers), return_exceptions=True)
+        self._servers = []
+        # 结束仍在转发数据或执行命令的连接
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    @staticmethod
+    async def _run_command(process, root):
+        """
+        在本机 shell 中执行远程命令，命令中的 /tmp/ 映射到该主机目录下的 tmp/。
+        """
+        command = (process.command or '').replace('/tmp/', f'{root}/tmp/')
+        child = await asyncio.create_subprocess_shell(command, cwd=root, stdout=asyncio.subprocess.PIPE,
+                                                      stderr=asyncio.subprocess.PIPE)
+
+        async def pump(source, target):
+            while True:
+                data = await source.read(PIPE_CHUNK_SIZE)
+                if not data:
+                    break
+                target.write(data)
+
+        await asyncio.gather(pump(child.stdout, process.stdout), pump(child.stderr, process.stderr))
+        process.exit(await child.wait())
+
+    async def _proxy(self, client_reader, client_writer, ssh_port):
+        """
+        把客户端连接转发到模拟主机的 SSH 端口，并按参数注入延迟、限速和断开。
+        """
+        if self._random.random() < self.failure_rate:
+            client_writer.transport.abort()
+            return
+        try:
+            server_reader, server_writer = await asyncio.open_connection('127.0.0.1', ssh_port)
+        except OSError:
+            client_writer.transport.abort()
+            return
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            await asyncio.gather(self._pipe(client_reader, server_writer),
+                                 self._pipe(server_reader, client_writer), return_exceptions=True)
+        except asyncio.CancelledError:
+            pass  # 集群关闭；连接处理任务是 start_server 的回调，不再向上传播取消
+        finally:
+            self._connections.discard(task)
+            for writer in (client_writer, server_writer):
+                writer.close()
+
+    async def _pipe(self, reader, writer):
+        """
+        单向转发：每个数据块在 latency / 2 之后送达，并按 bandwidth 限速。
+        """
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue(PIPE_QUEUE_SIZE)
+
+        async def receive():
+            try:
+                while True:
+                    data = await reader.read(PIPE_CHUNK_SIZE)
+                    await chunks.put((loop.time() + self.latency / 2, data))
+                    if not data:
+                        break
+            except OSError:
+                await chunks.put((loop.time(), b''))
+
+        async def send():
+            next_free = 0.0
+            while True:
+                deliver_at, data = await chunks.get()
+                if not data:
+                    break
+                if self.bandwidth:
+                    next_free = max(next_free, deliver_at) + len(data) / self.bandwidth
+                    deliver_at = next_free
+                delay = deliver_at - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                writer.write(data)
+                await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+
+        receiver = asyncio.ensure_future(receive())
+        try:
+            await send()
+        finally:
+            receiver.cancel()
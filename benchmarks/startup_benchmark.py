@@ -0,0 +1,113 @@
+"""
+启动时间基准测试。
+
+多次启动新的 Python 进程创建并显示主窗口，测量从启动进程到主窗口显示后第一次进入事件循环的
+耗时（time-to-window）和此时的常驻内存（RSS），并列出启动过程中已经加载的重量级模块，
+用于发现启动阶段被提前导入的依赖（例如 pandas、numpy、asyncssh）。
+
+没有显示环境时使用 Qt 的 offscreen 平台。
+
+用法:
+    python benchmarks/startup_benchmark.py [--runs 10]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['pandas', 'numpy', 'asyncssh', 'cryptography']
+
+
+def rss_bytes():
+    """
+    返回当前进程的常驻内存（字节），无法获取时返回 None。
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def child():
+    """
+    在子进程中创建并显示主窗口，进入事件循环后输出一行 JSON 结果并立即退出（不保存配置）。
+    """
+    if not os.environ.get('DISPLAY') and sys.platform.startswith('linux'):
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    sys.path.insert(0, ROOT)
+    import main
+    from PyQt5.QtCore import QTimer
+
+    def report():
+        result = {
+            'rss': rss_bytes(),
+            'modules': [name for name in HEAVY_MODULES if name in sys.modules],
+        }
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
+        os._exit(0)
+
+    app = main.QApplication(sys.argv[:1])
+    window = main.MainWindow()
+    window.show()
+    QTimer.singleShot(0, report)
+    app.exec_()
+
+
+def measure():
+    """
+    启动一次子进程，返回 (time-to-window 秒, 结果字典)。
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child'], cwd=ROOT,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    line = process.stdout.readline()
+    elapsed = time.perf_counter() - start
+    process.wait()
+    if not line:
+        raise RuntimeError(f'main window did not start (exit code {process.returncode})')
+    return elapsed, json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark GUI cold-start time and memory.')
+    parser.add_argument('--runs', type=int, default=10, help='number of launches to measure')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    times = []
+    rss = []
+    modules = set()
+    for _ in range(args.runs):
+        elapsed, result = measure()
+        times.append(elapsed)
+        if result['rss'] is not None:
+            rss.append(result['rss'])
+        modules.update(result['modules'])
+
+    print(f'runs: {args.runs}')
+    print(f"time-to-window: median {statistics.median(times) * 1000:.0f} ms, "
+          f"min {min(times) * 1000:.0f} ms, max {max(times) * 1000:.0f} ms")
+    if rss:
+        print(f'RSS after window shown: median {statistics.median(rss) / 1024 / 1024:.1f} MB')
+    print(f"heavy modules loaded at startup: {', '.join(sorted(modules)) or 'none'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""
+批量升级基准测试。
+
+在本机启动 --hosts 台模拟主机（见 ssh_farm.py），注入指定的链路延迟、带宽上限、认证延迟和断开概率，
+以 --concurrency 的并发数对所有主机执行 UpgradeManager.execute_upgrade_async，报告每分钟升级的主机数、
+上传吞吐量和各阶段耗时的分位数。
+
+每次运行的结果追加写入 --results 文件（JSON Lines），并与参数相同的上一次结果比较；吞吐量下降或
+p95 耗时增加超过 --tolerance 时视为性能回退，退出码为 1。
+模拟主机与被测客户端运行在同一进程中，服务器端的加密和 SFTP 处理也占用本机 CPU，
+因此结果只适合在同一台机器上的多次运行之间比较。
+
+用法:
+    python benchmarks/upgrade_benchmark.py [--hosts 50] [--size 8] [--latency 50] [--bandwidth 100]
+                                           [--auth-delay 0.2] [--failure-rate 0.02] [--config config.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from artifact import ArtifactStore  # noqa: E402
+from metrics import HostMetrics, RunMetrics  # noqa: E402
+from reachability import ScanConfig  # noqa: E402
+from retry_policy import RetryConfig  # noqa: E402
+from ssh_farm import PASSWORD, USERNAME, SSHFarm  # noqa: E402
+from ssh_manager import SSHManager  # noqa: E402
+from upgrade_manager import TransferConfig, UpgradeManager  # noqa: E402
+
+DEFAULT_RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', 'upgrade_benchmark.jsonl')
+PARAMETERS = ('hosts', 'concurrency', 'size', 'latency', 'bandwidth', 'auth_delay', 'failure_rate', 'script_time')
+UPGRADE_SCRIPT = '#!/bin/sh\nsleep {seconds}\nsha256sum "$1" > /dev/null\n'
+
+
+async def run_upgrades(addresses, file_path, script_path, concurrency, transfer_config, retry_config):
+    """
+    以不超过 concurrency 的并发数升级所有模拟主机。
+
+    返回:
+    - (RunMetrics, 总耗时秒数)
+    """
+    run_metrics = RunMetrics()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def upgrade(host, port):
+        metrics = HostMetrics(f'{host}:{port}')
+        async with semaphore:
+            ssh_manager = SSHManager(host, USERNAME, PASSWORD, metrics=metrics, port=port)
+            upgrade_manager = UpgradeManager(ssh_manager, transfer_config=transfer_config,
+                                             artifact_store=artifact_store, scan_config=ScanConfig(port=port),
+                                             metrics=metrics, retry_config=retry_config)
+            try:
+                await upgrade_manager.execute_upgrade_async(file_path, script_path)
+                metrics.finish('Success')
+            except Exception:
+                metrics.finish('Fail')
+        run_metrics.add(metrics)
+
+    started = time.monotonic()
+    with ArtifactStore() as artifact_store:
+        await asyncio.gather(*(upgrade(host, port) for host, port in addresses))
+    return run_metrics, time.monotonic() - started
+
+
+def git_revision():
+    """
+    返回当前代码的 git 提交，不在 git 仓库中时返回空字符串。
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+def previous_result(path, parameters):
+    """
+    返回结果文件中参数与 parameters 相同的最后一条结果，不存在时返回 None。
+    """
+    previous = None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get('parameters') == parameters:
+                    previous = record
+    except (OSError, ValueError):
+        return None
+    return previous
+
+
+def find_regressions(record, previous, tolerance):
+    """
+    与上一次结果比较，返回性能回退的描述列表。
+    """
+    regressions = []
+    for name in ('hosts_per_minute', 'bytes_per_second'):
+        if previous.get(name) and record[name] < previous[name] * (1 - tolerance):
+            regressions.append(f'{name}: {previous[name]:.1f} -> {record[name]:.1f}')
+    for phase, stats in record['phases'].items():
+        old = previous.get('phases', {}).get(phase)
+        # 极短的阶段受计时抖动影响较大，不参与比较
+        if old and old['p95'] >= 0.01 and stats['p95'] > old['p95'] * (1 + tolerance):
+            regressions.append(f"{phase} p95: {old['p95']:.3f}s -> {stats['p95']:.3f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark batch upgrades against local stand-in SSH hosts.')
+    parser.add_argument('--hosts', type=int, default=50, help='number of simulated hosts')
+    parser.add_argument('--concurrency', type=int, default=50, help='hosts upgraded at the same time')
+    parser.add_argument('--size', type=float, default=8, help='upgrade file size in MB')
+    parser.add_argument('--latency', type=float, default=0, help='round-trip latency per host in ms')
+    parser.add_argument('--bandwidth', type=float, default=0, help='per-host link speed in Mbit/s, 0 = unlimited')
+    parser.add_argument('--auth-delay', type=float, default=0, help='extra password auth time in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0, help='probability that a connection is dropped')
+    parser.add_argument('--script-time', type=float, default=0, help='seconds the upgrade script sleeps')
+    parser.add_argument('--config', help='config.json whose transfer and retry sections are used')
+    parser.add_argument('--results', default=DEFAULT_RESULTS, help='JSON Lines file results are appended to')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown reported as a regression')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for --failure-rate')
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    transfer_config = TransferConfig.from_dict(config.get('transfer'))
+    retry_config = RetryConfig.from_dict(config.get('retry'))
+    parameters = {name: getattr(args, name) for name in PARAMETERS}
+    parameters['transfer'] = transfer_config.to_dict()
+    parameters['retry'] = retry_config.to_dict()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        file_path = os.path.join(work_dir, 'benchmark.bin')
+        with open(file_path, 'wb') as f:
+            f.write(os.urandom(int(args.size * 1024 * 1024)))
+        script_path = os.path.join(work_dir, 'benchmark.sh')
+        with open(script_path, 'w', newline='\n') as f:
+            f.write(UPGRADE_SCRIPT.format(seconds=args.script_time))
+
+        with SSHFarm(args.hosts, latency=args.latency / 1000, bandwidth=args.bandwidth * 1000 * 1000 / 8,
+                     auth_delay=args.auth_delay, failure_rate=args.failure_rate, seed=args.seed) as farm:
+            run_metrics, elapsed = asyncio.run(run_upgrades(farm.addresses, file_path, script_path,
+                                                            args.concurrency, transfer_config, retry_config))
+
+    succeeded = sum(1 for metrics in run_metrics.hosts if metrics.status == 'Success')
+    uploaded = sum(metrics.bytes_uploaded for metrics in run_metrics.hosts)
+    record = {
+        'timestamp': time.time(),
+        'revision': git_revision(),
+        'parameters': parameters,
+        'elapsed': elapsed,
+        'succeeded': succeeded,
+        'failed': args.hosts - succeeded,
+        'hosts_per_minute': succeeded * 60 / elapsed,
+        'bytes_per_second': uploaded / elapsed,
+        'phases': run_metrics.summary(),
+    }
+
+    print(f'hosts: {args.hosts}, succeeded: {succeeded}, elapsed: {elapsed:.2f} s')
+    print(f"hosts/minute: {record['hosts_per_minute']:.1f}, upload: {record['bytes_per_second'] / 1024 / 1024:.2f} MB/s")
+    print(f"{'phase':<12}{'p50 s':>10}{'p95 s':>10}{'p99 s':>10}")
+    for phase, stats in record['phases'].items():
+        print(f"{phase:<12}{stats['p50']:>10.3f}{stats['p95']:>10.3f}{stats['p99']:>10.3f}")
+
+    previous = previous_result(args.results, parameters)
+    os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+    with open(args.results, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record) + '\n')
+    if previous is None:
+        print(f'no previous result with the same parameters in {args.results}')
+        return 0
+    regressions = find_regressions(record, previous, args.tolerance)
+    print(f"compared with {previous.get('revision') or 'previous run'}: "
+          f"{'regressions: ' + '; '.join(regressions) if regressions else 'no regressions'}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
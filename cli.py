@@ -0,0 +1,224 @@
+"""
+无界面的批量升级入口，适用于 cron 和 CI 等没有显示环境的场景。
+
+与图形界面使用同一个 UpgradeEngine（并发调度、文件传输、中继分发和可达性扫描），
+不导入 PyQt5。每台主机的结果以 JSON Lines 格式逐行写出，最后一行为汇总。
+
+用法:
+    python cli.py 主机清单.csv --file 升级文件 --script 升级脚本 [--config config.json] [--output results.jsonl]
+                  [--prometheus metrics.prom] [--history history.db]
+"""
+import argparse
+import csv
+import json
+import os
+import queue
+import sys
+import time
+
+from history_store import HistoryStore
+from metrics import RunMetrics
+from scheduler import SchedulerConfig
+from upgrade_engine import UpgradeEngine
+
+EVENT_POLL_TIMEOUT = 0.2  # 等待引擎事件的超时时间（秒），超时后检查批量升级是否异常结束
+
+
+def load_inventory(path):
+    """
+    读取主机清单。
+
+    支持包含 Host、Username、Password 列的 CSV 文件，由同名字段对象组成的 JSON 数组
+    （也可以直接使用旧版图形界面的 config.json，读取其中的 ssh_configs），以及图形界面的 history.db。
+    地址为空或重复的主机会被跳过。
+
+    返回:
+    - (host, username, password) 列表。
+    """
+    if path.lower().endswith('.db'):
+        if not os.path.isfile(path):
+            raise ValueError(f'{path} does not exist')
+        history = HistoryStore(path)
+        try:
+            rows = [{'Host': host, 'Username': username, 'Password': password}
+                    for host, username, password in history.inventory()]
+        finally:
+            history.close()
+    elif path.lower().endswith('.json'):
+        with open(path, 'r', encoding='utf-8') as f:
+            rows = json.load(f)
+        if isinstance(rows, dict):
+            rows = rows.get('ssh_configs', [])
+    else:
+        with open(path, 'r', newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            missing = {'Host', 'Username', 'Password'} - set(reader.fieldnames or [])
+            if missing:
+                raise ValueError(f"CSV file is missing columns: {', '.join(sorted(missing))}")
+            rows = list(reader)
+
+    inventory = []
+    seen = set()
+    for row in rows:
+        host = str(row.get('Host') or '').strip()
+        if not host or host in seen:
+            continue
+        seen.add(host)
+        inventory.append((host, str(row.get('Username') or ''), str(row.get('Password') or '')))
+    return inventory
+
+
+def configure_engine(engine, config):
+    """
+    按 config.json 格式的字典设置引擎参数。
+
+    返回:
+    - SchedulerConfig 实例。
+    """
+    engine.configure(config)
+    return SchedulerConfig.from_dict(config.get('scheduler'))
+
+
+def run_batch(inventory, file_path, script_path, config=None, scan=False, log_dir=None, on_result=None,
+              history=None):
+    """
+    对清单中的所有主机执行一次批量升级，并阻塞直到结束。
+
+    参数:
+    - inventory: (host, username, password) 列表。
+    - file_path/script_path: 本地升级文件和脚本路径。
+    - config: config.json 格式的字典，使用其中的 scheduler、transfer、relay、scan、pool、retry、shards、cancel 和 stages 配置。
+    - scan: 是否在升级前进行可达性预扫描。
+    - log_dir: 保存每台主机完整远程输出的目录，为空时不保存。
+    - on_result: 每台主机结束后调用的回调函数 on_result(record)。
+    - history: 记录本次升级结果的 HistoryStore，为空时不记录。
+
+    返回:
+    - (主机结果字典列表, 调度统计字典, RunMetrics)
+    """
+    engine = UpgradeEngine()
+    scheduler_config = configure_engine(engine, config or {})
+    engine.log_dir = log_dir
+    passwords = {host: (username, password) for host, username, password in inventory}
+    started = {}
+    host_metrics = {}
+    records = []
+    run_metrics = RunMetrics()
+    run_id = history.begin_run('cli', file_path, script_path) if history is not None else None
+    engine.start()
+    try:
+        if scan:
+            engine.call(engine.run_scan([(host, host) for host, _, _ in inventory]))
+            engine.drain_events()
+        future = engine.submit_rollout([(host, host, username, password) for host, username, password in inventory],
+                                       file_path, script_path, scheduler_config)
+        while True:
+            try:
+                kind, host, payload = engine.events.get(timeout=EVENT_POLL_TIMEOUT)
+            except queue.Empty:
+                if future.done():
+                    future.result()  # 批量升级异常结束时抛出原始异常
+                continue
+            if kind == 'progress':
+                started.setdefault(host, time.time())
+            elif kind == 'metrics':
+                host_metrics[host] = payload
+                run_metrics.add(payload)
+            elif kind == 'finished':
+                status, message = payload
+                finished_at = time.time()
+                record = {
+                    'host': host,
+                    'username': passwords[host][0],
+                    'status': status,
+                    'message': message,
+                    'started_at': started.pop(host, None),
+                    'finished_at': finished_at,
+                }
+                metrics = host_metrics.pop(host, None)
+                if history is not None:
+                    history.record_results(run_id, [(host, status, message, metrics)])
+                if metrics is not None:
+                    record.update(phases=metrics.to_dict()['phases'], bytes_uploaded=metrics.bytes_uploaded,
+                                  retries=metrics.retries)
+                records.append(record)
+                if on_result:
+                    on_result(record)
+            elif kind == 'rollout_finished':
+                return records, payload, run_metrics
+    finally:
+        engine.stop()
+        if history is not None:
+            history.finish_run(run_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Upgrade remote hosts without the GUI.')
+    parser.add_argument('inventory', help='inventory CSV (Host,Username,Password), JSON or GUI history.db file')
+    parser.add_argument('--file', required=True, help='upgrade file to upload')
+    parser.add_argument('--script', required=True, help='upgrade script to run with the uploaded file')
+    parser.add_argument('--config', help='config.json with scheduler/transfer/relay/scan/pool/retry/shards/cancel/stages sections')
+    parser.add_argument('--output', default='-', help='JSON Lines result file, "-" for stdout')
+    parser.add_argument('--scan', action='store_true', help='run a reachability pre-scan first')
+    parser.add_argument('--log-dir', help='directory for per-host remote output logs')
+    parser.add_argument('--history', help='SQLite history database to record this run in (e.g. the GUI history.db)')
+    parser.add_argument('--prometheus', help='write per-phase timing metrics in Prometheus text format to this file')
+    parser.add_argument('--processes', type=int,
+                        help='worker processes to shard upgrades across, 0 = one per CPU core (overrides config)')
+    args = parser.parse_args()
+
+    try:
+        inventory = load_inventory(args.inventory)
+        config = {}
+        if args.config:
+            with open(args.config, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f'Error: {e}', file=sys.stderr)
+        return 2
+    if not inventory:
+        print('Error: inventory is empty', file=sys.stderr)
+        return 2
+    if args.processes is not None:
+        config['shards'] = dict(config.get('shards') or {}, processes=args.processes)
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        def on_result(record):
+            output.write(json.dumps(dict(record, type='host'), ensure_ascii=False) + '\n')
+            output.flush()
+            print(f"{record['host']}: {record['status']}", file=sys.stderr)
+
+        history = HistoryStore(args.history) if args.history else None
+        try:
+            records, summary, run_metrics = run_batch(inventory, args.file, args.script, config, args.scan,
+                                                      args.log_dir, on_result, history)
+        except KeyboardInterrupt:
+            # run_batch 退出前已经停止引擎：正在进行的升级清理了远程临时文件并关闭了连接
+            print('Cancelled.', file=sys.stderr)
+            return 130
+        except Exception as e:
+            print(f'Error: {e}', file=sys.stderr)
+            return 1
+        finally:
+            if history is not None:
+                history.close()
+        output.write(json.dumps(dict(summary, type='summary', hosts=len(inventory), phases=run_metrics.summary()),
+                                ensure_ascii=False) + '\n')
+        if args.prometheus:
+            try:
+                run_metrics.write_prometheus(args.prometheus)
+            except OSError as e:
+                print(f'Error: cannot write metrics: {e}', file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    statuses = [record['status'] for record in records]
+    print(f"hosts: {len(inventory)}, succeeded: {statuses.count('Success')}, failed: {statuses.count('Fail')}, "
+          f"skipped: {statuses.count('Skipped')}", file=sys.stderr)
+    return 0 if statuses.count('Success') == len(inventory) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+import asyncio
+import atexit
+import bz2
+import gzip
+import lzma
+import os
+import shutil
+import tempfile
+
+# 可选的压缩算法：名称 -> (压缩文件后缀, 远程解压命令, 压缩级别范围)
+COMPRESSORS = {
+    'gzip': ('.gz', 'gzip', range(1, 10)),
+    'bzip2': ('.bz2', 'bzip2', range(1, 10)),
+    'xz': ('.xz', 'xz', range(0, 10)),
+}
+MIN_COMPRESS_SIZE = 1024 * 1024  # 小于该大小的文件（例如升级脚本）不压缩
+
+_compressed_files = {}  # (路径, 大小, 修改时间, 算法, 级别) -> 压缩文件路径
+_pending = {}  # 同上 -> 正在进行的压缩 Future
+_temp_dir = None
+
+
+def open_compressed(path, algorithm, level):
+    """
+    以写入方式打开压缩文件。gzip 固定头部时间戳，保证同一输入每次压缩的结果一致，
+    使远程残留的部分压缩文件可以断点续传。
+    """
+    if algorithm == 'gzip':
+        return gzip.GzipFile(path, 'wb', compresslevel=level, mtime=0)
+    if algorithm == 'bzip2':
+        return bz2.open(path, 'wb', compresslevel=level)
+    if algorithm == 'xz':
+        return lzma.open(path, 'wb', preset=level)
+    raise ValueError(f'Unsupported compression algorithm: {algorithm}')
+
+
+def clamp_level(algorithm, level):
+    """
+    把压缩级别限制在算法支持的范围内。
+    """
+    levels = COMPRESSORS[algorithm][2]
+    return min(max(level, levels.start), levels.stop - 1)
+
+
+def compress_file(path, algorithm, level, output_path=None):
+    """
+    流式压缩本地文件。
+
+    返回:
+    - 压缩文件路径，未指定 output_path 时写入进程级临时目录。
+    """
+    global _temp_dir
+    if output_path is None:
+        if _temp_dir is None:
+            _temp_dir = tempfile.mkdtemp(prefix='sshtool-')
+            atexit.register(shutil.rmtree, _temp_dir, True)
+        handle, output_path = tempfile.mkstemp(suffix=os.path.basename(path) + COMPRESSORS[algorithm][0],
+                                               dir=_temp_dir)
+        os.close(handle)
+    with open(path, 'rb') as src, open_compressed(output_path, algorithm, clamp_level(algorithm, level)) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    return output_path
+
+
+async def compressed_copy(path, algorithm, level):
+    """
+    获取本地文件的压缩副本。同一文件、算法和级别在进程内只压缩一次，
+    并在线程池中执行，多个主机并发请求时共享同一次压缩。
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns, algorithm, level)
+    if key in _compressed_files:
+        return _compressed_files[key]
+    future = _pending.get(key)
+    if future is None:
+        future = asyncio.get_running_loop().run_in_executor(None, compress_file, path, algorithm, level)
+        _pending[key] = future
+    try:
+        _compressed_files[key] = await asyncio.shield(future)
+    finally:
+        if future.done():
+            _pending.pop(key, None)
+    return _compressed_files[key]
@@ -0,0 +1,327 @@
+import asyncio
+import collections
+import contextlib
+import math
+import time
+
+
+def is_congestion_error(exc):
+    """
+    判断连接错误是否表示网络或目标主机拥塞（超时、连接被重置或丢失等）。
+
+    认证失败、主机拒绝连接等与负载无关的错误不算作拥塞信号。
+    """
+    if exc is None:
+        return False
+    import asyncssh  # 延迟导入：只有建立过连接才会出现连接错误，此时 asyncssh 已经加载
+    if isinstance(exc, (asyncssh.PermissionDenied, asyncssh.HostKeyNotVerifiable,
+                        asyncssh.IllegalUserName, ConnectionRefusedError)):
+        return False
+    return isinstance(exc, (asyncio.TimeoutError, ConnectionError, asyncssh.ConnectionLost,
+                            asyncssh.DisconnectError, asyncssh.ChannelOpenError))
+
+
+class FixedLimiter:
+    """
+    固定上限的并发限制器。
+
+    参数:
+    - limit: 同时持有许可的最大数量。
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def acquire(self):
+        await self._semaphore.acquire()
+
+    def release(self):
+        self._semaphore.release()
+
+    def observe(self, started_at, latency=None, congested=False, reused=False):
+        """
+        固定限制器忽略所有观测值。
+        """
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class AIMDLimiter:
+    """
+    基于 AIMD（加性增、乘性减）的自适应并发限制器。
+
+    根据观测到的连接延迟和错误调整允许同时进行的主机数量：
+    - 慢启动阶段每个健康样本使上限加 increase，首次退避后改为每个上限窗口加 increase；
+    - 出现拥塞错误或延迟超过基线的 latency_tolerance 倍时，上限乘以 decrease_factor。
+    同一次退避之前开始的请求随后报告的错误不会再次触发退避。
+
+    参数:
+    - initial: 初始并发上限。
+    - minimum/maximum: 并发上限的取值范围。
+    - increase: 加性增量。
+    - decrease_factor: 乘性减因子（0~1）。
+    - latency_tolerance: 延迟超过基线多少倍视为拥塞。
+    """
+
+    BASELINE_WEIGHT = 0.1  # 健康样本更新延迟基线时的权重
+    BASELINE_MIN_SAMPLES = 3  # 延迟基线生效前需要的样本数
+
+    def __init__(self, initial=4, minimum=1, maximum=64, increase=1.0, decrease_factor=0.5,
+                 latency_tolerance=2.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.baseline_latency = None
+        self.slow_start = True
+        self._samples = 0
+        self._last_decrease = float('-inf')
+        self._waiters = collections.deque()
+
+    async def acquire(self):
+        """
+        等待直到在途数量低于当前上限。
+        """
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif not waiter.cancelled():
+                    self._wake()
+                raise
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def observe(self, started_at, latency=None, congested=False, reused=False):
+        """
+        记录一次连接的观测结果并调整并发上限。
+
+        参数:
+        - started_at: 连接开始的 time.monotonic() 时间。
+        - latency: 连接耗时（秒），连接失败或复用连接池中的连接时为 None。
+        - congested: 是否发生了拥塞类错误。
+        - reused: 是否复用了连接池中的连接。复用的连接视为健康样本，但不参与延迟基线的计算。
+        """
+        if not congested and latency is not None and self._is_slow(latency):
+            congested = True
+
+        if congested:
+            if started_at > self._last_decrease:
+                self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                self._last_decrease = time.monotonic()
+                self.slow_start = False
+            return
+
+        if latency is None and not reused:
+            return
+        if latency is not None:
+            self._samples += 1
+            if self.baseline_latency is None:
+                self.baseline_latency = latency
+            else:
+                self.baseline_latency += (latency - self.baseline_latency) * self.BASELINE_WEIGHT
+        if self.slow_start:
+            self.limit = min(self.maximum, self.limit + self.increase)
+        else:
+            self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+        self._wake()
+
+    def _is_slow(self, latency):
+        return (self.baseline_latency is not None and self._samples >= self.BASELINE_MIN_SAMPLES
+                and latency > self.baseline_latency * self.latency_tolerance)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class HostSlot:
+    """
+    批量升级中单个主机占用的并发名额（limiter 的一个许可）。
+
+    升级在上传结束、拿到 exec 阶段的名额后调用 transferred() 提前归还许可，执行时间较长的脚本
+    不再占用连接和上传的并发，执行脚本的并发由 StageConfig.exec_in_flight 限制；等待 exec 名额期间仍占用许可，
+    因此执行阶段满载时不会继续连接新的主机。升级结束时调度器调用 release()，已归还时不重复归还。
+
+    参数:
+    - limiter: 已经获取了一个许可的并发限制器。
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.released = False
+
+    def observe(self, started_at, latency=None, congested=False, reused=False):
+        """
+        把连接观测值转发给限制器。
+        """
+        self.limiter.observe(started_at, latency, congested, reused)
+
+    def transferred(self):
+        """
+        上传已完成并开始执行脚本，提前归还许可。
+        """
+        self.release()
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.limiter.release()
+
+
+def create_limiter(config):
+    """
+    根据 SchedulerConfig 创建并发限制器：adaptive 为真时使用 AIMDLimiter，
+    否则使用上限为 max_in_flight 的 FixedLimiter。
+    """
+    if config.adaptive:
+        return AIMDLimiter(initial=config.initial_in_flight,
+                           minimum=config.min_in_flight,
+                           maximum=config.max_in_flight,
+                           latency_tolerance=config.latency_tolerance)
+    return FixedLimiter(config.max_in_flight)
+
+
+class StageConfig:
+    """
+    升级流水线各阶段的并发限制和上传带宽限制。
+
+    SchedulerConfig.max_in_flight 限制同时连接和上传的主机数量：主机拿到 exec 阶段的名额后即让出调度名额
+    （见 HostSlot），执行较慢的脚本不占用传输的并发。各阶段另有独立的上限，例如用 exec_in_flight 限制同时执行的
+    脚本数量，用 upload_in_flight 和 upload_rate 保持上传链路满载但不占满带宽。
+
+    参数:
+    - connect_in_flight: 同时建立连接（TCP 连接、握手和认证）的最大主机数量，0 表示不限制。
+    - upload_in_flight: 同时上传的最大主机数量，0 表示不限制。
+    - exec_in_flight: 同时执行升级脚本的最大主机数量，0 表示不限制。
+    - upload_rate: 所有主机上传的总带宽上限（字节/秒），0 表示不限制。
+    - upload_burst: 带宽限制允许的突发量（字节）。
+    """
+
+    DEFAULTS = {
+        'connect_in_flight': 0,
+        'upload_in_flight': 0,
+        'exec_in_flight': 0,
+        'upload_rate': 0,
+        'upload_burst': 1024 * 1024,
+    }
+
+    def __init__(self, **kwargs):
+        """
+        初始化StageConfig实例，未指定的参数使用 DEFAULTS 中的默认值。
+        """
+        for name, default in self.DEFAULTS.items():
+            value = kwargs.get(name, default)
+            setattr(self, name, max(0, type(default)(value)))
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        从配置字典创建实例，忽略未知的键。
+        """
+        return cls(**{name: value for name, value in (data or {}).items() if name in cls.DEFAULTS})
+
+    def to_dict(self):
+        """
+        转换为可写入 config.json 的字典。
+        """
+        return {name: getattr(self, name) for name in self.DEFAULTS}
+
+    def split(self, parts):
+        """
+        返回平均分给 parts 个工作进程后每个进程使用的限制（向上取整，不限制的仍为 0）。
+        """
+        data = self.to_dict()
+        for name in ('connect_in_flight', 'upload_in_flight', 'exec_in_flight', 'upload_rate'):
+            data[name] = math.ceil(data[name] / parts)
+        return StageConfig(**data)
+
+
+class TokenBucket:
+    """
+    令牌桶限速器，所有调用方共享 rate 字节/秒的总速率。
+
+    每次 consume 立即按到达顺序预留令牌，令牌不足时等待补足，因此并发的调用方轮流获得带宽。
+
+    参数:
+    - rate: 每秒补充的令牌数（字节/秒）。
+    - burst: 桶的容量（字节）。
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    async def consume(self, amount):
+        """
+        取走 amount 个令牌，令牌不足时等待。
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= amount
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+class StagePools:
+    """
+    按 StageConfig 为连接、上传和执行阶段分别限制并发，并提供全局的上传限速器 upload_limiter。
+    只能在引擎的事件循环中创建和使用。
+
+    参数:
+    - config: StageConfig 实例。
+    """
+
+    STAGES = ('connect', 'upload', 'exec')
+
+    def __init__(self, config=None):
+        self.config = config or StageConfig()
+        self._semaphores = {}
+        for stage in self.STAGES:
+            limit = getattr(self.config, f'{stage}_in_flight')
+            if limit > 0:
+                self._semaphores[stage] = asyncio.Semaphore(limit)
+        self.upload_limiter = (TokenBucket(self.config.upload_rate, self.config.upload_burst)
+                               if self.config.upload_rate > 0 else None)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, stage):
+        """
+        在 async with 语句块中占用阶段 stage 的一个名额，该阶段不限制时直接进入。
+        """
+        semaphore = self._semaphores.get(stage)
+        if semaphore is None:
+            yield
+            return
+        async with semaphore:
+            yield
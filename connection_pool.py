@@ -0,0 +1,169 @@
+import asyncio
+import collections
+import time
+
+
+class PoolConfig:
+    """
+    SSH 连接池参数。
+
+    参数:
+    - enabled: 是否在升级结束后保留连接，供之后的重试和升级复用。
+    - max_size: 最多保留的空闲连接数量，超过时关闭空闲最久的连接。
+    - idle_timeout: 空闲连接的最长保留时间（秒）。
+    - keepalive_interval: 连接上发送保活请求的间隔（秒），连续 3 次没有响应时 asyncssh 会关闭连接。
+    - health_check_after: 复用空闲超过该时间（秒）的连接前，先执行一次远程命令确认连接可用。
+    - health_check_timeout: 健康检查的超时时间（秒）。
+    """
+
+    DEFAULTS = {
+        'enabled': True,
+        'max_size': 256,
+        'idle_timeout': 600.0,
+        'keepalive_interval': 30.0,
+        'health_check_after': 5.0,
+        'health_check_timeout': 5.0,
+    }
+
+    def __init__(self, **kwargs):
+        """
+        初始化PoolConfig实例，未指定的参数使用 DEFAULTS 中的默认值。
+        """
+        for name, default in self.DEFAULTS.items():
+            value = kwargs.get(name, default)
+            setattr(self, name, type(default)(value))
+        self.max_size = max(0, self.max_size)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        从配置字典创建实例，忽略未知的键。
+        """
+        return cls(**{name: value for name, value in (data or {}).items() if name in cls.DEFAULTS})
+
+    def to_dict(self):
+        """
+        转换为可写入 config.json 的字典。
+        """
+        return {name: getattr(self, name) for name in self.DEFAULTS}
+
+
+class ConnectionPool:
+    """
+    按 (host, port, username, password) 保存已认证的空闲 SSH 连接。
+
+    SSHManager 连接前先从池中取出连接，复用时跳过 TCP 连接、握手和认证；关闭时把仍然可用的连接放回池中。
+    同一个连接同时只会被一个 SSHManager 使用。空闲连接在 idle_timeout 后由后台任务关闭，
+    池中最多保留 max_size 个空闲连接。连接池只在引擎的事件循环中使用。
+
+    参数:
+    - config: PoolConfig 实例。
+    """
+
+    HEALTH_CHECK_COMMAND = 'true'
+
+    def __init__(self, config=None):
+        self.config = config or PoolConfig()
+        # key -> [(连接, 放回的 time.monotonic())]，key 按最近放回的顺序排列，列表中最近放回的在末尾
+        self._idle = collections.OrderedDict()
+        self._size = 0
+        self._evictor = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self._size
+
+    async def acquire(self, key):
+        """
+        取出 key 对应的一个可用空闲连接，没有时返回 None。
+
+        优先取最近放回的连接；空闲超过 health_check_after 的连接先执行一次健康检查，失败时关闭并尝试下一个。
+        """
+        if not self.config.enabled:
+            return None
+        while self._idle.get(key):
+            client, released_at = self._pop(key)
+            if client.is_closed():
+                continue
+            if time.monotonic() - released_at > self.config.health_check_after and not await self._healthy(client):
+                client.close()
+                continue
+            self.hits += 1
+            return client
+        self.misses += 1
+        return None
+
+    def _pop(self, key, index=-1):
+        entries = self._idle[key]
+        entry = entries.pop(index)
+        if not entries:
+            del self._idle[key]
+        self._size -= 1
+        return entry
+
+    async def _healthy(self, client):
+        try:
+            await asyncio.wait_for(client.run(self.HEALTH_CHECK_COMMAND), self.config.health_check_timeout)
+            return True
+        except asyncio.CancelledError:
+            client.close()
+            raise
+        except Exception:
+            return False
+
+    def release(self, key, client):
+        """
+        把连接放回池中；连接已关闭、连接池已停用或已满时，关闭连接（池满时关闭空闲最久的连接）。
+
+        返回:
+        - 连接是否被保留。
+        """
+        if client.is_closed() or not self.config.enabled or self.config.max_size == 0:
+            client.close()
+            return False
+        self._idle.setdefault(key, []).append((client, time.monotonic()))
+        self._idle.move_to_end(key)
+        self._size += 1
+        while self._size > self.config.max_size:
+            oldest, _ = self._pop(next(iter(self._idle)), 0)
+            oldest.close()
+        if self._evictor is None or self._evictor.done():
+            self._evictor = asyncio.ensure_future(self._evict_idle())
+        return True
+
+    async def _evict_idle(self):
+        """
+        定期关闭空闲超过 idle_timeout 的连接，池为空时结束。
+        """
+        while self._idle:
+            now = time.monotonic()
+            for key, entries in list(self._idle.items()):
+                kept = []
+                for client, released_at in entries:
+                    if client.is_closed() or now - released_at > self.config.idle_timeout:
+                        client.close()
+                    else:
+                        kept.append((client, released_at))
+                self._size -= len(entries) - len(kept)
+                if kept:
+                    self._idle[key] = kept
+                else:
+                    del self._idle[key]
+            if self._idle:
+                oldest = min(entries[0][1] for entries in self._idle.values())
+                await asyncio.sleep(max(1.0, oldest + self.config.idle_timeout - now))
+
+    async def close_all(self):
+        """
+        关闭所有空闲连接并停止后台任务。
+        """
+        if self._evictor is not None:
+            self._evictor.cancel()
+            self._evictor = None
+        clients = [client for entries in self._idle.values() for client, _ in entries]
+        self._idle.clear()
+        self._size = 0
+        for client in clients:
+            client.close()
+        await asyncio.gather(*(client.wait_closed() for client in clients), return_exceptions=True)
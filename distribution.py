@@ -0,0 +1,373 @@
+import asyncio
+import collections
+import contextlib
+import ipaddress
+import shlex
+
+from concurrency import StagePools
+from upgrade_manager import UpgradeManager
+
+
+class RelayConfig:
+    """
+    中继分发参数。
+
+    参数:
+    - enabled: 是否在批量升级的每一波开始前先向这一波的主机中继分发。
+    - subnet_prefix: 按 IPv4 子网分组时的前缀长度（IPv6 固定按 /64 分组，主机名按域名后缀分组）。
+    - seeds_per_group: 每组中由本机直接上传的种子主机数量。
+    - fan_out: 每台已拿到文件的主机同时向多少台同组主机提供下载。
+    - max_active: 每组同时从其他主机下载的最大主机数量，0 表示只受 fan_out 和批量升级的并发上限限制。
+    - port: 主机之间传输文件使用的 TCP 端口。
+    - timeout: 文件服务进程和下载命令的超时时间（秒）。同组分发结束后文件服务进程立即停止，
+      该超时只在本机异常退出、没有执行 stop_command 时限制服务进程的存活时间。
+    - stage_command/unstage_command: 在远程主机上把升级文件暂存到供文件服务使用的临时目录、删除该目录的命令模板。
+    - serve_command/fetch_command/stop_command: 在远程主机上从暂存目录提供、下载和停止提供文件的命令模板。
+
+    默认的文件服务是没有认证的 HTTP 服务：它只监听主机被连接时使用的地址，目录中只有升级文件，
+    但在服务期间，能访问该地址 port 端口的任何人都可以下载升级文件。升级文件包含敏感内容时，
+    应通过防火墙限制 port 端口只对同组主机开放，或把 serve_command/fetch_command 替换为带认证的传输方式。
+    """
+
+    DEFAULTS = {
+        'enabled': False,
+        'subnet_prefix': 24,
+        'seeds_per_group': 1,
+        'fan_out': 4,
+        'max_active': 16,
+        'port': 8765,
+        'timeout': 300,
+        'stage_command': ('d=$(mktemp -d) || exit 1; (ln -f {path} "$d"/{name} 2>/dev/null || cp {path} "$d"/{name}) '
+                          '&& echo "$d" || rm -rf "$d"'),
+        'serve_command': ('cd {dir} || exit 1; nohup timeout {timeout} python3 -m http.server --bind {host} {port} '
+                          '</dev/null >/dev/null 2>&1 & pid=$!; sleep 1; kill -0 $pid && echo "$pid"'),
+        'fetch_command': ('(curl -fsS --max-time {timeout} -o {path}.part {url} || '
+                          'wget -q -T {timeout} -O {path}.part {url}) && mv -f {path}.part {path}'),
+        'stop_command': 'kill {pid} 2>/dev/null',
+        'unstage_command': 'rm -rf {dir}',
+    }
+
+    def __init__(self, **kwargs):
+        """
+        初始化RelayConfig实例，未指定的参数使用 DEFAULTS 中的默认值。
+        """
+        for name, default in self.DEFAULTS.items():
+            value = kwargs.get(name, default)
+            setattr(self, name, type(default)(value))
+        self.seeds_per_group = max(1, self.seeds_per_group)
+        self.fan_out = max(1, self.fan_out)
+        self.max_active = max(0, self.max_active)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        从配置字典创建实例，忽略未知的键。
+        """
+        return cls(**{name: value for name, value in (data or {}).items() if name in cls.DEFAULTS})
+
+    def to_dict(self):
+        """
+        转换为可写入 config.json 的字典。
+        """
+        return {name: getattr(self, name) for name in self.DEFAULTS}
+
+
+def group_key(host, subnet_prefix=24):
+    """
+    计算主机所属的分组：IPv4 地址按 subnet_prefix 子网，IPv6 地址按 /64 子网，主机名按域名后缀。
+    """
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return host.split('.', 1)[1] if '.' in host else host
+    prefix = subnet_prefix if address.version == 4 else 64
+    return str(ipaddress.ip_network(f'{host}/{prefix}', strict=False))
+
+
+class RelayDistributor:
+    """
+    中继分发器。
+
+    先由本机把升级文件上传到每组的种子主机，再由已拿到文件的主机通过局域网向同组的
+    其他主机提供下载，形成扇出为 fan_out 的分发树。每台主机收到文件后都使用与直接上传
+    相同的 SHA-256 校验（UpgradeManager.probe_remote_files），校验通过后才会继续向下分发。
+    分发失败的主机不影响升级，升级时会回退为从本机直接上传。
+
+    每组第一台暂存了升级文件的主机作为锚点，暂存目录一直保留到 close()（升级删除该主机上的升级文件后仍然可用），
+    之后每一波都由锚点向同组主机提供下载，不再从本机上传种子主机；锚点无法提供文件时才重新上传种子主机。
+
+    参数:
+    - config: RelayConfig 实例。
+    - transfer_config: 上传种子主机时使用的 TransferConfig。
+    - artifact_store: 批量升级共享的 ArtifactStore。
+    - pool: ConnectionPool，分发使用的连接在之后的升级中复用，为空时不复用。
+    - upload_limiter: 与升级共享的上传限速器（concurrency.TokenBucket），只限制向种子主机的上传。
+    - limiter: 批量升级的并发限制器，分发中每条 SSH 连接（上传、下载、启停文件服务和删除文件）
+      在使用期间占用它的一个许可，为空时不限制。
+    - stage_pools: 与升级共享的 StagePools，分发中的连接占用 connect 阶段的名额，种子主机的上传占用 upload 阶段的名额。
+    - ssh_port: 连接各主机使用的 SSH 端口。
+    """
+
+    def __init__(self, config, transfer_config, artifact_store, pool=None, upload_limiter=None, limiter=None,
+                 stage_pools=None, ssh_port=22):
+        self.config = config
+        self.transfer_config = transfer_config
+        self.artifact_store = artifact_store
+        self.pool = pool
+        self.upload_limiter = upload_limiter
+        self.limiter = limiter
+        self.stage_pools = stage_pools or StagePools()
+        self.ssh_port = ssh_port
+        self._anchors = {}  # 分组 -> (job, 暂存目录)
+
+    async def distribute(self, jobs, file_path):
+        """
+        把升级文件分发到所有主机。
+
+        参数:
+        - jobs: (key, host, username, password) 列表。
+        - file_path: 本地升级文件路径。
+
+        返回:
+        - 字典 key -> 是否已拿到校验通过的文件。
+        """
+        artifact = self.artifact_store.get(file_path)
+        await artifact.ensure_digests_async(self.transfer_config.chunk_size)
+        remote_path = UpgradeManager.remote_path(file_path)
+
+        groups = collections.defaultdict(list)
+        for job in jobs:
+            groups[group_key(job[1], self.config.subnet_prefix)].append(job)
+
+        delivered = {}
+        results = await asyncio.gather(*(self._distribute_group(name, group, artifact, remote_path)
+                                         for name, group in groups.items()))
+        for result in results:
+            delivered.update(result)
+        return delivered
+
+    async def remove(self, jobs, file_path):
+        """
+        删除 jobs 中各主机上已分发的升级文件，用于分发后没有升级的主机（例如批量升级中止后被跳过）。
+        同时进行的删除数量与分发中的其他连接一样受 limiter 限制，删除失败只打印警告。
+
+        参数:
+        - jobs: (key, host, username, password) 列表。
+        - file_path: 本地升级文件路径。
+        """
+        command = f'rm -f {shlex.quote(UpgradeManager.remote_path(file_path))}'
+
+        async def remove_one(job):
+            try:
+                await self._run_command(job, command)
+            except Exception as e:
+                print(f"Failed to remove relayed file from {job[1]}: {e}")
+
+        await asyncio.gather(*(remove_one(job) for job in jobs))
+
+    async def close(self):
+        """
+        删除各组锚点主机上的暂存目录，批量升级结束时调用。
+        """
+        anchors, self._anchors = list(self._anchors.values()), {}
+        await asyncio.gather(*(self._unstage(job, directory) for job, directory in anchors),
+                             return_exceptions=True)
+
+    async def _distribute_group(self, name, jobs, artifact, remote_path):
+        delivered = {job[0]: False for job in jobs}
+        servers = []  # (job, pid)
+        staged = []  # (job, 暂存目录)，本组分发结束时删除
+        slots = asyncio.Queue()  # 每个元素代表某台源主机的一个空闲下载名额
+        active = asyncio.Semaphore(self.config.max_active) if self.config.max_active > 0 else None
+
+        async def stage(job):
+            # 本组还没有锚点时，暂存目录作为锚点保留给之后的波使用
+            directory = await self._stage(job, artifact, remote_path)
+            if directory is not None:
+                if name in self._anchors:
+                    staged.append((job, directory))
+                else:
+                    self._anchors[name] = (job, directory)
+            return directory
+
+        async def add_source(job, directory):
+            pid = await self._start_serving(job, directory)
+            if pid is not None:
+                servers.append((job, pid))
+                for _ in range(self.config.fan_out):
+                    slots.put_nowait(job)
+
+        anchor = self._anchors.get(name)
+        if anchor is not None:
+            await add_source(*anchor)
+            if not servers:
+                # 锚点无法提供文件（例如主机已重启），改为重新上传种子主机
+                del self._anchors[name]
+                staged.append(anchor)
+        if servers:
+            seeds, peers = [], jobs
+        else:
+            seeds, peers = jobs[:self.config.seeds_per_group], jobs[self.config.seeds_per_group:]
+        unassigned = [len(peers)]  # 尚未分配源主机的同组主机数量
+
+        async def seed(job):
+            delivered[job[0]] = await self._upload_seed(job, artifact, remote_path)
+            if delivered[job[0]] and (peers or name not in self._anchors):
+                directory = await stage(job)
+                if directory is not None and peers:
+                    await add_source(job, directory)
+
+        async def relay(job, source):
+            try:
+                delivered[job[0]] = await self._fetch_from(job, source, artifact, remote_path)
+                if delivered[job[0]] and unassigned[0] > 0:
+                    directory = await stage(job)
+                    if directory is not None:
+                        await add_source(job, directory)
+            finally:
+                slots.put_nowait(source)
+                if active is not None:
+                    active.release()
+
+        tasks = []
+        try:
+            await asyncio.gather(*(seed(job) for job in seeds))
+            if servers:
+                for job in peers:
+                    if active is not None:
+                        await active.acquire()
+                    source = await slots.get()
+                    unassigned[0] -= 1
+                    tasks.append(asyncio.ensure_future(relay(job, source)))
+                await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*(self._stop_serving(job, pid) for job, pid in servers),
+                                 return_exceptions=True)
+            await asyncio.gather(*(self._unstage(job, directory) for job, directory in staged),
+                                 return_exceptions=True)
+        return delivered
+
+    def _ssh_manager(self, job):
+        _, host, username, password = job
+        from ssh_manager import SSHManager  # 延迟导入 asyncssh，缩短启动时间
+        return SSHManager(host, username, password, port=self.ssh_port, pool=self.pool,
+                          upload_limiter=self.upload_limiter)
+
+    @contextlib.asynccontextmanager
+    async def _permit(self):
+        """
+        在 async with 语句块中占用 limiter 的一个许可，limiter 为空时直接进入。
+        每条分发连接只在自己的语句块中占用许可，不嵌套获取，避免许可耗尽时互相等待。
+        """
+        if self.limiter is None:
+            yield
+            return
+        await self.limiter.acquire()
+        try:
+            yield
+        finally:
+            self.limiter.release()
+
+    async def _connect(self, ssh_manager):
+        async with self.stage_pools.slot('connect'):
+            await ssh_manager.connect_async()
+
+    async def _run_command(self, job, command):
+        ssh_manager = self._ssh_manager(job)
+        async with self._permit():
+            try:
+                await self._connect(ssh_manager)
+                return await ssh_manager.execute_command_async(command)
+            finally:
+                await ssh_manager.close_async()
+
+    async def _upload_seed(self, job, artifact, remote_path):
+        """
+        由本机直接上传到种子主机（支持跳过和断点续传）。
+        """
+        ssh_manager = self._ssh_manager(job)
+        upgrade_manager = UpgradeManager(ssh_manager, transfer_config=self.transfer_config,
+                                         artifact_store=self.artifact_store)
+        async with self._permit():
+            try:
+                await self._connect(ssh_manager)
+                async with self.stage_pools.slot('upload'):
+                    await upgrade_manager.upload_async([(artifact.path, remote_path)])
+                return True
+            except Exception as e:
+                print(f"Relay seed upload to {job[1]} failed: {e}")
+                return False
+            finally:
+                await ssh_manager.close_async()
+
+    async def _fetch_from(self, job, source, artifact, remote_path):
+        """
+        让 job 主机从 source 主机下载文件，并用 SHA-256 校验结果。
+        """
+        ssh_manager = self._ssh_manager(job)
+        upgrade_manager = UpgradeManager(ssh_manager, transfer_config=self.transfer_config)
+        source_host = f'[{source[1]}]' if ':' in source[1] else source[1]
+        url = f'http://{source_host}:{self.config.port}/{artifact.name}'
+        async with self._permit():
+            try:
+                await self._connect(ssh_manager)
+                # 目标主机上已有一致的文件时无需下载
+                if (await upgrade_manager.probe_remote_files([(artifact, remote_path)]))[0] is None:
+                    return True
+                await ssh_manager.execute_command_async(self.config.fetch_command.format(
+                    path=shlex.quote(remote_path), url=shlex.quote(url), timeout=self.config.timeout))
+                return (await upgrade_manager.probe_remote_files([(artifact, remote_path)]))[0] is None
+            except Exception as e:
+                print(f"Relay from {source[1]} to {job[1]} failed: {e}")
+                return False
+            finally:
+                await ssh_manager.close_async()
+
+    async def _stage(self, job, artifact, remote_path):
+        """
+        把 job 主机上的升级文件暂存到供文件服务使用的临时目录。
+
+        返回:
+        - 暂存目录，失败时返回 None。
+        """
+        try:
+            stdout, _ = await self._run_command(job, self.config.stage_command.format(
+                path=shlex.quote(remote_path), name=shlex.quote(artifact.name)))
+        except Exception as e:
+            print(f"Relay staging on {job[1]} failed: {e}")
+            return None
+        fields = stdout.split()
+        return fields[0] if len(fields) == 1 else None
+
+    async def _unstage(self, job, directory):
+        """
+        删除 job 主机上的暂存目录。
+        """
+        await self._run_command(job, self.config.unstage_command.format(dir=shlex.quote(directory)))
+
+    async def _start_serving(self, job, directory):
+        """
+        在 job 主机上启动文件服务进程，提供暂存目录 directory 中的文件。
+
+        返回:
+        - 服务进程的 pid，启动失败时返回 None。
+        """
+        try:
+            stdout, _ = await self._run_command(job, self.config.serve_command.format(
+                dir=shlex.quote(directory), host=shlex.quote(job[1]), port=self.config.port,
+                timeout=self.config.timeout))
+        except Exception as e:
+            print(f"Relay server on {job[1]} failed to start: {e}")
+            return None
+        fields = stdout.split()
+        if len(fields) != 1 or not fields[0].isdigit():
+            return None
+        return fields[0]
+
+    async def _stop_serving(self, job, pid):
+        """
+        停止 job 主机上的文件服务进程。
+        """
+        await self._run_command(job, self.config.stop_command.format(pid=pid))
@@ -0,0 +1,247 @@
+import math
+import sqlite3
+import time
+
+from metrics import PHASES
+
+DURATIONS = PHASES + ('total',)  # results 表中保存耗时（秒）的列
+
+
+class HistoryStore:
+    """
+    基于 SQLite 的主机清单和升级历史。
+
+    主机清单的增删改和每台主机的升级结果都按变化增量写入，不再每次重写整个清单；
+    results 表按 (host, run_id) 和 (run_id, total) 建立索引，一万台主机规模的历史查询无需扫描全表。
+    数据库无法打开或写入时打印警告并停用，不影响升级本身。
+
+    参数:
+    - path: 数据库文件路径。
+    """
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        try:
+            self._conn = sqlite3.connect(path)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._create_schema()
+        except sqlite3.Error as e:
+            print(f"Warning: history store {path} is disabled: {e}")
+            self.close()
+
+    def _create_schema(self):
+        phase_columns = ', '.join(f'{name} REAL' for name in DURATIONS)
+        with self._conn:
+            self._conn.executescript(f'''
+                CREATE TABLE IF NOT EXISTS hosts (
+                    host TEXT PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    password TEXT NOT NULL,
+                    position INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS hosts_position ON hosts (position);
+                CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    upgrade_file TEXT,
+                    upgrade_script TEXT,
+                    started_at REAL NOT NULL,
+                    finished_at REAL,
+                    hosts INTEGER,
+                    succeeded INTEGER,
+                    failed INTEGER,
+                    skipped INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS results (
+                    run_id INTEGER NOT NULL REFERENCES runs (id),
+                    host TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    message TEXT,
+                    started_at REAL,
+                    {phase_columns},
+                    bytes_uploaded INTEGER,
+                    retries INTEGER,
+                    PRIMARY KEY (run_id, host)
+                );
+                CREATE INDEX IF NOT EXISTS results_host ON results (host, run_id);
+                CREATE INDEX IF NOT EXISTS results_run_total ON results (run_id, total);
+                PRAGMA user_version = {self.SCHEMA_VERSION};
+            ''')
+
+    @property
+    def enabled(self):
+        return self._conn is not None
+
+    def _write(self, sql, parameters=(), many=False):
+        """
+        在一个事务中执行写操作，出错时打印警告并返回 None。
+        """
+        if self._conn is None:
+            return None
+        try:
+            with self._conn:
+                if many:
+                    return self._conn.executemany(sql, parameters)
+                return self._conn.execute(sql, parameters)
+        except sqlite3.Error as e:
+            print(f"Error writing history: {e}")
+            return None
+
+    def _query(self, sql, parameters=()):
+        if self._conn is None:
+            return []
+        try:
+            return self._conn.execute(sql, parameters).fetchall()
+        except sqlite3.Error as e:
+            print(f"Error reading history: {e}")
+            return []
+
+    def inventory(self):
+        """
+        按显示顺序返回主机清单 [(host, username, password)]。
+        """
+        return self._query('SELECT host, username, password FROM hosts ORDER BY position')
+
+    def add_hosts(self, configs):
+        """
+        把 (host, username, password) 追加到清单末尾，已存在的主机更新登录信息。
+        """
+        rows = self._query('SELECT COALESCE(MAX(position), -1) FROM hosts')
+        start = rows[0][0] + 1 if rows else 0
+        self._write('INSERT INTO hosts (host, username, password, position) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (host) DO UPDATE SET username = excluded.username, password = excluded.password',
+                    [(host, username, password, position)
+                     for position, (host, username, password) in enumerate(configs, start)], many=True)
+
+    def replace_inventory(self, configs):
+        """
+        用 (host, username, password) 序列替换整个清单。
+        """
+        if self._conn is None:
+            return
+        try:
+            with self._conn:
+                self._conn.execute('DELETE FROM hosts')
+                self._conn.executemany('INSERT OR REPLACE INTO hosts (host, username, password, position) '
+                                       'VALUES (?, ?, ?, ?)',
+                                       [(host, username, password, position)
+                                        for position, (host, username, password) in enumerate(configs)])
+        except sqlite3.Error as e:
+            print(f"Error writing history: {e}")
+
+    def update_host(self, old_host, host, username, password):
+        """
+        修改清单中 old_host 的地址和登录信息，保持其位置不变。
+        """
+        self._write('UPDATE hosts SET host = ?, username = ?, password = ? WHERE host = ?',
+                    (host, username, password, old_host))
+
+    def remove_host(self, host):
+        """
+        从清单中删除主机（保留其升级历史）。
+        """
+        self._write('DELETE FROM hosts WHERE host = ?', (host,))
+
+    def begin_run(self, kind, upgrade_file, upgrade_script):
+        """
+        记录一次升级的开始。
+
+        参数:
+        - kind: 升级方式，例如 'rollout'（批量升级）、'single'（单个主机）或 'cli'。
+
+        返回:
+        - run_id，数据库不可用时为 None。
+        """
+        cursor = self._write('INSERT INTO runs (kind, upgrade_file, upgrade_script, started_at) VALUES (?, ?, ?, ?)',
+                             (kind, upgrade_file, upgrade_script, time.time()))
+        return cursor.lastrowid if cursor is not None else None
+
+    def record_results(self, run_id, results):
+        """
+        在一个事务中写入多台主机的结果。
+
+        参数:
+        - results: (host, 状态, 消息, HostMetrics 或 None) 序列，未开始升级（例如被跳过）的主机没有 HostMetrics。
+        """
+        if run_id is None:
+            return
+        rows = []
+        for host, status, message, metrics in results:
+            if metrics is None:
+                rows.append((run_id, host, status, message, None) + (None,) * len(DURATIONS) + (0, 0))
+            else:
+                durations = tuple(metrics.phases.get(name) for name in PHASES) + (metrics.total,)
+                rows.append((run_id, host, status, message, metrics.started_at) + durations
+                            + (metrics.bytes_uploaded, metrics.retries))
+        columns = ', '.join(DURATIONS)
+        placeholders = ', '.join('?' * (len(DURATIONS) + 7))
+        self._write(f'INSERT OR REPLACE INTO results (run_id, host, status, message, started_at, {columns}, '
+                    f'bytes_uploaded, retries) VALUES ({placeholders})', rows, many=True)
+
+    def finish_run(self, run_id):
+        """
+        记录一次升级的结束，并根据 results 汇总主机数和各状态的数量。
+        """
+        if run_id is None:
+            return
+        self._write("UPDATE runs SET finished_at = ?, "
+                    "hosts = (SELECT COUNT(*) FROM results WHERE run_id = runs.id), "
+                    "succeeded = (SELECT COUNT(*) FROM results WHERE run_id = runs.id AND status = 'Success'), "
+                    "failed = (SELECT COUNT(*) FROM results WHERE run_id = runs.id AND status = 'Fail'), "
+                    "skipped = (SELECT COUNT(*) FROM results WHERE run_id = runs.id AND status = 'Skipped') "
+                    "WHERE id = ?", (time.time(), run_id))
+
+    def failing_hosts(self, runs=3):
+        """
+        返回最近参与的 runs 次升级全部失败的主机及其最后一次的错误消息 [(host, message)]。
+        """
+        # 只检查最近一次结果为失败的主机，每台主机的最近 runs 条结果通过 (host, run_id) 索引读取
+        return self._query('''
+            SELECT r.host, r.message FROM results AS r
+            WHERE r.status = 'Fail'
+              AND r.run_id = (SELECT MAX(run_id) FROM results WHERE host = r.host)
+              AND (SELECT COUNT(*) FROM (SELECT status FROM results WHERE host = r.host
+                                         ORDER BY run_id DESC LIMIT ?) WHERE status = 'Fail') = ?
+            ORDER BY r.host
+        ''', (runs, runs))
+
+    def slowest_hosts(self, fraction=0.05, phase='total', run_id=None):
+        """
+        返回某次升级中 phase 耗时最长的 fraction 比例的主机 [(host, 耗时)]，按耗时降序排列。
+
+        参数:
+        - phase: metrics.PHASES 中的阶段或 'total'。
+        - run_id: 为空时使用最近一次升级。
+        """
+        if phase not in DURATIONS:
+            raise ValueError(f'Unknown phase: {phase}')
+        if run_id is None:
+            rows = self._query('SELECT MAX(id) FROM runs')
+            run_id = rows[0][0] if rows else None
+            if run_id is None:
+                return []
+        rows = self._query(f'SELECT COUNT(*) FROM results WHERE run_id = ? AND {phase} IS NOT NULL', (run_id,))
+        count = rows[0][0] if rows else 0
+        if not count:
+            return []
+        return self._query(f'SELECT host, {phase} FROM results WHERE run_id = ? AND {phase} IS NOT NULL '
+                           f'ORDER BY {phase} DESC LIMIT ?', (run_id, max(1, math.ceil(count * fraction))))
+
+    def host_history(self, host, limit=20):
+        """
+        返回主机最近 limit 次升级的 [(run_id, 状态, 消息, 总耗时)]，最新的在前。
+        """
+        return self._query('SELECT run_id, status, message, total FROM results WHERE host = ? '
+                           'ORDER BY run_id DESC LIMIT ?', (host, limit))
+
+    def close(self):
+        """
+        关闭数据库连接。
+        """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
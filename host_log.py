@@ -0,0 +1,60 @@
+import os
+import re
+import time
+
+
+class HostLog:
+    """
+    把单个主机的远程输出完整追加写入磁盘文件。
+
+    每个主机对应 directory 下的一个日志文件，多次升级的输出依次追加，每次升级前写入一行
+    带时间戳的分隔标题。文件在写入第一行输出时才打开，写入经过缓冲，内存占用与输出量无关。
+
+    参数:
+    - directory: 日志目录，为空时不写入任何文件。
+    - host: 主机地址，用于生成文件名。
+    """
+
+    def __init__(self, directory, host):
+        """
+        初始化HostLog实例。
+        """
+        self.host = host
+        self.path = os.path.join(directory, self.file_name(host)) if directory else None
+        self._file = None
+
+    @staticmethod
+    def file_name(host):
+        """
+        主机对应的日志文件名（把不能出现在文件名中的字符替换为下划线）。
+        """
+        return re.sub(r'[^\w.-]', '_', host) + '.log'
+
+    def write(self, stream, line):
+        """
+        追加一行输出，标准错误输出的行带有 "[stderr] " 前缀。
+        """
+        if self.path is None:
+            return
+        try:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._file = open(self.path, 'a', encoding='utf-8', errors='replace')
+                self._file.write(f"===== {time.strftime('%Y-%m-%d %H:%M:%S')} {self.host} =====\n")
+            self._file.write(f'[stderr] {line}\n' if stream == 'stderr' else f'{line}\n')
+        except OSError as e:
+            # 日志写入失败不影响升级本身，之后不再尝试写入
+            print(f"警告: 无法写入日志文件 {self.path}: {e}")
+            self.close()
+            self.path = None
+
+    def close(self):
+        """
+        关闭日志文件。
+        """
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
@@ -1,37 +1,24 @@
 import os
 import sys
+import csv
 import json
-import pandas as pd
-import asyncio
 from PyQt5 import uic
-from PyQt5.QtGui import QColor, QPalette, QBrush, QPixmap, QIcon
-from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox, QTableWidgetItem, QPushButton, \
-    QFileDialog
-from PyQt5.QtCore import QThread, pyqtSignal, QFileInfo, QByteArray, QTimer, Qt
-from ssh_manager import SSHManager
-from upgrade_manager import UpgradeManager
-
-
-class UpgradeWorker(QThread):
-    finished = pyqtSignal(int, str, str)  # 行号，状态，消息
-    progress = pyqtSignal(int, int)  # 进度信号
-
-    def __init__(self, coro, row):
-        super().__init__()
-        self.coro = coro
-        self.row = row
-
-    def run(self):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            loop.report_progress = lambda p: self.progress.emit(self.row, p)
-            result = loop.run_until_complete(self.coro)
-            self.finished.emit(self.row, "Success", str(result))
-        except Exception as e:
-            self.finished.emit(self.row, "Fail", str(e))
-        finally:
-            loop.close()
+from PyQt5.QtGui import QPalette, QBrush, QPixmap, QIcon
+from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox, QFileDialog, QHeaderView, QInputDialog
+from PyQt5.QtCore import pyqtSignal, QFileInfo, QByteArray, QTimer, Qt
+from task_table import TaskTableModel, ButtonDelegate
+from upgrade_manager import CancelConfig, TransferConfig
+from upgrade_engine import UpgradeEngine
+from scheduler import SchedulerConfig
+from concurrency import StageConfig
+from batch_command import CommandConfig
+from connection_pool import PoolConfig
+from distribution import RelayConfig
+from reachability import ScanConfig
+from retry_policy import RetryConfig
+from sharding import ShardConfig
+from metrics import RunMetrics
+from history_store import HistoryStore
 
 
 class MainWindow(QMainWindow):
@@ -51,7 +38,15 @@ class MainWindow(QMainWindow):
         5: 80,  # Upgrade
         6: 80  # Delete
     }  # 定义表格初始列宽
-    update_gui_signal = pyqtSignal(int, str, str)  # 用于更新 GUI 的信号
+    HISTORY_FILE = os.path.join(os.path.dirname(CONFIG_FILE), 'history.db')  # 主机清单和升级历史
+    LOG_DIR = os.path.join(os.path.dirname(CONFIG_FILE), 'logs')  # 每个主机完整远程输出的日志目录
+    METRICS_JSONL_FILE = os.path.join(LOG_DIR, 'metrics.jsonl')  # 每次升级结束后追加每个主机的阶段耗时
+    METRICS_PROM_FILE = os.path.join(LOG_DIR, 'metrics.prom')  # 最近一次升级的 Prometheus 文本格式统计
+    FAILING_RUNS = 3  # 升级统计中列出最近连续失败这么多次的主机
+    LOG_TAIL_LINES = 200  # 每个主机在界面中保留的最后输出行数
+    LOG_LINE_LENGTH = 500  # 界面中每行输出保留的最大字符数
+    ENGINE_POLL_INTERVAL = 33  # 轮询升级引擎事件队列并批量刷新表格的间隔（毫秒，约 30 Hz）
+    update_gui_signal = pyqtSignal(str, str, str)  # 用于更新 GUI 的信号，参数为 (主机, 状态, 消息)
 
     def __init__(self):
         """
@@ -60,12 +55,29 @@ class MainWindow(QMainWindow):
         super().__init__()
         self._last_opened_dir = ''
         self.running_tasks = set()
-        self.upgrade_workers = []
         self.total_tasks = 0
-        self.upgrade_progresses = {}
-        self.upgrade_statuses = {}
-        self.update_overall_progress()
+        self.task_model = TaskTableModel(self.LOG_TAIL_LINES, self)
+        self.dirty_hosts = set()  # 等待下一次刷新时重绘的主机
         self.is_upgrading_all = False
+        self.rollout_running = False
+        self.rollout_summary = None
+        self.command_running = False
+        self.last_command = ''
+        self.cancelling = False  # 正在后台取消升级，收到 'cancel_finished' 之前忽略其他事件
+        self.run_metrics = RunMetrics()  # 当前（或最近一次）升级中各主机的阶段耗时
+        self.history = HistoryStore(self.HISTORY_FILE)
+        self.run_id = None  # 当前升级在 history 中的编号
+        self.pending_metrics = {}  # host -> 已收到但尚未随 'finished' 事件写入历史的 HostMetrics
+        self.pending_results = []  # 等待下一次刷新时写入历史的 (host, 状态, 消息, HostMetrics)
+        self.scheduler_config = SchedulerConfig()
+
+        # 所有主机共享同一个后台事件循环
+        self.engine = UpgradeEngine()
+        self.engine.log_dir = self.LOG_DIR
+        self.engine.start()
+        self.engine_timer = QTimer(self)
+        self.engine_timer.timeout.connect(self.process_engine_events)
+        self.engine_timer.start(self.ENGINE_POLL_INTERVAL)
 
         self.init_ui()
         self.set_app_icon()
@@ -84,6 +96,7 @@ class MainWindow(QMainWindow):
 
         self.setup_table()
         self.setup_progress_bar()
+        self.update_overall_progress()
 
     def set_app_icon(self):
         """
@@ -124,14 +137,21 @@ class MainWindow(QMainWindow):
 
     def setup_table(self):
         """
-        初始化表格。
+        初始化表格：数据来自 TaskTableModel，升级和删除按钮由委托绘制。
         """
-        self.upgradeTasksTable.setColumnCount(7)
-        self.upgradeTasksTable.setHorizontalHeaderLabels(
-            ['Host', 'Username', 'Password', 'State', 'Logs', 'Upgrade', 'Delete'])
+        self.upgradeTasksTable.setModel(self.task_model)
+        self.upgrade_delegate = ButtonDelegate('Upgrade', '#0067c0', self)
+        self.upgrade_delegate.clicked.connect(self.upgrade_host)
+        self.task_model.task_edited.connect(self.on_task_edited)
+        self.delete_delegate = ButtonDelegate('Delete', '#d32f2f', self)
+        self.delete_delegate.clicked.connect(self.remove_upgrade_task)
+        self.upgradeTasksTable.setItemDelegateForColumn(TaskTableModel.UPGRADE, self.upgrade_delegate)
+        self.upgradeTasksTable.setItemDelegateForColumn(TaskTableModel.DELETE, self.delete_delegate)
         for col, width in self.INITIAL_COLUMN_WIDTHS.items():
             self.upgradeTasksTable.setColumnWidth(col, width)
-        self.upgradeTasksTable.verticalHeader().setDefaultSectionSize(40)  # 设置表格行高
+        vertical_header = self.upgradeTasksTable.verticalHeader()
+        vertical_header.setSectionResizeMode(QHeaderView.Fixed)  # 固定行高，避免逐行计算尺寸
+        vertical_header.setDefaultSectionSize(40)  # 设置表格行高
 
     def setup_progress_bar(self):
         """
@@ -143,6 +163,8 @@ class MainWindow(QMainWindow):
     def setup_connections(self):
         self.addUpgradeTaskButton.clicked.connect(self.add_upgrade_task)
         self.upgradeAllHostsButton.clicked.connect(self.upgrade_all)
+        self.scanHostsButton.clicked.connect(self.scan_all)
+        self.runCommandButton.clicked.connect(self.run_command)
         self.upgradeFileButton.clicked.connect(self.select_upgrade_file)
         self.upgradeScriptButton.clicked.connect(self.select_upgrade_script)
         self.importButton.clicked.connect(self.import_ssh_configs)
@@ -171,25 +193,17 @@ class MainWindow(QMainWindow):
             self.upgradeScriptEntry.setText(file_path)
             self.save_last_opened_dir(file_path)
 
-    def add_upgrade_task_row(self, host, username, password):
+    def add_upgrade_task_rows(self, configs, replace=False):
         """
-        添加新的升级任务。
+        批量添加 (host, username, password) 升级任务，已存在的主机会被跳过；replace 为真时替换所有任务。
+        新增的主机同时写入 history 中的主机清单。
         """
-        row_position = self.upgradeTasksTable.rowCount()
-        self.upgradeTasksTable.insertRow(row_position)
-        self.upgradeTasksTable.setItem(row_position, 0, host)
-        self.upgradeTasksTable.setItem(row_position, 1, username)
-        self.upgradeTasksTable.setItem(row_position, 2, password)
-
-        upgrade_button = QPushButton('Upgrade')
-        upgrade_button.clicked.connect(lambda _, r=row_position: self.upgrade_host(r))
-        upgrade_button.setStyleSheet("color: #0067c0;")
-        self.upgradeTasksTable.setCellWidget(row_position, 5, upgrade_button)
-
-        delete_button = QPushButton('Delete')
-        delete_button.clicked.connect(lambda _, r=row_position: self.remove_upgrade_task(r))
-        delete_button.setStyleSheet("color: #d32f2f;")
-        self.upgradeTasksTable.setCellWidget(row_position, 6, delete_button)
+        tasks = self.task_model.add_tasks(configs, replace)
+        rows = [(task.host, task.username, task.password) for task in tasks]
+        if replace:
+            self.history.replace_inventory(rows)
+        elif rows:
+            self.history.add_hosts(rows)
 
     def add_upgrade_task(self):
         """
@@ -199,56 +213,33 @@ class MainWindow(QMainWindow):
         username = self.usernameEntry.text()
         password = self.passwordEntry.text()
         if host and username and password:
-            self.add_upgrade_task_row(QTableWidgetItem(host),
-                                      QTableWidgetItem(username),
-                                      QTableWidgetItem(password))
+            self.add_upgrade_task_rows([(host, username, password)])
         self.update_task_count()
         self.check_and_update_progress_bar_color()
 
-    def remove_upgrade_task(self, row):
+    def remove_upgrade_task(self, host):
         """
-        删除指定的升级任务。
+        删除指定主机的升级任务。
         """
-        self.upgradeTasksTable.removeRow(row)
-
-        # 更新 upgrade_progresses 和 upgrade_statuses
-        del self.upgrade_progresses[row]
-        del self.upgrade_statuses[row]
-
-        # 重新编号剩余的任务
-        new_progresses = {}
-        new_statuses = {}
-        for i, (old_row, progress) in enumerate(sorted(self.upgrade_progresses.items())):
-            new_progresses[i] = progress
-            new_statuses[i] = self.upgrade_statuses[old_row]
-
-        self.upgrade_progresses = new_progresses
-        self.upgrade_statuses = new_statuses
-
-        # 更新所有升级和删除按钮的lambda函数
-        for i in range(self.upgradeTasksTable.rowCount()):
-            upgrade_button = self.upgradeTasksTable.cellWidget(i, 5)
-            upgrade_button.clicked.disconnect()
-            upgrade_button.clicked.connect(lambda _, r=i: self.upgrade_host(r))
-
-            delete_button = self.upgradeTasksTable.cellWidget(i, 6)
-            delete_button.clicked.disconnect()
-            delete_button.clicked.connect(lambda _, r=i: self.remove_upgrade_task(r))
-
-        self.upgradeTasksTable.setCurrentItem(None)
+        self.task_model.remove_task(host)
+        self.history.remove_host(host)
+        self.upgradeTasksTable.clearSelection()
         self.update_task_count()
         self.check_and_update_progress_bar_color()
 
+    def on_task_edited(self, old_host, host):
+        """
+        把表格中修改的主机、用户名或密码写入 history 中的主机清单。
+        """
+        task = self.task_model.task(host)
+        if task is not None:
+            self.history.update_host(old_host, task.host, task.username, task.password)
+
     def update_task_count(self):
         """
         更新任务数量。
         """
-        task_count = self.upgradeTasksTable.rowCount()
-        self.total_tasks = task_count
-        new_progresses = {row: self.upgrade_progresses.get(row, 0) for row in range(task_count)}
-        self.upgrade_progresses = new_progresses
-        new_statuses = {row: self.upgrade_statuses.get(row, "default") for row in range(task_count)}
-        self.upgrade_statuses = new_statuses
+        self.total_tasks = self.task_model.rowCount()
         self.update_overall_progress()  # 更新任务数量后，更新总体进度
 
     def clear_ssh_configs(self):
@@ -264,53 +255,88 @@ class MainWindow(QMainWindow):
         else:
             return
 
-        self.upgradeTasksTable.clearContents()
-        self.upgradeTasksTable.setRowCount(0)
-        self.upgrade_progresses.clear()
-        self.upgrade_statuses.clear()
+        self.task_model.clear()
+        self.history.replace_inventory([])
+        self.total_tasks = 0
         self.overallProgressBar.setValue(0)
         self.reset_progress_bar_color()
 
     def stop_all_tasks(self):
         """
-        停止所有任务。
-        """
-        for worker in list(self.running_tasks):
-            worker.terminate()
-            worker.wait()
-            self.running_tasks.remove(worker)
-        self.upgrade_workers.clear()
-        self.upgradeAllHostsButton.setEnabled(True)
+        停止所有任务：立即停止调度，正在进行的升级在后台清理远程临时文件并关闭连接，
+        清理完成（'cancel_finished' 事件）之前按钮保持禁用。
+        """
+        self.cancelling = True
+        self.engine.submit_cancel()
+        if self.running_tasks:
+            self.flush_table_updates()
+            self.history.finish_run(self.run_id)
+        self.running_tasks.clear()
+        self.rollout_running = False
+        self.command_running = False
+        self.is_upgrading_all = False
+        self.set_all_buttons_enabled(False)
+        self.upgradeAllHostsButton.setEnabled(False)
         self.overallProgressBar.setValue(0)
         self.reset_progress_bar_color()
 
-    async def connect_ssh(self, row):
+    def scan_all(self):
         """
-        连接SSH并执行升级操作。
+        对所有主机进行可达性预扫描，扫描结果在有效期内供升级使用，不可达的主机在批量升级时直接排除。
         """
-        host = self.upgradeTasksTable.item(row, 0).text()
-        username = self.upgradeTasksTable.item(row, 1).text()
-        password = self.upgradeTasksTable.item(row, 2).text()
-        ssh_manager = SSHManager(host, username, password)
-        upgrade_manager = UpgradeManager(ssh_manager)
-        try:
-            result = await upgrade_manager.execute_upgrade_async()
-            if isinstance(result, str):  # 如果是错误消息
-                raise Exception(result)
-            stdout, stderr = result
-            if stderr:
-                raise Exception(stderr)
-            self.upgradeTasksTable.setItem(row, 3, QTableWidgetItem("Success"))
-            self.upgradeTasksTable.setItem(row, 4, QTableWidgetItem(stdout))
-        except Exception as e:
-            self.upgradeTasksTable.setItem(row, 3, QTableWidgetItem("Fail"))
-            self.upgradeTasksTable.setItem(row, 4, QTableWidgetItem(str(e)))
+        tasks = self.task_model.tasks()
+        if not tasks:
+            QMessageBox.warning(self, "警告", "没有添加任何任务!\n"
+                                            "请先添加至少一个升级任务。")
+            return
+        if self.running_tasks:
+            QMessageBox.warning(self, "警告", "请等待正在进行的升级结束后再扫描。")
+            return
+        for task in tasks:
+            self.task_model.reset_task(task, "Scanning")
+        self.task_model.refresh_all()
+        self.set_all_buttons_enabled(False)
+        self.upgradeAllHostsButton.setEnabled(False)
+        self.engine.submit_scan([(task.host, task.host) for task in tasks])
+
+    def run_command(self):
+        """
+        在选中的主机（没有选中时为所有主机）上执行同一条命令，结束后按输出分组显示结果。
+        """
+        tasks = self.task_model.tasks()
+        rows = sorted({index.row() for index in self.upgradeTasksTable.selectionModel().selectedIndexes()})
+        if rows:
+            tasks = [tasks[row] for row in rows]
+        if not tasks:
+            QMessageBox.warning(self, "警告", "没有添加任何任务!\n"
+                                            "请先添加至少一个升级任务。")
+            return
+        if self.running_tasks:
+            QMessageBox.warning(self, "警告", "请等待正在进行的升级结束后再执行命令。")
+            return
+        command, ok = QInputDialog.getText(self, '批量命令', f'在 {len(tasks)} 台主机上执行的命令:',
+                                           text=self.last_command)
+        if not ok or not command.strip():
+            return
+        self.last_command = command
+        jobs = []
+        for task in tasks:
+            jobs.append((task.host, task.host, task.username, task.password))
+            # 只记录命令状态，保留升级状态和进度，"重试失败"仍然按升级结果选择主机
+            task.command_status = "Running"
+            task.message = ''
+        self.task_model.refresh_all()
+        self.command_running = True
+        self.set_all_buttons_enabled(False)
+        self.upgradeAllHostsButton.setEnabled(False)
+        self.upgradeTasksTable.clearSelection()
+        self.engine.submit_command(jobs, command, self.scheduler_config)
 
     def upgrade_all(self):
         """
-        为所有SSH配置创建并启动异步工作线程。
+        为所有SSH配置提交升级任务到升级引擎。
         """
-        if self.upgradeTasksTable.rowCount() == 0:
+        if self.task_model.rowCount() == 0:
             QMessageBox.warning(self, "警告", "没有添加任何任务!\n"
                                             "请先添加至少一个升级任务。")
             return
@@ -325,21 +351,35 @@ class MainWindow(QMainWindow):
         self.upgradeAllHostsButton.setEnabled(False)  # 禁用“连接全部”按钮
         self.overallProgressBar.setValue(0)
         self.reset_progress_bar_color()
-        self.total_tasks = self.upgradeTasksTable.rowCount()
-        self.upgrade_progresses = {row: 0 for row in range(self.total_tasks)}
-        self.upgrade_statuses = {row: "default" for row in range(self.total_tasks)}
-        for row in range(self.total_tasks):
-            self.upgrade_host(row)
+        tasks = self.task_model.tasks()
+        self.total_tasks = len(tasks)
+        self.upgrade_tasks(tasks)
 
+    def upgrade_tasks(self, tasks):
+        """
+        将指定的多个 HostTask 作为一次批量升级提交给升级引擎，由调度器控制并发和分波。
+        """
+        upgrade_file = self.upgradeFileEntry.text()
+        upgrade_script = self.upgradeScriptEntry.text()
+        self.start_run('rollout')
+        jobs = []
+        for task in tasks:
+            jobs.append((task.host, task.host, task.username, task.password))
+            self.task_model.reset_task(task, "Waiting")
+            self.running_tasks.add(task.host)
+        self.task_model.refresh_all()
+
+        self.rollout_running = True
+        self.rollout_summary = None
+        self.engine.submit_rollout(jobs, upgrade_file, upgrade_script, self.scheduler_config)
         self.set_all_buttons_enabled(False)
+        self.upgradeTasksTable.clearSelection()
 
-    def upgrade_host(self, row):
+    def upgrade_host(self, host):
         """
-        为指定的SSH配置创建并启动异步工作线程。
+        为指定的SSH配置提交升级任务到升级引擎。
         """
-        host = self.upgradeTasksTable.item(row, 0).text()
-        username = self.upgradeTasksTable.item(row, 1).text()
-        password = self.upgradeTasksTable.item(row, 2).text()
+        task = self.task_model.task(host)
         upgrade_file = self.upgradeFileEntry.text()
         upgrade_script = self.upgradeScriptEntry.text()
 
@@ -347,54 +387,50 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, "警告", "请选择升级文件和脚本。")
             return
 
-        self.upgradeTasksTable.setItem(row, 3, QTableWidgetItem("0%"))
-        self.upgradeTasksTable.setItem(row, 4, QTableWidgetItem(""))
-        self.upgrade_progresses[row] = 0
-        self.upgrade_statuses[row] = "0%"
-        self.update_gui_signal.emit(row, "0%", "")  # 显式触发GUI更新
+        self.task_model.reset_task(task, "0%")
+        self.update_gui_signal.emit(host, "0%", "")  # 显式触发GUI更新
 
-        ssh_manager = SSHManager(host, username, password)
-        upgrade_manager = UpgradeManager(ssh_manager)
-
-        worker = UpgradeWorker(upgrade_manager.execute_upgrade_async(upgrade_file, upgrade_script), row)
-        worker.finished.connect(self.on_worker_finished)
-        worker.progress.connect(self.on_worker_progress)
-        self.upgrade_workers.append(worker)
-        self.running_tasks.add(worker)
-        worker.start()
-
-        self.upgrade_progresses[row] = 0  # 初始化该任务的进度为0
+        self.start_run('single')
+        self.running_tasks.add(host)
+        self.engine.submit_upgrade(host, host, task.username, task.password, upgrade_file, upgrade_script)
         self.reset_progress_bar_color()
 
         # 禁用当前行的按钮
-        upgrade_button = self.upgradeTasksTable.cellWidget(row, 5)
-        upgrade_button.setEnabled(False)
-        upgrade_button.setStyleSheet("color: #a0a0a0;")
-        delete_button = self.upgradeTasksTable.cellWidget(row, 6)
-        delete_button.setEnabled(False)
-        delete_button.setStyleSheet("color: #a0a0a0;")
+        self.task_model.set_busy(host, True)
         # 取消选择表格中的单元格
-        self.upgradeTasksTable.setCurrentItem(None)
+        self.upgradeTasksTable.clearSelection()
         # 禁用“更新全部”按钮
         self.upgradeAllHostsButton.setEnabled(False)
 
     def check_upgrade_results(self):
         """
-        检查所有升级任务的结果，显示统计信息，如果有失败的任务且正在执行"升级全部"操作，弹出对话框询问是否重新升级。
+        检查所有升级任务的结果，显示统计信息，如果有失败或被跳过的任务，弹出对话框询问是否重新升级。
         """
-        if not self.is_upgrading_all:
-            return  # 如果不是"升级全部"操作，直接返回
-
-        total_tasks = len(self.upgrade_statuses)
-        successful_tasks = sum(1 for status in self.upgrade_statuses.values() if status == "Success")
-        failed_tasks = sum(1 for status in self.upgrade_statuses.values() if status == "Fail")
+        statuses = [task.status for task in self.task_model.tasks()]
+        total_tasks = len(statuses)
+        successful_tasks = statuses.count("Success")
+        failed_tasks = statuses.count("Fail")
+        skipped_tasks = statuses.count("Skipped")
 
         message = f"升级任务统计:\n" \
                   f"总任务数: {total_tasks}\n" \
                   f"成功数量: {successful_tasks}\n" \
-                  f"失败数量: {failed_tasks}\n\n"
-
-        if failed_tasks > 0:
+                  f"失败数量: {failed_tasks}\n"
+        if skipped_tasks > 0:
+            message += f"跳过数量: {skipped_tasks}\n"
+        if self.rollout_summary and self.rollout_summary.get('abort_reason'):
+            message += f"{self.rollout_summary['abort_reason']}\n"
+        metrics_summary = self.run_metrics.format_summary()
+        if metrics_summary:
+            message += f"\n{metrics_summary}\n"
+        failing_hosts = self.history.failing_hosts(self.FAILING_RUNS)
+        if failing_hosts:
+            names = ', '.join(host for host, _ in failing_hosts[:5])
+            more = f" 等 {len(failing_hosts)} 台" if len(failing_hosts) > 5 else ""
+            message += f"\n最近 {self.FAILING_RUNS} 次升级均失败的主机: {names}{more}\n"
+        message += "\n"
+
+        if failed_tasks > 0 or skipped_tasks > 0:
             message += "是否要重新升级失败的任务？"
             reply = QMessageBox.question(self, '升级结果', message,
                                          QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
@@ -407,111 +443,249 @@ class MainWindow(QMainWindow):
         """
         重新升级失败的任务。
         """
-        failed_tasks = [row for row, status in self.upgrade_statuses.items() if status == "Fail"]
-        for row in failed_tasks:
-            self.upgrade_host(row)
+        failed_tasks = [task for task in self.task_model.tasks() if task.status in ("Fail", "Skipped")]
+        self.is_upgrading_all = True
+        self.upgradeAllHostsButton.setEnabled(False)
+        self.reset_progress_bar_color()
+        self.upgrade_tasks(failed_tasks)
 
-    def on_worker_progress(self, row, progress):
+    def process_engine_events(self):
         """
-        处理异步工作线程的进度更新。
+        取出升级引擎队列中的事件并分发处理（在GUI线程中由定时器调用）。
+
+        每个事件只更新任务数据并记录受影响的主机，处理完本批事件后才统一重绘表格和总体进度，
+        表格和进度条每个刷新周期最多更新一次。
         """
-        if self.upgrade_statuses.get(row) != "Fail":
-            self.upgrade_progresses[row] = progress
-            self.update_gui_signal.emit(row, f"{progress}%", "")
+        events = self.engine.drain_events()
+        if not events:
+            return
+        for kind, host, payload in events:
+            if kind == 'cancel_finished':
+                self.on_cancel_finished(payload)
+            elif self.cancelling:
+                continue  # 被取消的任务在清理期间发出的事件
+            elif kind == 'progress':
+                self.on_task_progress(host, payload)
+            elif kind == 'log':
+                self.on_task_log(host, *payload)
+            elif kind == 'metrics':
+                self.run_metrics.add(payload)
+                self.pending_metrics[host] = payload
+            elif kind == 'finished':
+                self.on_task_finished(host, *payload)
+            elif kind == 'rollout_finished':
+                self.on_rollout_finished(payload)
+            elif kind == 'scan_result':
+                self.on_scan_result(host, payload)
+            elif kind == 'scan_finished':
+                self.on_scan_finished(payload)
+            elif kind == 'command_result':
+                self.on_command_result(host, payload)
+            elif kind == 'command_finished':
+                self.on_command_finished(payload)
+        self.flush_table_updates()
+
+    def flush_table_updates(self):
+        """
+        重绘自上次刷新以来发生变化的行，升级进行中时同时更新总体进度，并在一个事务中写入本批结束的主机的结果。
+        """
+        if self.pending_results:
+            self.history.record_results(self.run_id, self.pending_results)
+            self.pending_results = []
+        if self.dirty_hosts:
+            self.task_model.refresh_hosts(self.dirty_hosts)
+            self.dirty_hosts.clear()
         if not self.upgradeAllHostsButton.isEnabled():
             self.update_overall_progress()
-        # print(f"任务 {row} 进度: {progress}%")  # 调试输出
 
-    def on_worker_finished(self, row, status, message):
+    def on_task_progress(self, host, progress):
         """
-        处理异步工作线程的完成事件。
+        处理升级任务的进度更新。
         """
-        if status == "Fail":
-            self.upgrade_progresses[row] = 0
-        else:
-            self.upgrade_progresses[row] = 100
-        self.upgrade_statuses[row] = status
-        self.update_gui_signal.emit(row, status, message)
-        if not self.upgradeAllHostsButton.isEnabled():
-            self.update_overall_progress()
+        task = self.task_model.task(host)
+        if task is None:
+            return
+        if task.status != "Fail":
+            self.task_model.set_progress(task, progress)
+            task.status = f"{progress}%"
+            task.message = ""
+            self.dirty_hosts.add(host)
+        # print(f"任务 {host} 进度: {progress}%")  # 调试输出
+
+    def on_task_log(self, host, stream, line):
+        """
+        处理远程脚本的一行输出：存入该主机的环形缓冲区，Logs 列显示最新一行。
+        """
+        task = self.task_model.task(host)
+        if task is None:
+            return
+        line = line[:self.LOG_LINE_LENGTH]
+        task.logs.append(f'[stderr] {line}' if stream == 'stderr' else line)
+        self.dirty_hosts.add(host)
 
-        # print(f"任务 {row} 完成。状态: {status}")  # 调试输出
+    def on_task_finished(self, host, status, message):
+        """
+        处理升级任务的完成事件。
+        """
+        task = self.task_model.task(host)
+        if task is not None:
+            self.task_model.set_progress(task, 100 if status == "Success" else 0)
+            task.status = status
+            task.message = message
+            self.dirty_hosts.add(host)
 
-        for worker in list(self.running_tasks):
-            if worker.row == row:
-                self.running_tasks.remove(worker)
-                break
+            # print(f"任务 {host} 完成。状态: {status}")  # 调试输出
 
-        # 恢复当前行的按钮状态
-        upgrade_button = self.upgradeTasksTable.cellWidget(row, 5)
-        delete_button = self.upgradeTasksTable.cellWidget(row, 6)
-        if upgrade_button:
-            upgrade_button.setEnabled(True)
-            upgrade_button.setStyleSheet("color: #0067c0;")
-        if delete_button:
-            delete_button.setEnabled(True)
-            delete_button.setStyleSheet("color: #d32f2f;")
+            # 恢复当前行的按钮状态
+            self.task_model.set_busy(host, False)
+
+        self.pending_results.append((host, status, message, self.pending_metrics.pop(host, None)))
+        self.running_tasks.discard(host)
 
         # 检查是否没有正在执行的任务
+        if len(self.running_tasks) == 0 and not self.rollout_running:
+            self.on_all_tasks_finished()
+
+    def on_scan_result(self, host, result):
+        """
+        处理单个主机的可达性扫描结果。
+        """
+        task = self.task_model.task(host)
+        if task is not None:
+            task.status = "Reachable" if result.reachable else "Unreachable"
+            task.message = result.describe()
+            self.dirty_hosts.add(host)
+
+    def on_scan_finished(self, summary):
+        """
+        可达性扫描结束后恢复按钮状态并显示统计信息。
+        """
+        self.flush_table_updates()
+        self.set_all_buttons_enabled(True)
+        self.upgradeAllHostsButton.setEnabled(True)
+        QMessageBox.information(self, '扫描结果',
+                                f"可达性扫描统计:\n"
+                                f"总主机数: {summary['hosts']}\n"
+                                f"可达数量: {summary['reachable']}\n"
+                                f"不可达数量: {summary['hosts'] - summary['reachable']}\n")
+
+    def on_command_result(self, host, group):
+        """
+        处理批量命令中单个主机的结果，Logs 列显示该主机所在输出组的摘要。
+        """
+        task = self.task_model.task(host)
+        if task is not None:
+            task.command_status = "OK" if group.ok else "Error"
+            task.message = group.label
+            self.dirty_hosts.add(host)
+
+    def on_command_finished(self, groups):
+        """
+        批量命令结束后恢复按钮状态，并按输出分组显示结果，每组的完整输出在详细信息中。
+        """
+        self.flush_table_updates()
+        self.command_running = False
+        self.set_all_buttons_enabled(True)
+        self.upgradeAllHostsButton.setEnabled(True)
+        dialog = QMessageBox(QMessageBox.Information, '命令结果',
+                             f"命令: {self.last_command}\n"
+                             f"共 {len(groups)} 种不同的输出:\n\n{groups.format_summary()}", QMessageBox.Ok, self)
+        dialog.setDetailedText(groups.format_details())
+        dialog.exec_()
+
+    def on_rollout_finished(self, summary):
+        """
+        处理批量升级调度结束事件。
+        """
+        self.rollout_running = False
+        self.rollout_summary = summary
         if len(self.running_tasks) == 0:
-            QTimer.singleShot(0, lambda: self.upgradeAllHostsButton.setEnabled(True))
-            self.set_all_buttons_enabled(True)
-            self.check_and_update_progress_bar_color()
+            self.on_all_tasks_finished()
+
+    def on_cancel_finished(self, summary):
+        """
+        取消完成后恢复按钮。
+        """
+        self.cancelling = False
+        if summary['forced']:
+            print(f"Warning: {summary['forced']} upgrade(s) did not finish cleanup within the grace period.")
+        self.set_all_buttons_enabled(True)
+        self.upgradeAllHostsButton.setEnabled(True)
+
+    def on_all_tasks_finished(self):
+        """
+        所有任务结束后恢复按钮状态，如果是"升级全部"操作则显示统计信息。
+        """
+        self.flush_table_updates()  # 显示统计信息之前先刷新表格
+        QTimer.singleShot(0, lambda: self.upgradeAllHostsButton.setEnabled(True))
+        self.set_all_buttons_enabled(True)
+        self.check_and_update_progress_bar_color()
+        self.history.finish_run(self.run_id)
+        self.export_run_metrics()
+        is_upgrading_all = self.is_upgrading_all
+        self.is_upgrading_all = False
+        if is_upgrading_all:
             self.check_upgrade_results()
-            self.is_upgrading_all = False
 
-    def update_gui(self, row, status, message):
+    def start_run(self, kind):
         """
-        更新GUI中的表格项。
+        没有正在执行的任务时开始新一次升级（耗时统计和 history 中的记录）；升级过程中追加的单个主机计入当前升级。
         """
-        status_item = QTableWidgetItem(status)
-        message_item = QTableWidgetItem(message)
+        if not self.running_tasks:
+            self.run_metrics = RunMetrics()
+            self.pending_metrics.clear()
+            self.run_id = self.history.begin_run(kind, self.upgradeFileEntry.text(), self.upgradeScriptEntry.text())
 
-        if status == "Success":
-            status_item.setForeground(QColor("green"))
-            message_item.setForeground(QColor("green"))
-        elif status == "Fail":
-            status_item.setForeground(QColor("red"))
-            message_item.setForeground(QColor("red"))
-        elif status.endswith("%"):
-            status_item.setForeground(QColor("#05B8CC"))
-            message_item.setForeground(QColor("#05B8CC"))
+    def export_run_metrics(self):
+        """
+        升级结束后把各主机的阶段耗时追加到 METRICS_JSONL_FILE，并用本次统计覆盖 METRICS_PROM_FILE。
+        """
+        if not self.run_metrics.hosts:
+            return
+        try:
+            os.makedirs(self.LOG_DIR, exist_ok=True)
+            self.run_metrics.write_jsonl(self.METRICS_JSONL_FILE)
+            self.run_metrics.write_prometheus(self.METRICS_PROM_FILE)
+        except OSError as e:
+            print(f"Error exporting metrics: {e}")
 
-        self.upgradeTasksTable.setItem(row, 3, status_item)
-        self.upgradeTasksTable.setItem(row, 4, message_item)
+    def update_gui(self, host, status, message):
+        """
+        更新GUI中的表格项。
+        """
+        task = self.task_model.task(host)
+        if task is not None:
+            task.status = status
+            task.message = message
+            self.task_model.refresh(host)
 
     def set_all_buttons_enabled(self, enabled):
         """
         设置所有按钮的启用状态。
         """
-        for row in range(self.upgradeTasksTable.rowCount()):
-            upgrade_button = self.upgradeTasksTable.cellWidget(row, 5)
-            delete_button = self.upgradeTasksTable.cellWidget(row, 6)
-            if upgrade_button:
-                upgrade_button.setEnabled(enabled)
-                upgrade_button.setStyleSheet("color: #0067c0;" if enabled else "color: #a0a0a0;")
-            if delete_button:
-                delete_button.setEnabled(enabled)
-                delete_button.setStyleSheet("color: #d32f2f;" if enabled else "color: #a0a0a0;")
+        self.task_model.set_actions_enabled(enabled)
+        self.scanHostsButton.setEnabled(enabled)
+        self.runCommandButton.setEnabled(enabled)
 
     def update_overall_progress(self):
         """
-        更新总体进度。
+        更新总体进度（使用模型增量维护的进度总和，与任务数量无关）。
         """
         if self.total_tasks > 0:
-            overall_progress = int(sum(self.upgrade_progresses.values()) / self.total_tasks)
+            overall_progress = int(self.task_model.progress_total / self.total_tasks)
         else:
             overall_progress = 0
-        QTimer.singleShot(0, lambda: self.overallProgressBar.setValue(overall_progress))
+        self.overallProgressBar.setValue(overall_progress)
         # print(f"总体进度: {overall_progress}%")  # 调试输出
 
     def check_and_update_progress_bar_color(self):
         """
         检查并更新进度条颜色。
         """
-        if any(status == "Fail" for status in self.upgrade_statuses.values()):
+        statuses = [task.status for task in self.task_model.tasks()]
+        if "Fail" in statuses:
             self.set_progress_bar_color("rgba(255, 0, 0, 0.5)")  # 红色，50% 不透明度
-        elif all(status == "Success" for status in self.upgrade_statuses.values() if status):
+        elif all(status == "Success" for status in statuses):
             self.set_progress_bar_color("rgba(76, 175, 80, 0.5)")  # 绿色，50%
         else:
             self.set_progress_bar_color("rgba(5, 184, 204, 0.5)")  # 默认蓝色，50% 不透明度
@@ -548,23 +722,24 @@ class MainWindow(QMainWindow):
                                                    "CSV Files (*.csv);;All Files (*)")
         if file_path:
             try:
-                df = pd.read_csv(file_path)
-
-                # 检查必要的列是否存在
-                if not all(column in df.columns for column in ['Host', 'Username', 'Password']):
-                    raise ValueError("CSV文件缺少必要的列：'Host', 'Username', 'Password'")
-
-                self.upgradeTasksTable.setRowCount(0)  # 清空表格
-
-                for index, row in df.iterrows():
-                    self.add_upgrade_task_row(QTableWidgetItem(row['Host']),
-                                              QTableWidgetItem(row['Username']),
-                                              QTableWidgetItem(row['Password']))
+                with open(file_path, 'r', newline='', encoding='utf-8-sig') as f:
+                    reader = csv.DictReader(f)
+                    if not reader.fieldnames:
+                        raise EOFError
+
+                    # 检查必要的列是否存在
+                    if not all(column in reader.fieldnames for column in ['Host', 'Username', 'Password']):
+                        raise ValueError("CSV文件缺少必要的列：'Host', 'Username', 'Password'")
+
+                    # 逐行读取并替换表格中的任务，不在内存中构建完整的表格
+                    configs = (((row['Host'] or '').strip(), row['Username'] or '', row['Password'] or '')
+                               for row in reader)
+                    self.add_upgrade_task_rows(configs, replace=True)
                 self.update_task_count()
                 self.save_last_opened_dir(file_path)
-            except pd.errors.EmptyDataError:
+            except EOFError:
                 self.show_import_ssh_configs_error_message("CSV文件为空或格式不正确。请检查文件内容。")
-            except pd.errors.ParserError:
+            except (csv.Error, UnicodeDecodeError):
                 self.show_import_ssh_configs_error_message("CSV文件解析错误。请检查文件格式是否正确。")
             except ValueError as ve:
                 self.show_import_ssh_configs_error_message(str(ve))
@@ -594,20 +769,15 @@ class MainWindow(QMainWindow):
         file_path, _ = QFileDialog.getSaveFileName(self, "Save SSH Configs", initial_dir,
                                                    "CSV Files (*.csv);;All Files (*)")
         if file_path:
-            data = []
-            for row in range(self.upgradeTasksTable.rowCount()):
-                data.append({
-                    'Host': self.upgradeTasksTable.item(row, 0).text(),
-                    'Username': self.upgradeTasksTable.item(row, 1).text(),
-                    'Password': self.upgradeTasksTable.item(row, 2).text()
-                })
-            df = pd.DataFrame(data)
-            df.to_csv(file_path, index=False)
+            with open(file_path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(['Host', 'Username', 'Password'])
+                writer.writerows((task.host, task.username, task.password) for task in self.task_model.tasks())
             self.save_last_opened_dir(file_path)
 
     def save_config(self):
         """
-        保存配置到 config.json 文件。
+        保存配置到 config.json 文件（主机清单保存在 history 中，history 不可用时才写入配置文件）。
         """
         config = {
             'geometry': self.saveGeometry().toHex().data().decode(),
@@ -615,14 +785,6 @@ class MainWindow(QMainWindow):
             'upgrade_file': self.upgradeFileEntry.text(),
             'upgrade_script': self.upgradeScriptEntry.text(),
             'last_opened_dir': self.get_last_opened_dir() + '/',
-            'ssh_configs': [
-                {
-                    'Host': self.upgradeTasksTable.item(row, 0).text(),
-                    'Username': self.upgradeTasksTable.item(row, 1).text(),
-                    'Password': self.upgradeTasksTable.item(row, 2).text()
-                }
-                for row in range(self.upgradeTasksTable.rowCount())
-            ],
             'entries': {
                 'host': self.hostEntry.text(),
                 'username': self.usernameEntry.text(),
@@ -630,9 +792,28 @@ class MainWindow(QMainWindow):
             },
             'table_column_widths': {
                 str(i): self.upgradeTasksTable.columnWidth(i)
-                for i in range(self.upgradeTasksTable.columnCount())
-            }
+                for i in range(self.task_model.columnCount())
+            },
+            'scheduler': self.scheduler_config.to_dict(),
+            'transfer': self.engine.transfer_config.to_dict(),
+            'relay': self.engine.relay_config.to_dict(),
+            'scan': self.engine.scan_config.to_dict(),
+            'pool': self.engine.pool_config.to_dict(),
+            'retry': self.engine.retry_config.to_dict(),
+            'shards': self.engine.shard_config.to_dict(),
+            'cancel': self.engine.cancel_config.to_dict(),
+            'command': self.engine.command_config.to_dict(),
+            'stages': self.engine.stage_config.to_dict()
         }
+        if not self.history.enabled:
+            config['ssh_configs'] = [
+                {
+                    'Host': task.host,
+                    'Username': task.username,
+                    'Password': task.password
+                }
+                for task in self.task_model.tasks()
+            ]
         with open(self.CONFIG_FILE, 'w') as f:
             json.dump(config, f)
 
@@ -655,6 +836,16 @@ class MainWindow(QMainWindow):
                 last_opened_dir = config.get('last_opened_dir', '')
                 column_widths = config.get('table_column_widths', {})
                 ssh_configs = config.get('ssh_configs', [])
+                self.scheduler_config = SchedulerConfig.from_dict(config.get('scheduler'))
+                self.engine.transfer_config = TransferConfig.from_dict(config.get('transfer'))
+                self.engine.relay_config = RelayConfig.from_dict(config.get('relay'))
+                self.engine.scan_config = ScanConfig.from_dict(config.get('scan'))
+                self.engine.pool_config = PoolConfig.from_dict(config.get('pool'))
+                self.engine.retry_config = RetryConfig.from_dict(config.get('retry'))
+                self.engine.shard_config = ShardConfig.from_dict(config.get('shards'))
+                self.engine.cancel_config = CancelConfig.from_dict(config.get('cancel'))
+                self.engine.command_config = CommandConfig.from_dict(config.get('command'))
+                self.engine.stage_config = StageConfig.from_dict(config.get('stages'))
 
                 if geometry:
                     self.restoreGeometry(QByteArray.fromHex(geometry.encode()))
@@ -671,19 +862,30 @@ class MainWindow(QMainWindow):
                 for col, width in column_widths.items():
                     self.upgradeTasksTable.setColumnWidth(int(col), width)
 
-                for ssh_config in ssh_configs:
-                    self.add_upgrade_task_row(QTableWidgetItem(ssh_config.get('Host', '')),
-                                              QTableWidgetItem(ssh_config.get('Username', '')),
-                                              QTableWidgetItem(ssh_config.get('Password', '')))
-                self.update_task_count()
+                self.load_inventory(ssh_configs)
 
         except FileNotFoundError:
-            # 如果配置文件不存在，不执行任何操作
-            pass
+            # 如果配置文件不存在，只加载 history 中的主机清单
+            self.load_inventory([])
         except Exception as e:
             # 捕获并记录其他可能的异常
             print(f"Error loading configuration: {e}")
 
+    def load_inventory(self, ssh_configs):
+        """
+        从 history 加载主机清单；history 中还没有主机时，迁移旧版 config.json 中的 ssh_configs。
+        """
+        inventory = self.history.inventory()
+        if inventory:
+            self.task_model.add_tasks(inventory)
+        else:
+            self.add_upgrade_task_rows((ssh_config.get('Host', ''),
+                                        ssh_config.get('Username', ''),
+                                        ssh_config.get('Password', '')) for ssh_config in ssh_configs)
+            if ssh_configs and self.history.enabled:
+                self.save_config()  # 迁移后从配置文件中移除 ssh_configs
+        self.update_task_count()
+
     def get_last_opened_dir(self):
         """
         获取上次打开的文件夹路径。
@@ -708,10 +910,16 @@ class MainWindow(QMainWindow):
         处理窗口关闭事件，确保在关闭前保存配置。
         """
         self.save_config()
+        self.engine_timer.stop()
+        self.engine.stop()
+        self.history.close()
         event.accept()
 
 
 if __name__ == '__main__':
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()  # 打包后的程序启动分片工作进程时需要
     QApplication.setAttribute(Qt.AA_EnableHighDpiScaling)
     app = QApplication(sys.argv)
     main_window = MainWindow()
@@ -0,0 +1,196 @@
+import contextlib
+import json
+import math
+import os
+import time
+
+PHASES = ('ping', 'tcp_connect', 'handshake', 'upload', 'exec')  # 按执行顺序排列的升级阶段
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class HostMetrics:
+    """
+    单个主机一次升级的耗时统计。
+
+    各阶段的耗时使用 time.monotonic() 测量，单位为秒：
+    - ping: 可达性检查（使用有效期内的预扫描结果时接近 0）。
+    - tcp_connect: 建立 TCP 连接。
+    - handshake: SSH 握手和认证。
+    - upload: 校验远程文件、上传（包括压缩和远程解压）。
+    - exec: 授权、执行升级脚本和清理。
+
+    参数:
+    - host: 主机地址。
+    """
+
+    __slots__ = ('host', 'status', 'phases', 'bytes_uploaded', 'retries', 'reused', 'started_at', 'total',
+                 '_started')
+
+    def __init__(self, host):
+        self.host = host
+        self.status = ''
+        self.phases = {}  # 阶段 -> 耗时（秒），同一阶段执行多次时累加
+        self.bytes_uploaded = 0
+        self.retries = 0  # 失败后的重试次数（见 retry_policy）
+        self.reused = False  # 是否复用了连接池中的连接（此时没有 tcp_connect 和 handshake 阶段）
+        self.started_at = time.time()
+        self.total = None
+        self._started = time.monotonic()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        测量 with 语句块的耗时并计入阶段 name（块内抛出异常时同样计入）。
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - started)
+
+    def record(self, name, seconds):
+        """
+        将 seconds 秒计入阶段 name。
+        """
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def finish(self, status):
+        """
+        记录升级结果和总耗时。
+        """
+        self.status = status
+        self.total = time.monotonic() - self._started
+
+    def to_dict(self):
+        """
+        转换为可写入 JSON 的字典。
+        """
+        return {
+            'host': self.host,
+            'status': self.status,
+            'started_at': self.started_at,
+            'total': self.total,
+            'phases': {name: self.phases[name] for name in PHASES if name in self.phases},
+            'bytes_uploaded': self.bytes_uploaded,
+            'retries': self.retries,
+            'reused': self.reused,
+        }
+
+
+def percentile(sorted_values, quantile):
+    """
+    按最近秩法返回已排序序列的分位数，序列为空时返回 None。
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(quantile * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class RunMetrics:
+    """
+    一次批量升级中所有主机的耗时统计，可导出为 JSON Lines 和 Prometheus 文本格式。
+
+    参数:
+    - run_id: 本次升级的标识，默认使用开始时间。
+    """
+
+    def __init__(self, run_id=None):
+        self.run_id = run_id or time.strftime('%Y%m%dT%H%M%S')
+        self.hosts = []
+
+    def add(self, metrics):
+        """
+        添加一个主机的 HostMetrics。
+        """
+        self.hosts.append(metrics)
+
+    def summary(self):
+        """
+        返回每个阶段（以及总耗时 total）的统计：
+        {阶段: {'count': 主机数, 'sum': 耗时之和, 'p50': ..., 'p95': ..., 'p99': ...}}，没有数据的阶段不包含在内。
+        """
+        result = {}
+        for name in PHASES + ('total',):
+            if name == 'total':
+                values = sorted(m.total for m in self.hosts if m.total is not None)
+            else:
+                values = sorted(m.phases[name] for m in self.hosts if name in m.phases)
+            if values:
+                stats = {'count': len(values), 'sum': sum(values)}
+                for quantile in QUANTILES:
+                    stats[f'p{round(quantile * 100)}'] = percentile(values, quantile)
+                result[name] = stats
+        return result
+
+    def format_summary(self):
+        """
+        返回用于界面显示的多行统计文本，没有数据时返回空字符串。
+        """
+        summary = self.summary()
+        if not summary:
+            return ''
+        lines = ['阶段耗时 p50 / p95 / p99（秒）:']
+        for name, stats in summary.items():
+            lines.append(f"{name}: {stats['p50']:.2f} / {stats['p95']:.2f} / {stats['p99']:.2f}")
+        lines.append(f'上传字节数: {sum(m.bytes_uploaded for m in self.hosts)}')
+        reused = sum(1 for m in self.hosts if m.reused)
+        if reused:
+            lines.append(f'复用连接: {reused} / {len(self.hosts)}')
+        retries = sum(m.retries for m in self.hosts)
+        if retries:
+            lines.append(f'重试次数: {retries}')
+        return '\n'.join(lines)
+
+    def write_jsonl(self, path):
+        """
+        把每个主机的统计作为一行 JSON 追加写入 path。
+        """
+        with open(path, 'a', encoding='utf-8') as f:
+            for metrics in self.hosts:
+                f.write(json.dumps(dict(metrics.to_dict(), run=self.run_id), ensure_ascii=False) + '\n')
+
+    def prometheus_text(self):
+        """
+        返回 Prometheus 文本格式的统计：各阶段耗时分位数、各状态的主机数、上传字节数和重试次数。
+        """
+        lines = [
+            '# HELP sshtool_phase_duration_seconds Per-host duration of each upgrade phase in the last run.',
+            '# TYPE sshtool_phase_duration_seconds summary',
+        ]
+        for name, stats in self.summary().items():
+            for quantile in QUANTILES:
+                value = stats[f'p{round(quantile * 100)}']
+                lines.append(f'sshtool_phase_duration_seconds{{phase="{name}",quantile="{quantile:g}"}} {value:.6f}')
+            lines.append(f'sshtool_phase_duration_seconds_sum{{phase="{name}"}} {stats["sum"]:.6f}')
+            lines.append(f'sshtool_phase_duration_seconds_count{{phase="{name}"}} {stats["count"]}')
+
+        statuses = {}
+        for metrics in self.hosts:
+            statuses[metrics.status] = statuses.get(metrics.status, 0) + 1
+        lines += ['# HELP sshtool_hosts Hosts in the last run by final status.', '# TYPE sshtool_hosts gauge']
+        lines += [f'sshtool_hosts{{status="{status}"}} {count}' for status, count in sorted(statuses.items())]
+        lines += [
+            '# HELP sshtool_uploaded_bytes Bytes uploaded in the last run.',
+            '# TYPE sshtool_uploaded_bytes gauge',
+            f'sshtool_uploaded_bytes {sum(m.bytes_uploaded for m in self.hosts)}',
+            '# HELP sshtool_retries Upgrade retries after transient failures in the last run.',
+            '# TYPE sshtool_retries gauge',
+            f'sshtool_retries {sum(m.retries for m in self.hosts)}',
+            '# HELP sshtool_reused_connections Hosts in the last run that reused a pooled SSH connection.',
+            '# TYPE sshtool_reused_connections gauge',
+            f'sshtool_reused_connections {sum(1 for m in self.hosts if m.reused)}',
+            '# HELP sshtool_run_timestamp_seconds Start time of the last run.',
+            '# TYPE sshtool_run_timestamp_seconds gauge',
+            f'sshtool_run_timestamp_seconds {min((m.started_at for m in self.hosts), default=0):.3f}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        把 prometheus_text() 写入 path（先写临时文件再替换，供 node_exporter 的 textfile 收集器读取）。
+        """
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus_text())
+        os.replace(temp_path, path)
@@ -0,0 +1,174 @@
+import asyncio
+import time
+
+
+class ScanConfig:
+    """
+    可达性预扫描参数。
+
+    参数:
+    - port: 目标主机的 SSH 端口，可达性探测以及升级、批量命令和中继分发的 SSH 连接都使用该端口。
+    - timeout: 建立 TCP 连接和读取 SSH 版本标识的超时时间（秒）。
+    - concurrency: 同时探测的最大主机数量。
+    - ttl: 扫描结果的有效期（秒），有效期内升级引擎直接使用扫描结果，不再重复探测。
+    - exclude_unreachable: 批量升级时是否直接排除扫描结果为不可达的主机。
+    """
+
+    DEFAULTS = {
+        'port': 22,
+        'timeout': 1.0,
+        'concurrency': 256,
+        'ttl': 300.0,
+        'exclude_unreachable': True,
+    }
+
+    def __init__(self, **kwargs):
+        """
+        初始化ScanConfig实例，未指定的参数使用 DEFAULTS 中的默认值。
+        """
+        for name, default in self.DEFAULTS.items():
+            value = kwargs.get(name, default)
+            setattr(self, name, type(default)(value))
+        self.concurrency = max(1, self.concurrency)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        从配置字典创建实例，忽略未知的键。
+        """
+        return cls(**{name: value for name, value in (data or {}).items() if name in cls.DEFAULTS})
+
+    def to_dict(self):
+        """
+        转换为可写入 config.json 的字典。
+        """
+        return {name: getattr(self, name) for name in self.DEFAULTS}
+
+
+class ScanResult:
+    """
+    单个主机的探测结果。
+
+    参数:
+    - host/port: 探测的主机和端口。
+    - reachable: TCP 连接是否成功。
+    - latency: 建立 TCP 连接的耗时（秒），不可达时为 None。
+    - banner: 服务端发送的 SSH 版本标识（例如 "SSH-2.0-OpenSSH_8.9"），未读取到时为空字符串。
+    - error: 不可达的原因。
+    """
+
+    __slots__ = ('host', 'port', 'reachable', 'latency', 'banner', 'error', 'scanned_at')
+
+    def __init__(self, host, port, reachable, latency=None, banner='', error=''):
+        self.host = host
+        self.port = port
+        self.reachable = reachable
+        self.latency = latency
+        self.banner = banner
+        self.error = error
+        self.scanned_at = time.monotonic()
+
+    def describe(self):
+        """
+        返回用于界面显示的一行描述。
+        """
+        if not self.reachable:
+            return f'Port {self.port} unreachable: {self.error}'
+        return f'{self.banner or "No banner"} ({self.latency * 1000:.0f} ms)'
+
+
+class ReachabilityCache:
+    """
+    带有效期的扫描结果缓存，按主机保存最近一次探测结果。
+
+    参数:
+    - ttl: 结果的有效期（秒）。
+    """
+
+    def __init__(self, ttl=300.0):
+        self.ttl = ttl
+        self._results = {}
+
+    def get(self, host):
+        """
+        返回仍在有效期内的 ScanResult，不存在或已过期时返回 None。
+        """
+        result = self._results.get(host)
+        if result is None:
+            return None
+        if time.monotonic() - result.scanned_at > self.ttl:
+            del self._results[host]
+            return None
+        return result
+
+    def put(self, result):
+        """
+        保存探测结果。
+        """
+        self._results[result.host] = result
+
+    def clear(self):
+        """
+        清空所有结果。
+        """
+        self._results.clear()
+
+
+async def probe_host(host, port=22, timeout=1.0):
+    """
+    探测主机端口是否可达，并读取 SSH 服务端在连接建立后发送的版本标识。
+
+    返回:
+    - ScanResult。
+    """
+    started = time.monotonic()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=timeout)
+    except (asyncio.TimeoutError, OSError) as e:
+        return ScanResult(host, port, False, error=str(e) or type(e).__name__)
+    latency = time.monotonic() - started
+    banner = ''
+    try:
+        # 服务端可能先发送若干其他行，版本标识以 "SSH-" 开头
+        deadline = started + timeout
+        while not banner.startswith('SSH-'):
+            line = await asyncio.wait_for(reader.readline(), timeout=max(0.0, deadline - time.monotonic()))
+            if not line:
+                break
+            banner = line.decode('ascii', errors='replace').strip()
+    except (asyncio.TimeoutError, OSError, ValueError):
+        pass
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+    return ScanResult(host, port, True, latency, banner if banner.startswith('SSH-') else '')
+
+
+async def scan_hosts(hosts, config, cache=None, on_result=None):
+    """
+    以不超过 config.concurrency 的并发数探测所有主机。
+
+    参数:
+    - hosts: 主机地址列表。
+    - config: ScanConfig 实例。
+    - cache: 保存结果的 ReachabilityCache。
+    - on_result: 每个主机探测结束后调用的回调函数 on_result(result)。
+
+    返回:
+    - ScanResult 列表，顺序与 hosts 一致。
+    """
+    semaphore = asyncio.Semaphore(config.concurrency)
+
+    async def scan(host):
+        async with semaphore:
+            result = await probe_host(host, config.port, config.timeout)
+        if cache is not None:
+            cache.put(result)
+        if on_result:
+            on_result(result)
+        return result
+
+    return await asyncio.gather(*(scan(host) for host in hosts))
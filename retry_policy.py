@@ -0,0 +1,112 @@
+import asyncio
+import errno
+import random
+
+# 失败类型
+REFUSED = 'refused'  # 连接被拒绝、重置或在握手中断开
+TIMEOUT = 'timeout'  # 主机不可达或连接超时
+AUTH = 'auth'  # 认证失败
+UPLOAD = 'upload'  # 上传或远程解压出错
+SCRIPT = 'script'  # 升级脚本退出码非 0、有错误输出或执行中连接断开
+FAILURE_CLASSES = (REFUSED, TIMEOUT, AUTH, UPLOAD, SCRIPT)
+
+_TIMEOUT_ERRNOS = {errno.ETIMEDOUT, errno.EHOSTUNREACH, errno.ENETUNREACH}
+
+
+class RetryConfig:
+    """
+    升级失败后的重试参数，按失败类型分别设置。
+
+    每种失败类型 <类型> 有两个参数：
+    - <类型>_retries: 该类型失败的最大重试次数，0 表示不重试。
+    - <类型>_delay: 第一次重试前的等待时间（秒），之后每次翻倍，不超过 max_delay。
+
+    其他参数:
+    - max_delay: 两次尝试之间的最长等待时间（秒）。
+    - jitter: 随机缩短等待时间的比例（0 ~ 1），1 表示在 0 到计算值之间均匀随机，
+      避免大量主机在同一时刻重新连接。
+
+    认证失败和升级脚本失败默认不重试：前者重试通常无效，后者的脚本不一定可以重复执行。
+    """
+
+    DEFAULTS = {
+        'refused_retries': 3,
+        'refused_delay': 2.0,
+        'timeout_retries': 2,
+        'timeout_delay': 5.0,
+        'auth_retries': 0,
+        'auth_delay': 10.0,
+        'upload_retries': 3,
+        'upload_delay': 1.0,
+        'script_retries': 0,
+        'script_delay': 30.0,
+        'max_delay': 60.0,
+        'jitter': 0.5,
+    }
+
+    def __init__(self, **kwargs):
+        """
+        初始化RetryConfig实例，未指定的参数使用 DEFAULTS 中的默认值。
+        """
+        for name, default in self.DEFAULTS.items():
+            value = kwargs.get(name, default)
+            setattr(self, name, type(default)(value))
+        self.jitter = min(1.0, max(0.0, self.jitter))
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        从配置字典创建实例，忽略未知的键。
+        """
+        return cls(**{name: value for name, value in (data or {}).items() if name in cls.DEFAULTS})
+
+    def to_dict(self):
+        """
+        转换为可写入 config.json 的字典。
+        """
+        return {name: getattr(self, name) for name in self.DEFAULTS}
+
+    def retries(self, failure_class):
+        """
+        返回失败类型 failure_class 的最大重试次数，未知类型不重试。
+        """
+        if failure_class not in FAILURE_CLASSES:
+            return 0
+        return max(0, getattr(self, f'{failure_class}_retries'))
+
+    def delay(self, failure_class, attempt, rng=random):
+        """
+        返回该类型第 attempt 次重试（从 0 开始）前的等待时间（秒），按指数退避并加入随机抖动。
+        """
+        delay = min(self.max_delay, getattr(self, f'{failure_class}_delay') * 2 ** attempt)
+        return delay * (1 - self.jitter * rng.random())
+
+
+class UpgradeError(Exception):
+    """
+    升级失败，附带失败类型和失败时所在的阶段。
+
+    参数:
+    - message: 错误消息，即界面中显示的内容。
+    - failure_class: FAILURE_CLASSES 中的失败类型，为空时表示不可重试的错误。
+    - phase: 失败时所在的阶段（metrics.PHASES 中的 ping、tcp_connect、upload 或 exec）。
+    """
+
+    def __init__(self, message, failure_class=None, phase=None):
+        super().__init__(message)
+        self.failure_class = failure_class
+        self.phase = phase
+
+
+def classify_connect_error(exc):
+    """
+    按 SSH 连接失败的原始异常返回失败类型（TIMEOUT、AUTH 或 REFUSED）。
+    """
+    import asyncssh  # 延迟导入：只有建立过连接才会出现连接错误，此时 asyncssh 已经加载
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError)):
+        return TIMEOUT
+    if isinstance(exc, OSError) and exc.errno in _TIMEOUT_ERRNOS:
+        return TIMEOUT
+    if isinstance(exc, asyncssh.PermissionDenied):
+        return AUTH
+    return REFUSED
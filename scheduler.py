@@ -0,0 +1,168 @@
+import asyncio
+
+from concurrency import HostSlot, create_limiter
+
+
+class SchedulerConfig:
+    """
+    批量升级调度参数。
+
+    参数:
+    - max_in_flight: 同时连接和上传的最大主机数量，主机开始执行升级脚本后让出名额（见 concurrency.HostSlot）。
+    - wave_size: 每一波的主机数量，0 表示剩余主机作为一波。
+    - canary_size: 金丝雀波的主机数量，金丝雀波全部成功后才会继续，0 表示不使用金丝雀波。
+    - abort_failure_rate: 失败率超过该值时中止后续调度（0~1），1 表示从不中止。
+    - abort_min_results: 计算失败率前至少需要完成的主机数量。
+    - adaptive: 是否根据连接延迟和错误自动调整并发数（AIMD），此时 max_in_flight 为上限。
+    - initial_in_flight/min_in_flight: 自适应模式下的初始并发数和最小并发数。
+    - latency_tolerance: 自适应模式下，连接延迟超过基线多少倍视为拥塞。
+    """
+
+    DEFAULTS = {
+        'max_in_flight': 20,
+        'wave_size': 0,
+        'canary_size': 1,
+        'abort_failure_rate': 0.5,
+        'abort_min_results': 5,
+        'adaptive': False,
+        'initial_in_flight': 4,
+        'min_in_flight': 1,
+        'latency_tolerance': 2.0,
+    }
+
+    def __init__(self, **kwargs):
+        """
+        初始化SchedulerConfig实例，未指定的参数使用 DEFAULTS 中的默认值。
+        """
+        for name, default in self.DEFAULTS.items():
+            value = kwargs.get(name, default)
+            setattr(self, name, type(default)(value))
+        self.max_in_flight = max(1, self.max_in_flight)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        从配置字典创建实例，忽略未知的键。
+        """
+        return cls(**{name: value for name, value in (data or {}).items() if name in cls.DEFAULTS})
+
+    def to_dict(self):
+        """
+        转换为可写入 config.json 的字典。
+        """
+        return {name: getattr(self, name) for name in self.DEFAULTS}
+
+
+class RolloutScheduler:
+    """
+    有界并发的滚动升级调度器。
+
+    按 金丝雀波 -> 若干滚动波 的顺序执行主机升级，每一波内同时连接和上传的主机数不超过
+    max_in_flight；金丝雀波出现失败或整体失败率超过阈值时，不再调度剩余主机。
+
+    参数:
+    - config: SchedulerConfig 实例。
+    - run_host: 协程函数 run_host(job, slot)，返回 (状态, 消息)，状态为 "Success" 表示成功。
+      slot 是该主机占用的 HostSlot，可以在结束前调用 slot.transferred() 提前让出名额。
+    - on_skipped: 回调函数 on_skipped(job, reason)，用于通知未被调度的主机。
+    - limiter: 并发限制器，默认根据 config 创建（见 concurrency.create_limiter）。
+    - before_wave: 协程函数 before_wave(wave)，在每一波开始前调用（被跳过的波不调用），例如向这一波的主机中继分发。
+    """
+
+    def __init__(self, config, run_host, on_skipped=None, limiter=None, before_wave=None):
+        self.config = config
+        self.run_host = run_host
+        self.on_skipped = on_skipped
+        self.before_wave = before_wave
+        self.limiter = limiter or create_limiter(config)
+        self.succeeded = 0
+        self.failed = 0
+        self.abort_reason = None
+
+    def plan_waves(self, jobs):
+        """
+        将主机列表划分为金丝雀波和滚动波。
+
+        返回:
+        - 波列表，每一波是一个主机列表；若使用金丝雀波，则它是第一波。
+        """
+        jobs = list(jobs)
+        waves = []
+        canary_size = min(self.config.canary_size, len(jobs))
+        if canary_size > 0 and canary_size < len(jobs):
+            waves.append(jobs[:canary_size])
+            jobs = jobs[canary_size:]
+        wave_size = self.config.wave_size if self.config.wave_size > 0 else len(jobs)
+        for start in range(0, len(jobs), max(1, wave_size)):
+            waves.append(jobs[start:start + wave_size])
+        return waves
+
+    def failure_rate(self):
+        """
+        当前已完成主机的失败率。
+        """
+        completed = self.succeeded + self.failed
+        return self.failed / completed if completed else 0.0
+
+    def stop(self, reason):
+        """
+        停止调度：尚未开始的主机都被跳过，已经开始的主机不受影响。
+        """
+        if self.abort_reason is None:
+            self.abort_reason = reason
+
+    def _check_abort(self):
+        completed = self.succeeded + self.failed
+        if (self.abort_reason is None and completed >= self.config.abort_min_results
+                and self.failure_rate() > self.config.abort_failure_rate):
+            self.abort_reason = (f'Rollout aborted: failure rate {self.failure_rate():.0%} '
+                                 f'exceeds {self.config.abort_failure_rate:.0%}')
+
+    async def _run_one(self, job):
+        await self.limiter.acquire()
+        slot = HostSlot(self.limiter)
+        try:
+            if self.abort_reason is not None:
+                self._skip(job)
+                return
+            status, _ = await self.run_host(job, slot)
+        finally:
+            slot.release()
+        if status == "Success":
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        self._check_abort()
+
+    def _skip(self, job):
+        if self.on_skipped:
+            self.on_skipped(job, self.abort_reason)
+
+    async def run(self, jobs):
+        """
+        执行调度。
+
+        返回:
+        - 字典，包含 succeeded、failed、skipped 数量和 abort_reason。
+        """
+        jobs = list(jobs)
+        waves = self.plan_waves(jobs)
+        has_canary = 0 < self.config.canary_size < len(jobs)
+        for index, wave in enumerate(waves):
+            if self.abort_reason is not None:
+                for job in wave:
+                    self._skip(job)
+                continue
+            if self.before_wave is not None:
+                await self.before_wave(wave)
+            failed_before = self.failed
+            await asyncio.gather(*(self._run_one(job) for job in wave))
+            if has_canary and index == 0 and self.failed > failed_before:
+                self.abort_reason = 'Rollout aborted: canary wave failed'
+        skipped = len(jobs) - self.succeeded - self.failed
+        return {
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'skipped': skipped,
+            'abort_reason': self.abort_reason,
+        }
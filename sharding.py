@@ -0,0 +1,361 @@
+import asyncio
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import signal
+import threading
+import zlib
+
+from artifact import ArtifactStore
+
+FLUSH_INTERVAL = 0.02  # 工作进程合并发送事件的间隔（秒）
+REPLY_KINDS = ('result', 'observe', 'transferred', 'ack')  # 工作进程发回的应答，其他类型都是引擎事件
+
+
+class ShardConfig:
+    """
+    多进程分片参数。
+
+    参数:
+    - processes: 执行升级的工作进程数量。1 表示在引擎线程中直接执行（不使用工作进程），
+      0 表示使用与 CPU 核数相同的工作进程。
+    """
+
+    DEFAULTS = {
+        'processes': 1,
+    }
+
+    def __init__(self, **kwargs):
+        """
+        初始化ShardConfig实例，未指定的参数使用 DEFAULTS 中的默认值。
+        """
+        for name, default in self.DEFAULTS.items():
+            value = kwargs.get(name, default)
+            setattr(self, name, type(default)(value))
+        self.processes = max(0, self.processes)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        从配置字典创建实例，忽略未知的键。
+        """
+        return cls(**{name: value for name, value in (data or {}).items() if name in cls.DEFAULTS})
+
+    def to_dict(self):
+        """
+        转换为可写入 config.json 的字典。
+        """
+        return {name: getattr(self, name) for name in self.DEFAULTS}
+
+    def worker_count(self):
+        """
+        返回实际使用的工作进程数量，1 表示不使用工作进程。
+        """
+        return self.processes or os.cpu_count() or 1
+
+
+def shard_index(host, shards):
+    """
+    返回主机所属的分片，同一主机总是分配到同一个工作进程，以便复用该进程连接池中的连接。
+    """
+    return zlib.crc32(host.encode('utf-8')) % shards
+
+
+class _Worker:
+    def __init__(self, context, index):
+        parent_conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), name=f'UpgradeShard-{index}',
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.settings = None  # 最近一次发送给该进程的引擎参数
+        self.alive = True
+
+
+class ShardPool:
+    """
+    把单个主机的升级分配给多个工作进程执行，每个工作进程运行自己的 UpgradeEngine 事件循环。
+
+    SSH 握手、认证和上传的加密都是 CPU 密集的，单个事件循环最多使用一个核；分片后这些计算分摊到
+    所有工作进程。调度（分波、并发限制和中止条件）、中继分发和可达性扫描仍在主进程的引擎中进行，
+    只有 run_upgrade 被转发到按主机地址选择的工作进程。
+
+    工作进程每 FLUSH_INTERVAL 秒把引擎事件合并为一个列表发回（同一主机连续的进度事件只保留最后一个），
+    主进程的读取线程按原顺序把事件放入 events，因此调用方看到的事件与单进程时相同。
+    ShardPool 的方法只能在主进程引擎的事件循环中调用。
+
+    参数:
+    - processes: 工作进程数量。
+    - events: 接收转发事件的 queue.Queue（即 UpgradeEngine.events）。
+    """
+
+    def __init__(self, processes, events):
+        self.events = events
+        self._loop = asyncio.get_running_loop()
+        self._context = multiprocessing.get_context('spawn')  # 主进程中有事件循环线程和 Qt，不能使用 fork
+        self._workers = [_Worker(self._context, index) for index in range(processes)]
+        self._pending = {}  # 请求 id -> (Future, key, (observe, transferred), 工作进程)，Future 只在事件循环中访问
+        self._ids = itertools.count()
+        self._reader = threading.Thread(target=self._read, name='ShardReader', daemon=True)
+        self._reader.start()
+
+    def __len__(self):
+        return len(self._workers)
+
+    async def run_upgrade(self, job, settings, scan_result=None, batch=None, observe=None, transferred=None):
+        """
+        在主机所属的工作进程中执行升级。
+
+        参数:
+        - job: (key, host, username, password, file_path, script_path)。
+        - settings: 引擎参数字典，与上次发送给该进程的不同时先发送一次。
+        - scan_result: 主进程中有效期内的 ScanResult，工作进程据此跳过可达性探测。
+        - batch: 批量升级的标识，同一批次的主机在工作进程中共享 ArtifactStore，为空时单独打开文件。
+        - observe: 每次连接尝试后调用的 observe(started_at, latency, congested, reused)，用于自适应并发。
+        - transferred: 工作进程中的升级上传结束、开始执行脚本时调用的 transferred()（见 concurrency.HostSlot）。
+
+        返回:
+        - (状态, 消息)
+        """
+        index = shard_index(job[1], len(self._workers))
+        worker = self._workers[index]
+        if not worker.alive:
+            worker = self._workers[index] = _Worker(self._context, index)
+            if not self._reader.is_alive():
+                self._reader = threading.Thread(target=self._read, name='ShardReader', daemon=True)
+                self._reader.start()
+        if worker.settings != settings:
+            worker.conn.send(('configure', settings))
+            worker.settings = settings
+        request_id = next(self._ids)
+        future = self._loop.create_future()
+        self._pending[request_id] = (future, job[0], (observe, transferred), worker)
+        worker.conn.send(('upgrade', request_id, job, scan_result, batch, observe is not None))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if worker.alive:
+                worker.conn.send(('cancel', request_id))
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+
+    def release(self, batch):
+        """
+        通知工作进程关闭批次 batch 共享的文件。
+        """
+        for worker in self._workers:
+            if worker.alive:
+                worker.conn.send(('release', batch))
+
+    async def cancel_all(self, timeout=5):
+        """
+        取消所有工作进程中的升级，并等待它们确认；确认之前发出的事件都已放入 events。
+        """
+        acks = []
+        for worker in self._workers:
+            if worker.alive:
+                request_id = next(self._ids)
+                future = self._loop.create_future()
+                self._pending[request_id] = (future, None, (None, None), worker)
+                worker.conn.send(('cancel_all', request_id))
+                acks.append((request_id, future))
+        try:
+            await asyncio.wait_for(asyncio.gather(*(future for _, future in acks)), timeout)
+        finally:
+            for request_id, _ in acks:
+                self._pending.pop(request_id, None)
+
+    def close(self, timeout=5):
+        """
+        停止所有工作进程（可以在主进程引擎的事件循环停止后调用）。
+        """
+        for worker in self._workers:
+            if worker.alive:
+                worker.alive = False
+                try:
+                    worker.conn.send(('stop',))
+                except OSError:
+                    pass
+        for worker in self._workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join(timeout)
+            worker.conn.close()
+        self._reader.join(timeout)
+
+    def _read(self):
+        """
+        读取线程：接收所有工作进程发回的消息，直到全部工作进程退出。
+        """
+        while True:
+            conns = {worker.conn: worker for worker in self._workers if worker.alive}
+            if not conns:
+                return
+            for conn in multiprocessing.connection.wait(list(conns), timeout=1.0):
+                worker = conns[conn]
+                try:
+                    messages = conn.recv()
+                except (EOFError, OSError):
+                    if worker.alive:
+                        worker.alive = False
+                        self._call_soon(self._worker_exited, worker)
+                    continue
+                for message in messages:
+                    if message[0] in REPLY_KINDS:
+                        self._call_soon(self._reply, *message)
+                    else:
+                        self.events.put(message)
+
+    def _call_soon(self, callback, *args):
+        try:
+            self._loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            pass  # 主进程引擎已经停止
+
+    def _reply(self, kind, request_id, payload):
+        pending = self._pending.get(request_id)
+        if pending is None:
+            return
+        future, _, (observe, transferred), _ = pending
+        if kind == 'observe':
+            if observe is not None:
+                observe(*payload)
+        elif kind == 'transferred':
+            if transferred is not None:
+                transferred()
+        elif not future.done():
+            future.set_result(payload)
+
+    def _worker_exited(self, worker):
+        """
+        工作进程意外退出时，把分配给它的升级标记为失败。
+        """
+        for future, key, _, owner in list(self._pending.values()):
+            if owner is worker and not future.done():
+                outcome = ("Fail", f'Upgrade worker {worker.process.name} exited unexpectedly.')
+                if key is not None:
+                    self.events.put(('finished', key, outcome))
+                future.set_result(outcome)
+
+
+def _worker_main(conn):
+    """
+    工作进程入口：在本进程的 UpgradeEngine 中执行主进程转发的升级，并把事件和结果发回。
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # 由主进程决定何时停止
+    from upgrade_engine import UpgradeEngine
+    engine = UpgradeEngine()
+    engine.start()
+    replies = queue.Queue()  # 在引擎线程中产生的应答
+    keys = {}  # 请求 id -> 升级的 key
+    stores = {}  # 批次 -> ArtifactStore
+    running = True
+    try:
+        while running:
+            try:
+                if conn.poll(FLUSH_INTERVAL):
+                    while running and conn.poll():
+                        running = _handle_command(conn.recv(), engine, replies, keys, stores)
+            except (EOFError, OSError):
+                running = False  # 主进程已退出
+            try:
+                _flush(conn, engine, replies)
+            except OSError:
+                running = False
+    finally:
+        engine.stop()
+        for store in stores.values():
+            store.close()
+
+
+def _handle_command(message, engine, replies, keys, stores):
+    """
+    处理主进程的一条命令，返回是否继续运行。
+    """
+    command = message[0]
+    if command == 'configure':
+        engine.configure(message[1])
+    elif command == 'upgrade':
+        _, request_id, job, scan_result, batch, observe = message
+        if scan_result is not None:
+            engine.reachability_cache.put(scan_result)
+        store = None
+        if batch is not None:
+            store = stores.get(batch)
+            if store is None:
+                store = stores[batch] = ArtifactStore()
+        limiter = _ObservationForwarder(request_id, replies) if observe else None
+        future = engine.submit(engine._start_upgrade(*job, limiter, store))
+        keys[request_id] = job[0]
+        future.add_done_callback(lambda f: _on_done(request_id, f, replies, keys))
+    elif command == 'cancel':
+        key = keys.get(message[1])
+        if key is not None:
+            # 与升级经过同一个事件循环队列，升级尚未开始时也能找到对应的 Task
+            engine.cancel_upgrade(key)
+    elif command == 'cancel_all':
+        engine.cancel_all()
+        replies.put(('ack', message[1], None))
+    elif command == 'release':
+        store = stores.pop(message[1], None)
+        if store is not None:
+            store.close()
+    elif command == 'stop':
+        return False
+    return True
+
+
+def _on_done(request_id, future, replies, keys):
+    keys.pop(request_id, None)
+    if future.cancelled():
+        return
+    exc = future.exception()
+    replies.put(('result', request_id, ("Fail", str(exc)) if exc is not None else future.result()))
+
+
+def _flush(conn, engine, replies):
+    """
+    把应答和引擎事件合并为一条消息发回主进程。
+
+    先取出应答再取出事件：应答产生之前，对应主机的事件已经在事件队列中，因此事件总是先于应答到达。
+    """
+    pending_replies = []
+    while True:
+        try:
+            pending_replies.append(replies.get_nowait())
+        except queue.Empty:
+            break
+    messages = []
+    last = {}  # key -> 该主机最近一个事件在 messages 中的位置
+    for event in engine.drain_events():
+        kind, key, _ = event
+        index = last.get(key)
+        if kind == 'progress' and index is not None and messages[index][0] == 'progress':
+            messages[index] = event
+            continue
+        last[key] = len(messages)
+        messages.append(event)
+    messages += pending_replies
+    if messages:
+        conn.send(messages)
+
+
+class _ObservationForwarder:
+    """
+    在工作进程中代替主进程的 HostSlot，把连接观测值和上传结束的通知转发给主进程。
+    """
+
+    def __init__(self, request_id, replies):
+        self.request_id = request_id
+        self.replies = replies
+
+    def observe(self, started_at, latency=None, congested=False, reused=False):
+        self.replies.put(('observe', self.request_id, (started_at, latency, congested, reused)))
+
+    def transferred(self):
+        self.replies.put(('transferred', self.request_id, None))
@@ -1,7 +1,20 @@
 import asyncio
+import time
 import asyncssh
 
 
+class _ConnectTimer(asyncssh.SSHClient):
+    """
+    记录 TCP 连接建立的时刻，用于区分 TCP 连接和 SSH 握手、认证的耗时。
+    """
+
+    def __init__(self):
+        self.connected_at = None
+
+    def connection_made(self, conn):
+        self.connected_at = time.monotonic()
+
+
 class SSHManager:
     """
     该类用于建立SSH连接，并执行远程命令。
@@ -10,22 +23,39 @@ class SSHManager:
     - host: 远程主机的地址。
     - username: 远程主机的登录用户名。
     - password: 远程主机的登录密码。
+    - connect_timeout: 建立连接（TCP 连接、握手和认证）的超时时间，单位为秒。
+    - connect_observer: 每次连接尝试结束后（包括复用连接池中的连接）调用的回调函数 connect_observer(ssh_manager)。
+    - metrics: 记录连接阶段耗时、重试次数和上传字节数的 HostMetrics，为空时不记录。
+    - port: 远程主机的 SSH 端口。
+    - pool: ConnectionPool，连接时优先复用池中已认证的连接，关闭时把连接放回池中，为空时不复用。
+    - upload_limiter: 多个主机共享的上传限速器（concurrency.TokenBucket），为空时不限速。
     """
 
-    def __init__(self, host, username, password):
+    def __init__(self, host, username, password, connect_timeout=30, connect_observer=None, metrics=None,
+                 port=22, pool=None, upload_limiter=None):
         """
         初始化SSHManager实例。
 
         设置远程主机地址、用户名和密码。
         """
         self.host = host
+        self.port = port
         self.username = username
         self.password = password
+        self.connect_timeout = connect_timeout
+        self.connect_observer = connect_observer
+        self.metrics = metrics
+        self.pool = pool
+        self.upload_limiter = upload_limiter
         self.client = None
+        self.connect_started = None  # 最近一次连接开始的 time.monotonic() 时间
+        self.connect_latency = None  # 最近一次成功连接的耗时（秒）
+        self.connect_error = None  # 最近一次连接失败的原始异常
+        self.reused = False  # 最近一次连接是否复用了连接池中的连接
 
-    async def ping_host(self):
+    async def ping_host(self, port=22, timeout=1):
         try:
-            _, writer = await asyncio.wait_for(asyncio.open_connection(self.host, 22), timeout=1)
+            _, writer = await asyncio.wait_for(asyncio.open_connection(self.host, port), timeout=timeout)
             writer.close()
             await writer.wait_closed()
             return True
@@ -38,25 +68,73 @@ class SSHManager:
         异步建立SSH连接。
 
         创建SSHClient实例，并使用提供的凭证连接到远程主机。
+        连接池中有该主机可用的空闲连接时直接复用，跳过 TCP 连接、握手和认证。
+        连接失败时只尝试一次，原始异常保存在 connect_error 中，由调用方按失败类型决定是否重试
+        （见 retry_policy）。
         """
-        max_retries = 1
-        retry_delay = 1
-
-        for attempt in range(max_retries):
-            try:
-                self.client = await asyncssh.connect(
-                    self.host,
-                    username=self.username,
-                    password=self.password,
-                    known_hosts=None
-                )
+        self.reused = False
+        if self.pool is not None:
+            self.client = await self.pool.acquire(self.pool_key)
+            if self.client is not None:
+                self.reused = True
+                if self.metrics is not None:
+                    self.metrics.reused = True
+                # 复用的连接同样通知观察者，否则连接池命中时自适应并发得不到样本，上限无法增加
+                self.connect_started = time.monotonic()
+                self.connect_latency = None
+                self.connect_error = None
+                self._notify_connect_observer()
                 return
-            except (asyncssh.Error, OSError) as exc:
-                # print(f'SSH connection failed (attempt {attempt + 1}): {exc}')
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(retry_delay)
-                else:
-                    raise Exception(f'Failed to connect after {max_retries} attempts: {exc}')
+        # 放入连接池的连接需要保活，连续 3 次没有响应时由 asyncssh 关闭
+        keepalive_interval = self.pool.config.keepalive_interval if self.pool is not None else 0
+
+        self.connect_started = time.monotonic()
+        self.connect_latency = None
+        self.connect_error = None
+        timer = _ConnectTimer()
+        try:
+            self.client = await asyncssh.connect(
+                self.host,
+                port=self.port,
+                username=self.username,
+                password=self.password,
+                known_hosts=None,
+                connect_timeout=self.connect_timeout,
+                client_factory=lambda: timer,
+                keepalive_interval=keepalive_interval,
+                keepalive_count_max=3
+            )
+            self.connect_latency = time.monotonic() - self.connect_started
+            self._record_connect_phases(timer)
+            self._notify_connect_observer()
+        except (asyncssh.Error, OSError, asyncio.TimeoutError) as exc:
+            self.connect_error = exc
+            self._record_connect_phases(timer)
+            self._notify_connect_observer()
+            raise Exception(f'Failed to connect: {exc or type(exc).__name__}')
+
+    @property
+    def pool_key(self):
+        """
+        连接池中区分连接的键，登录信息不同的连接不会被复用。
+        """
+        return self.host, self.port, self.username, self.password
+
+    def _record_connect_phases(self, timer):
+        """
+        把本次连接尝试的耗时按 TCP 连接建立的时刻拆分为 tcp_connect 和 handshake 两个阶段。
+        """
+        if self.metrics is None:
+            return
+        now = time.monotonic()
+        connected_at = timer.connected_at or now
+        self.metrics.record('tcp_connect', connected_at - self.connect_started)
+        if timer.connected_at is not None:
+            self.metrics.record('handshake', now - connected_at)
+
+    def _notify_connect_observer(self):
+        if self.connect_observer:
+            self.connect_observer(self)
 
     async def execute_command_async(self, command):
         """
@@ -80,28 +158,152 @@ class SSHManager:
             # print(error_msg)
             return '', error_msg
 
-    async def upload_file_async(self, local_path, remote_path):
+    async def stream_command_async(self, command, line_handler, max_line_length=65536):
         """
-        异步上传文件到远程主机。
+        异步执行远程命令，并在输出产生时逐行回调，不在内存中保留完整输出。
 
         参数:
-        - local_path: 本地文件路径。
-        - remote_path: 远程文件路径。
+        - command: 待执行的远程命令。
+        - line_handler: 回调函数 line_handler(stream, line)，stream 为 'stdout' 或 'stderr'，line 不含换行符。
+        - max_line_length: 单行最大长度，超过时按该长度截断为多行回调。
+
+        返回:
+        - 远程命令的退出码，被信号终止时为 -1。
         """
         if self.client is None:
             raise Exception('SSH client is not connected. Please call connect_async first.')
 
+        async def pump(reader, stream):
+            pending = ''
+            while True:
+                data = await reader.read(max_line_length)
+                if not data:
+                    break
+                lines = (pending + data).split('\n')
+                pending = lines.pop()
+                for line in lines:
+                    line_handler(stream, line.rstrip('\r'))
+                while len(pending) >= max_line_length:
+                    line_handler(stream, pending[:max_line_length])
+                    pending = pending[max_line_length:]
+            if pending:
+                line_handler(stream, pending.rstrip('\r'))
+
         try:
-            await asyncssh.scp(local_path, (self.client, remote_path))
-            # print(f'File {local_path} uploaded to {remote_path} successfully.')
+            async with self.client.create_process(command, errors='replace') as process:
+                await asyncio.gather(pump(process.stdout, 'stdout'), pump(process.stderr, 'stderr'))
+                await process.wait()
+                return process.exit_status if process.exit_status is not None else -1
         except (asyncssh.Error, OSError) as exc:
-            # print(f'Failed to upload file: {exc}')
+            raise Exception(f'Failed to execute command: {exc}')
+
+    async def upload_artifacts_async(self, artifacts, block_size=65536, max_requests=64, progress_handler=None):
+        """
+        通过同一个SFTP会话，把内存映射的本地文件直接写入远程文件。
+
+        每个文件按 block_size 切成 memoryview 分块，最多 max_requests 个写请求并行在途，
+        不再逐主机重新打开和读取本地文件。起始偏移量大于 0 时保留远程文件已有的前缀（断点续传）。
+
+        参数:
+        - artifacts: (Artifact, 远程文件路径, 起始偏移量) 列表。
+        - block_size: 每个写请求的块大小（字节）。
+        - max_requests: 同时在途的最大写请求数量。
+        - progress_handler: 回调函数 progress_handler(已传输字节数, 总字节数)。
+
+        返回:
+        - 上传的总字节数。
+        """
+        if self.client is None:
+            raise Exception('SSH client is not connected. Please call connect_async first.')
+
+        total_bytes = sum(artifact.size - offset for artifact, _, offset in artifacts)
+        transferred = [0]
+
+        def on_block(length):
+            transferred[0] += length
+            if self.metrics is not None:
+                self.metrics.bytes_uploaded += length
+            if progress_handler:
+                progress_handler(transferred[0], total_bytes)
+
+        async with self.client.start_sftp_client() as sftp:
+            for artifact, remote_path, offset in artifacts:
+                async with sftp.open(remote_path, 'r+b' if offset else 'wb') as remote_file:
+                    await self._write_pipelined(remote_file, artifact, range(offset, artifact.size, block_size),
+                                                block_size, max_requests, on_block, self.upload_limiter)
+                    if offset:
+                        await remote_file.truncate(artifact.size)
+        return total_bytes
+
+    async def write_blocks_async(self, artifact, remote_path, offsets, block_size=65536, max_requests=64,
+                                 progress_handler=None):
+        """
+        通过SFTP把 artifact 中从 offsets 开始、各 block_size 字节的块写入已存在的远程文件的相同位置，
+        远程文件的其他内容保持不变（用于差量上传）。
+
+        参数:
+        - offsets: 块的起始偏移量列表。
+        - progress_handler: 回调函数 progress_handler(已传输字节数, 总字节数)。
+
+        返回:
+        - 上传的总字节数。
+        """
+        if self.client is None:
+            raise Exception('SSH client is not connected. Please call connect_async first.')
+
+        total_bytes = sum(min(block_size, artifact.size - offset) for offset in offsets)
+        transferred = [0]
+
+        def on_block(length):
+            transferred[0] += length
+            if self.metrics is not None:
+                self.metrics.bytes_uploaded += length
+            if progress_handler:
+                progress_handler(transferred[0], total_bytes)
+
+        async with self.client.start_sftp_client() as sftp:
+            async with sftp.open(remote_path, 'r+b') as remote_file:
+                await self._write_pipelined(remote_file, artifact, offsets, block_size, max_requests, on_block,
+                                            self.upload_limiter)
+        return total_bytes
+
+    @staticmethod
+    async def _write_pipelined(remote_file, artifact, offsets, block_size, max_requests, on_block, limiter=None):
+        """
+        以最多 max_requests 个并行写请求，把 artifact 中从 offsets 中每个偏移量开始的块写入远程文件。
+        提供了 limiter（TokenBucket）时，每个块发送前先取得与块大小相同的令牌。
+        """
+        block_count = len(offsets)
+        offsets = iter(offsets)
+
+        async def writer():
+            # 所有 writer 共享同一个偏移迭代器，每个块只会被取走一次
+            for offset in offsets:
+                block = artifact.view(offset, block_size)
+                if limiter is not None:
+                    await limiter.consume(len(block))
+                await remote_file.write(block, offset)
+                on_block(len(block))
+
+        tasks = [asyncio.ensure_future(writer()) for _ in range(max(1, min(max_requests, block_count)))]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
             raise
 
-    async def close_async(self):
+    async def close_async(self, reuse=True):
         """
         关闭SSH连接。
+
+        参数:
+        - reuse: 为真且提供了连接池时，把仍然可用的连接放回池中而不是关闭。
         """
         if self.client:
-            self.client.close()
-            await self.client.wait_closed()
+            client, self.client = self.client, None
+            if reuse and self.pool is not None and self.pool.release(self.pool_key, client):
+                return
+            client.close()
+            await client.wait_closed()
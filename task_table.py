@@ -0,0 +1,326 @@
+import collections
+
+from PyQt5.QtCore import QAbstractTableModel, QEvent, QModelIndex, Qt, pyqtSignal
+from PyQt5.QtGui import QColor, QPalette
+from PyQt5.QtWidgets import QApplication, QStyle, QStyledItemDelegate, QStyleOptionButton
+
+KEY_ROLE = Qt.UserRole + 1  # 返回行对应主机标识的数据角色
+ENABLED_ROLE = Qt.UserRole + 2  # 返回操作按钮是否可用的数据角色
+
+
+class HostTask:
+    """
+    升级任务表中的一行，以主机地址 host 作为唯一标识。
+
+    参数:
+    - host/username/password: SSH 登录信息。
+    - log_lines: 界面中保留的最后输出行数。
+    """
+
+    __slots__ = ('host', 'username', 'password', 'status', 'command_status', 'progress', 'message', 'logs', 'busy')
+
+    def __init__(self, host, username, password, log_lines=200):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.status = ''  # ""（未执行）、"Waiting"、"N%"、"Success"、"Fail"、"Skipped" 或扫描状态
+        self.command_status = ''  # 批量命令的状态："Running"、"OK" 或 "Error"，不影响升级状态 status
+        self.progress = 0
+        self.message = ''
+        self.logs = collections.deque(maxlen=log_lines)  # 最近的远程输出
+        self.busy = False  # 正在升级时禁用该行的操作按钮
+
+    def reset(self, status):
+        """
+        开始新一次升级前清空消息和输出（进度由 TaskTableModel.reset_task 清零）。
+        """
+        self.status = status
+        self.command_status = ''
+        self.message = ''
+        self.logs.clear()
+
+    @property
+    def state(self):
+        """
+        State 列显示的状态：执行过批量命令后显示命令的状态，否则显示升级或扫描状态。
+        """
+        return self.command_status or self.status
+
+
+class TaskTableModel(QAbstractTableModel):
+    """
+    升级任务表的数据模型。
+
+    所有行保存在列表中，并维护 host -> 行号 的索引，事件和操作都按主机定位行，
+    与行号无关；界面只绘制可见的行，批量导入只触发一次插入通知。
+    progress_total 为所有行进度之和，通过 set_progress/reset_task 增量维护，计算总体进度无需遍历所有行。
+
+    参数:
+    - log_lines: 每个主机在界面中保留的最后输出行数。
+    - parent: 父对象。
+
+    在表格中修改主机、用户名或密码后发出 task_edited(修改前的主机, 修改后的主机) 信号。
+    """
+
+    task_edited = pyqtSignal(str, str)
+    HEADERS = ['Host', 'Username', 'Password', 'State', 'Logs', 'Upgrade', 'Delete']
+    HOST, USERNAME, PASSWORD, STATE, LOGS, UPGRADE, DELETE = range(7)
+    STATUS_COLORS = {'Success': QColor('green'), 'Fail': QColor('red'),
+                     'Reachable': QColor('green'), 'Unreachable': QColor('red'),
+                     'OK': QColor('green'), 'Error': QColor('red')}
+    PROGRESS_COLOR = QColor('#05B8CC')
+
+    def __init__(self, log_lines=200, parent=None):
+        super().__init__(parent)
+        self.log_lines = log_lines
+        self.actions_enabled = True
+        self.progress_total = 0
+        self._tasks = []
+        self._rows = {}  # host -> 行号
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._tasks)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return super().headerData(section, orientation, role)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        task = self._tasks[index.row()]
+        column = index.column()
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            if column == self.HOST:
+                return task.host
+            if column == self.USERNAME:
+                return task.username
+            if column == self.PASSWORD:
+                return task.password
+            if column == self.STATE:
+                return task.state
+            if column == self.LOGS:
+                # 升级过程中显示最新一行输出，结束后显示结果消息
+                return task.message or (task.logs[-1] if task.logs else '')
+        elif role == Qt.ForegroundRole and column in (self.STATE, self.LOGS):
+            if task.state.endswith('%'):
+                return self.PROGRESS_COLOR
+            return self.STATUS_COLORS.get(task.state)
+        elif role == Qt.ToolTipRole and column == self.LOGS:
+            return '\n'.join(task.logs) or None
+        elif role == KEY_ROLE:
+            return task.host
+        elif role == ENABLED_ROLE:
+            return self.actions_enabled and not task.busy
+        return None
+
+    def flags(self, index):
+        flags = super().flags(index)
+        # 与操作按钮相同：批量升级或批量命令进行中时所有行都不可编辑
+        if (index.isValid() and index.column() <= self.PASSWORD and self.actions_enabled
+                and not self._tasks[index.row()].busy):
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or not index.isValid() or index.column() > self.PASSWORD:
+            return False
+        task = self._tasks[index.row()]
+        old_host = task.host
+        value = str(value)
+        if index.column() == self.HOST:
+            if not value or (value != task.host and value in self._rows):
+                return False
+            del self._rows[task.host]
+            task.host = value
+            self._rows[value] = index.row()
+        elif index.column() == self.USERNAME:
+            task.username = value
+        else:
+            task.password = value
+        self.dataChanged.emit(index, index)
+        self.task_edited.emit(old_host, task.host)
+        return True
+
+    def add_tasks(self, configs, replace=False):
+        """
+        追加 (host, username, password) 序列中的主机，跳过地址为空或已存在的主机。
+
+        configs 可以是逐行读取文件的生成器；读取过程中出现异常时表格保持不变。
+
+        参数:
+        - replace: 为真时用读取到的主机替换表格中的所有行。
+
+        返回:
+        - 实际添加的 HostTask 列表。
+        """
+        existing = {} if replace else self._rows
+        new_tasks = []
+        seen = set()
+        for host, username, password in configs:
+            if host and host not in existing and host not in seen:
+                seen.add(host)
+                new_tasks.append(HostTask(host, username, password, self.log_lines))
+        if replace:
+            self.beginResetModel()
+            self._tasks = new_tasks
+            self._rows = {task.host: row for row, task in enumerate(new_tasks)}
+            self.progress_total = 0
+            self.endResetModel()
+        elif new_tasks:
+            first = len(self._tasks)
+            self.beginInsertRows(QModelIndex(), first, first + len(new_tasks) - 1)
+            for row, task in enumerate(new_tasks, first):
+                self._tasks.append(task)
+                self._rows[task.host] = row
+            self.endInsertRows()
+        return new_tasks
+
+    def remove_task(self, host):
+        """
+        删除指定主机所在的行。
+        """
+        row = self._rows.get(host)
+        if row is None:
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        self.progress_total -= self._tasks[row].progress
+        del self._tasks[row]
+        del self._rows[host]
+        for index in range(row, len(self._tasks)):
+            self._rows[self._tasks[index].host] = index
+        self.endRemoveRows()
+
+    def clear(self):
+        """
+        删除所有行。
+        """
+        self.beginResetModel()
+        self._tasks = []
+        self._rows = {}
+        self.progress_total = 0
+        self.endResetModel()
+
+    def task(self, host):
+        """
+        返回指定主机的 HostTask，不存在时返回 None。
+        """
+        row = self._rows.get(host)
+        return None if row is None else self._tasks[row]
+
+    def tasks(self):
+        """
+        按显示顺序返回所有 HostTask。
+        """
+        return list(self._tasks)
+
+    def set_progress(self, task, progress):
+        """
+        设置任务进度并同步更新 progress_total（不发出重绘通知）。
+        """
+        self.progress_total += progress - task.progress
+        task.progress = progress
+
+    def reset_task(self, task, status):
+        """
+        开始新一次升级前重置任务的进度、状态、消息和输出（不发出重绘通知）。
+        """
+        self.set_progress(task, 0)
+        task.reset(status)
+
+    def refresh_hosts(self, hosts):
+        """
+        通知视图重绘多个主机的状态和日志列，合并为一次覆盖这些行的重绘通知。
+        """
+        rows = [self._rows[host] for host in hosts if host in self._rows]
+        if rows:
+            self.dataChanged.emit(self.index(min(rows), self.STATE), self.index(max(rows), self.LOGS))
+
+    def refresh(self, host, first_column=STATE, last_column=LOGS):
+        """
+        通知视图重绘指定主机所在行的 first_column ~ last_column 列。
+        """
+        row = self._rows.get(host)
+        if row is not None:
+            self.dataChanged.emit(self.index(row, first_column), self.index(row, last_column))
+
+    def refresh_all(self):
+        """
+        通知视图重绘所有行。
+        """
+        if self._tasks:
+            self.dataChanged.emit(self.index(0, 0), self.index(len(self._tasks) - 1, len(self.HEADERS) - 1))
+
+    def set_busy(self, host, busy):
+        """
+        设置指定主机是否正在升级（升级中禁用该行的操作按钮）。
+        """
+        task = self.task(host)
+        if task is not None:
+            task.busy = busy
+            self.refresh(host, self.UPGRADE, self.DELETE)
+
+    def set_actions_enabled(self, enabled):
+        """
+        启用或禁用所有行的操作按钮（启用时同时清除各行的升级中状态），只发出一次重绘通知。
+        """
+        self.actions_enabled = enabled
+        if enabled:
+            for task in self._tasks:
+                task.busy = False
+        if self._tasks:
+            self.dataChanged.emit(self.index(0, self.UPGRADE), self.index(len(self._tasks) - 1, self.DELETE))
+
+
+class ButtonDelegate(QStyledItemDelegate):
+    """
+    在单元格中绘制按钮的委托，不为每一行创建按钮控件。
+
+    点击可用的按钮时发出 clicked(host) 信号，按钮是否可用由模型的 ENABLED_ROLE 决定。
+
+    参数:
+    - text: 按钮文字。
+    - color: 按钮可用时的文字颜色。
+    - parent: 父对象。
+    """
+
+    clicked = pyqtSignal(str)
+    DISABLED_COLOR = QColor('#a0a0a0')
+
+    def __init__(self, text, color, parent=None):
+        super().__init__(parent)
+        self.text = text
+        self.color = QColor(color)
+        self._pressed = None  # 鼠标按下时所在的 (行, 列)
+
+    def paint(self, painter, option, index):
+        enabled = bool(index.data(ENABLED_ROLE))
+        button = QStyleOptionButton()
+        button.rect = option.rect.adjusted(2, 2, -2, -2)
+        button.text = self.text
+        button.state = QStyle.State_Enabled if enabled else QStyle.State_None
+        if enabled and self._pressed == (index.row(), index.column()):
+            button.state |= QStyle.State_Sunken
+        button.palette = QPalette(option.palette)
+        button.palette.setColor(QPalette.ButtonText, self.color if enabled else self.DISABLED_COLOR)
+        style = option.widget.style() if option.widget else QApplication.style()
+        style.drawControl(QStyle.CE_PushButton, button, painter, option.widget)
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QEvent.MouseButtonPress and event.button() == Qt.LeftButton:
+            if index.data(ENABLED_ROLE):
+                self._pressed = (index.row(), index.column())
+            return True
+        if event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton:
+            pressed, self._pressed = self._pressed, None
+            if (pressed == (index.row(), index.column()) and option.rect.contains(event.pos())
+                    and index.data(ENABLED_ROLE)):
+                self.clicked.emit(index.data(KEY_ROLE))
+            return True
+        if event.type() == QEvent.MouseButtonDblClick:
+            return True
+        return False
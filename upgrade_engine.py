@@ -0,0 +1,581 @@
+import asyncio
+import collections
+import queue
+import threading
+
+from artifact import ArtifactStore
+from batch_command import CommandConfig, OutputGroups, run_command
+from concurrency import StageConfig, StagePools, create_limiter, is_congestion_error
+from connection_pool import ConnectionPool, PoolConfig
+from distribution import RelayConfig, RelayDistributor
+from host_log import HostLog
+from metrics import HostMetrics
+from reachability import ReachabilityCache, ScanConfig, scan_hosts
+from retry_policy import RetryConfig
+from scheduler import RolloutScheduler
+from sharding import ShardConfig, ShardPool
+from upgrade_manager import CancelConfig, TransferConfig, UpgradeManager
+
+
+class UpgradeEngine:
+    """
+    升级引擎。
+
+    在一个长期存在的后台线程中运行唯一的 asyncio 事件循环，所有主机的
+    UpgradeManager.execute_upgrade_async 都作为该循环上的 Task 执行，
+    因此线程数和事件循环数量不随主机数量增长。
+
+    进度和结果通过线程安全的队列 events 发回调用方，事件格式为 (kind, key, payload)：
+    - ('progress', key, 百分比)
+    - ('log', key, (stream, line))，远程脚本的一行输出，stream 为 'stdout' 或 'stderr'
+    - ('metrics', key, HostMetrics)，该主机各阶段的耗时统计，紧接着发出 'finished'
+    - ('finished', key, (状态, 消息))，状态为 "Success"、"Fail" 或 "Skipped"
+    - ('relay_finished', None, {'hosts': 主机数, 'delivered': 已通过中继拿到文件的主机数})
+    - ('rollout_finished', None, 调度统计字典)
+    - ('scan_result', key, ScanResult)
+    - ('scan_finished', None, {'hosts': 主机数, 'reachable': 可达主机数})
+    - ('command_result', key, OutputGroup)，批量命令中一台主机的结果，输出相同的主机共用同一个 OutputGroup
+    - ('command_finished', None, OutputGroups)
+    - ('cancel_finished', None, {'cancelled': 被取消的升级数, 'forced': 超过宽限期被强制结束的升级数})
+
+    transfer_config 和 relay_config 为所有主机共用的文件传输参数（TransferConfig）和中继分发参数（RelayConfig）。
+    log_dir 不为空时，每个主机的完整远程输出同时追加写入该目录下的日志文件（见 HostLog）。
+    scan_config 为可达性预扫描参数（ScanConfig），扫描结果保存在 reachability_cache 中，
+    有效期内升级时不再重复探测，批量升级时直接排除不可达的主机。
+    pool_config 为连接池参数（PoolConfig）。升级和中继分发结束后，已认证的连接保留在 connection_pool 中，
+    同一会话中之后的重试和升级直接复用，引擎停止时全部关闭。
+    retry_config 为按失败类型重试的参数（RetryConfig），重试从主机最后完成的阶段继续。
+    shard_config 为多进程分片参数（ShardConfig）。使用多个工作进程时，调度、中继分发和扫描仍在本引擎中进行，
+    单个主机的升级按主机地址转发到各工作进程中的 UpgradeEngine 执行（见 sharding.ShardPool），
+    事件格式不变。
+    stage_config 为升级流水线各阶段的并发限制和上传带宽限制（StageConfig），由本引擎中的所有升级共享；
+    使用多个工作进程时平均分给各工作进程。
+    command_config 为批量命令参数（CommandConfig），批量命令同样在本引擎中执行。
+    cancel_config 为取消升级的参数（CancelConfig）。取消时先停止调度，再取消正在进行的升级，
+    各主机在宽限期内并发删除远程临时文件并关闭连接。
+    """
+
+    CANCEL_MARGIN = 2.0  # 取消时在宽限期之外额外等待的时间（秒）
+    CANCEL_REASON = 'Rollout cancelled.'  # 取消时被跳过的主机显示的原因
+
+    def __init__(self):
+        """
+        初始化UpgradeEngine实例。
+        """
+        self.events = queue.Queue()
+        self.transfer_config = TransferConfig()
+        self.relay_config = RelayConfig()
+        self.log_dir = None
+        self.scan_config = ScanConfig()
+        self.reachability_cache = ReachabilityCache(self.scan_config.ttl)
+        self.pool_config = PoolConfig()
+        self.retry_config = RetryConfig()
+        self.shard_config = ShardConfig()
+        self.cancel_config = CancelConfig()
+        self.command_config = CommandConfig()
+        self.stage_config = StageConfig()
+        self._stage_pools = None  # 按 stage_config 在事件循环中创建的 StagePools
+        self._shards = None  # ShardPool，第一次转发升级时创建
+        self.connection_pool = ConnectionPool(self.pool_config)
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._tasks = {}  # key -> asyncio.Task，仅在引擎线程中访问
+        self._rollouts = set()  # 正在运行的批量调度 Task
+        self._cancelling = set()  # 已经取消、正在清理的升级 Task，不再重复取消以免中断清理
+        self._schedulers = set()  # 正在运行的 RolloutScheduler，取消时先停止调度
+
+    def configure(self, config):
+        """
+        按 config.json 格式的字典（transfer、relay、scan、pool、retry、shards、cancel、command 和 stages 配置）设置引擎参数，
+        缺少的配置使用默认值。字典中还可以包含 log_dir。
+        """
+        self.transfer_config = TransferConfig.from_dict(config.get('transfer'))
+        self.relay_config = RelayConfig.from_dict(config.get('relay'))
+        self.scan_config = ScanConfig.from_dict(config.get('scan'))
+        self.pool_config = PoolConfig.from_dict(config.get('pool'))
+        self.retry_config = RetryConfig.from_dict(config.get('retry'))
+        self.shard_config = ShardConfig.from_dict(config.get('shards'))
+        self.cancel_config = CancelConfig.from_dict(config.get('cancel'))
+        self.command_config = CommandConfig.from_dict(config.get('command'))
+        self.stage_config = StageConfig.from_dict(config.get('stages'))
+        if 'log_dir' in config:
+            self.log_dir = config['log_dir']
+
+    def worker_settings(self):
+        """
+        返回工作进程中执行单个主机升级所需的参数，格式与 configure 相同（工作进程自身不再分片）。
+        """
+        return {
+            'transfer': self.transfer_config.to_dict(),
+            'scan': self.scan_config.to_dict(),
+            'pool': self.pool_config.to_dict(),
+            'retry': self.retry_config.to_dict(),
+            'cancel': self.cancel_config.to_dict(),
+            'stages': self.stage_config.split(self.shard_config.worker_count()).to_dict(),
+            'log_dir': self.log_dir,
+        }
+
+    def start(self):
+        """
+        启动后台引擎线程（重复调用无副作用）。
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._ready.clear()
+        self._thread = threading.Thread(target=self._run_loop, name='UpgradeEngine', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run_loop(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        self._ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.close()
+
+    def stop(self, timeout=5):
+        """
+        取消所有任务（见 cancel_all）并停止后台引擎线程。
+        """
+        if self._loop is None or self._thread is None:
+            return
+        self.cancel_all()
+        try:
+            self.call(self.connection_pool.close_all(), timeout)
+        except Exception as e:
+            print(f"Error closing pooled connections: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+        self._thread = None
+        self._loop = None
+        if self._shards is not None:
+            self._shards.close(timeout)
+            self._shards = None
+
+    def call(self, coro, timeout=None):
+        """
+        在引擎事件循环中执行协程并等待其结果（供其他线程调用）。
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    def submit(self, coro):
+        """
+        将协程提交到引擎事件循环，返回 concurrent.futures.Future。
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def submit_upgrade(self, key, host, username, password, file_path, script_path):
+        """
+        提交单个主机的升级任务。
+
+        参数:
+        - key: 任务标识，随事件一起返回给调用方。
+        - host/username/password: SSH 登录信息。
+        - file_path/script_path: 本地升级文件和脚本路径。
+        """
+        return self.submit(self._start_upgrade(key, host, username, password, file_path, script_path))
+
+    async def _start_upgrade(self, key, host, username, password, file_path, script_path, limiter=None,
+                             artifact_store=None):
+        task = asyncio.current_task()
+        self._tasks[key] = task
+        try:
+            return await self.run_upgrade(key, host, username, password, file_path, script_path, limiter,
+                                          artifact_store)
+        finally:
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+            self._cancelling.discard(task)
+
+    def submit_rollout(self, jobs, file_path, script_path, config):
+        """
+        提交批量升级，由 RolloutScheduler 按 config 控制并发、分波和中止条件。
+
+        参数:
+        - jobs: (key, host, username, password) 列表。
+        - file_path/script_path: 本地升级文件和脚本路径。
+        - config: SchedulerConfig 实例。
+        """
+        return self.submit(self._start_rollout(jobs, file_path, script_path, config))
+
+    async def _start_rollout(self, jobs, file_path, script_path, config):
+        task = asyncio.current_task()
+        self._rollouts.add(task)
+        try:
+            return await self.run_rollout(jobs, file_path, script_path, config)
+        finally:
+            self._rollouts.discard(task)
+
+    async def run_rollout(self, jobs, file_path, script_path, config):
+        """
+        在引擎事件循环中执行批量升级。
+
+        返回:
+        - 调度统计字典，同时作为 'rollout_finished' 事件发出。
+        """
+        jobs, unreachable = self.exclude_unreachable(jobs)
+        for job, result in unreachable:
+            self.events.put(('finished', job[0], ("Fail", f'Host {job[1]} is not reachable: {result.describe()}')))
+        limiter = create_limiter(config)
+        artifact_store = ArtifactStore()
+
+        async def run_host(job, slot):
+            return await self._start_upgrade(*job, file_path, script_path, slot, artifact_store)
+
+        distributor = None
+        relayed = set()  # 已通过中继拿到升级文件的主机 key
+        relayed_skipped = []  # 拿到了升级文件但被跳过的主机，结束时删除它们的升级文件
+        if self.relay_config.enabled:
+            self.connection_pool.config = self.pool_config
+            stage_pools = self.stage_pools()
+            distributor = RelayDistributor(self.relay_config, self.transfer_config, artifact_store,
+                                           self.connection_pool, stage_pools.upload_limiter, limiter, stage_pools,
+                                           self.scan_config.port)
+
+        async def before_wave(wave):
+            # 每一波开始前只向这一波的主机中继分发，升级时校验一致即可跳过上传；
+            # 金丝雀波失败或批量升级中止时，其余主机不会收到升级文件
+            delivered = await distributor.distribute(wave, file_path)
+            relayed.update(key for key, ok in delivered.items() if ok)
+            self.events.put(('relay_finished', None,
+                             {'hosts': len(delivered), 'delivered': sum(delivered.values())}))
+
+        def on_skipped(job, reason):
+            if job[0] in relayed:
+                relayed_skipped.append(job)
+            self.events.put(('finished', job[0], ("Skipped", reason)))
+
+        scheduler = RolloutScheduler(config, run_host, on_skipped, limiter,
+                                     before_wave if distributor is not None else None)
+        self._schedulers.add(scheduler)
+        with artifact_store:
+            try:
+                summary = await scheduler.run(jobs)
+            finally:
+                self._schedulers.discard(scheduler)
+                if self._shards is not None:
+                    # 工作进程中本批次共享的文件
+                    self._shards.release(id(artifact_store))
+                if distributor is not None:
+                    keep = (scheduler.abort_reason == self.CANCEL_REASON
+                            and not self.cancel_config.remove_partial_uploads)
+                    await self._clean_up_relay(distributor, [] if keep else relayed_skipped, file_path)
+        summary['unreachable'] = len(unreachable)
+        self.events.put(('rollout_finished', None, summary))
+        return summary
+
+    async def _clean_up_relay(self, distributor, jobs, file_path):
+        """
+        删除被跳过的主机 jobs 上通过中继拿到的升级文件和各组锚点主机上的暂存目录，
+        最多等待 cancel_config.grace_period 秒。
+        """
+        try:
+            await asyncio.wait_for(asyncio.gather(distributor.remove(jobs, file_path), distributor.close()),
+                                   self.cancel_config.grace_period)
+        except asyncio.TimeoutError:
+            print("Warning: timed out removing relayed files.")
+
+    def _connect_observer(self, limiter):
+        """
+        返回把每次连接的耗时和错误报告给 limiter 的 SSHManager 连接观察者，limiter 为空时返回 None。
+        """
+        if limiter is None:
+            return None
+
+        def connect_observer(manager):
+            limiter.observe(manager.connect_started, manager.connect_latency,
+                            is_congestion_error(manager.connect_error), manager.reused)
+        return connect_observer
+
+    def stage_pools(self):
+        """
+        返回与当前 stage_config 对应的 StagePools（在事件循环中调用，stage_config 被替换后重新创建）。
+        """
+        if self._stage_pools is None or self._stage_pools.config is not self.stage_config:
+            self._stage_pools = StagePools(self.stage_config)
+        return self._stage_pools
+
+    def exclude_unreachable(self, jobs):
+        """
+        按有效期内的预扫描结果，把 jobs 分为待升级的主机和不可达的主机。
+
+        返回:
+        - (待升级的 job 列表, (job, ScanResult) 列表)
+        """
+        if not self.scan_config.exclude_unreachable:
+            return list(jobs), []
+        self.reachability_cache.ttl = self.scan_config.ttl
+        remaining, unreachable = [], []
+        for job in jobs:
+            result = self.reachability_cache.get(job[1])
+            if result is not None and not result.reachable:
+                unreachable.append((job, result))
+            else:
+                remaining.append(job)
+        return remaining, unreachable
+
+    def submit_scan(self, jobs):
+        """
+        提交可达性预扫描。
+
+        参数:
+        - jobs: (key, host) 列表。
+        """
+        return self.submit(self.run_scan(jobs))
+
+    async def run_scan(self, jobs):
+        """
+        在引擎事件循环中按 scan_config 并发探测所有主机，结果写入 reachability_cache，
+        并通过 'scan_result' 和 'scan_finished' 事件报告。
+
+        返回:
+        - 可达的主机数量。
+        """
+        self.reachability_cache.ttl = self.scan_config.ttl
+        keys = collections.defaultdict(list)  # 同一主机可能对应多个 key
+        for key, host in jobs:
+            keys[host].append(key)
+
+        def on_result(result):
+            for key in keys[result.host]:
+                self.events.put(('scan_result', key, result))
+
+        task = asyncio.current_task()
+        self._rollouts.add(task)
+        try:
+            results = await scan_hosts(list(keys), self.scan_config, self.reachability_cache, on_result)
+        finally:
+            self._rollouts.discard(task)
+        reachable = sum(1 for result in results if result.reachable)
+        self.events.put(('scan_finished', None, {'hosts': len(results), 'reachable': reachable}))
+        return reachable
+
+    def submit_command(self, jobs, command, config):
+        """
+        提交批量命令：在每台主机上执行同一条命令，结果按输出分组。
+
+        参数:
+        - jobs: (key, host, username, password) 列表。
+        - command: 远程命令。
+        - config: SchedulerConfig 实例，使用其中的并发参数。
+        """
+        return self.submit(self.run_command(jobs, command, config))
+
+    async def run_command(self, jobs, command, config):
+        """
+        在引擎事件循环中并发执行批量命令，每台主机结束后发出 'command_result' 事件，最后发出 'command_finished'。
+        输出完全相同（stdout、stderr 和退出码）的主机归入同一组，每种输出只保存一份。
+
+        返回:
+        - OutputGroups
+        """
+        from ssh_manager import SSHManager  # 延迟导入 asyncssh，缩短启动时间
+        groups = OutputGroups()
+        limiter = create_limiter(config)
+        self.connection_pool.config = self.pool_config
+        jobs, unreachable = self.exclude_unreachable(jobs)
+        for (key, host, _, _), result in unreachable:
+            self.events.put(('command_result', key,
+                             groups.add_error(host, f'Host {host} is not reachable: {result.describe()}')))
+
+        async def run_host(key, host, username, password):
+            async with limiter:
+                ssh_manager = SSHManager(host, username, password, connect_observer=self._connect_observer(limiter),
+                                         port=self.scan_config.port, pool=self.connection_pool)
+                try:
+                    group = groups.add(await run_command(ssh_manager, command, self.command_config))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    group = groups.add_error(host, str(e))
+            self.events.put(('command_result', key, group))
+
+        task = asyncio.current_task()
+        self._rollouts.add(task)
+        try:
+            await asyncio.gather(*(run_host(*job) for job in jobs))
+        finally:
+            self._rollouts.discard(task)
+        self.events.put(('command_finished', None, groups))
+        return groups
+
+    async def run_upgrade(self, key, host, username, password, file_path, script_path, limiter=None,
+                          artifact_store=None):
+        """
+        在引擎事件循环中执行单个主机的升级，并通过事件队列报告进度和结果。
+        如果提供了并发限制器 limiter（或批量升级中该主机的 HostSlot），则把本次连接的延迟和错误反馈给它，
+        HostSlot 在上传结束、开始执行脚本时提前让出名额；
+        如果提供了 artifact_store，则与同批次的其他主机共享本地文件的内存映射。
+        shard_config 指定多个工作进程时，升级在主机所属的工作进程中执行。
+
+        返回:
+        - (状态, 消息)
+        """
+        if self.shard_config.worker_count() > 1:
+            return await self._run_upgrade_in_worker(key, host, username, password, file_path, script_path,
+                                                     limiter, artifact_store)
+        host_log = HostLog(self.log_dir, host)
+
+        def on_output(stream, line):
+            host_log.write(stream, line)
+            self.events.put(('log', key, (stream, line)))
+
+        from ssh_manager import SSHManager  # 延迟导入 asyncssh，缩短启动时间
+        metrics = HostMetrics(host)
+        self.connection_pool.config = self.pool_config
+        stage_pools = self.stage_pools()
+        # 与可达性探测使用同一个端口，扫描结果才对应实际连接的端口
+        ssh_manager = SSHManager(host, username, password, connect_observer=self._connect_observer(limiter),
+                                 metrics=metrics, port=self.scan_config.port, pool=self.connection_pool,
+                                 upload_limiter=stage_pools.upload_limiter)
+        upgrade_manager = UpgradeManager(ssh_manager,
+                                         progress_callback=lambda p: self.events.put(('progress', key, p)),
+                                         transfer_config=self.transfer_config,
+                                         artifact_store=artifact_store,
+                                         output_callback=on_output,
+                                         scan_config=self.scan_config,
+                                         reachability_cache=self.reachability_cache,
+                                         metrics=metrics,
+                                         retry_config=self.retry_config,
+                                         cancel_config=self.cancel_config,
+                                         stage_pools=stage_pools,
+                                         on_transferred=getattr(limiter, 'transferred', None))
+        self.events.put(('progress', key, 0))
+        try:
+            result = await upgrade_manager.execute_upgrade_async(file_path, script_path)
+            outcome = ("Success", str(result))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            outcome = ("Fail", str(e))
+        finally:
+            host_log.close()
+        metrics.finish(outcome[0])
+        self.events.put(('metrics', key, metrics))
+        self.events.put(('finished', key, outcome))
+        return outcome
+
+    async def _run_upgrade_in_worker(self, key, host, username, password, file_path, script_path, limiter,
+                                     artifact_store):
+        if self._shards is None or len(self._shards) != self.shard_config.worker_count():
+            if self._shards is not None:
+                self._shards.close()
+            self._shards = ShardPool(self.shard_config.worker_count(), self.events)
+        return await self._shards.run_upgrade(
+            (key, host, username, password, file_path, script_path), self.worker_settings(),
+            self.reachability_cache.get(host), id(artifact_store) if artifact_store is not None else None,
+            limiter.observe if limiter is not None else None, getattr(limiter, 'transferred', None))
+
+    def cancel_all(self, timeout=None):
+        """
+        取消所有正在运行的任务并等待清理完成，然后丢弃尚未被取走的事件。
+
+        参数:
+        - timeout: 最长等待时间（秒），默认为 cancel_config.grace_period 再加几秒余量。
+
+        返回:
+        - 取消统计字典（见 'cancel_finished' 事件），超时或出错时为 None。
+        """
+        if self._loop is None:
+            return None
+        if timeout is None:
+            timeout = self.cancel_config.grace_period + self.CANCEL_MARGIN * 2
+        summary = None
+        try:
+            summary = self.call(self.cancel_async(), timeout)
+        except Exception as e:
+            print(f"Error cancelling tasks: {e}")
+        self.drain_events()
+        return summary
+
+    def cancel_upgrade(self, key):
+        """
+        取消单个主机的升级，该主机在 cancel_config.grace_period 内清理远程临时文件后报告结束。
+        """
+        return self.submit(self._cancel_upgrade(key))
+
+    async def _cancel_upgrade(self, key):
+        task = self._tasks.get(key)
+        if task is not None:
+            self._cancel_task(task)
+
+    def _cancel_task(self, task):
+        if task not in self._cancelling:
+            self._cancelling.add(task)
+            task.cancel()
+
+    def submit_cancel(self):
+        """
+        在后台取消所有正在运行的任务，不阻塞调用方；清理完成后发出 'cancel_finished' 事件。
+        调用方应忽略在此之前收到的其他事件。
+        """
+        return self.submit(self._submit_cancel())
+
+    async def _submit_cancel(self):
+        summary = await self.cancel_async()
+        self.events.put(('cancel_finished', None, summary))
+        return summary
+
+    async def cancel_async(self):
+        """
+        在引擎事件循环中取消所有任务：先停止所有调度，使尚未开始的主机不再开始；
+        再取消正在进行的升级，各主机在 cancel_config.grace_period 内并发清理远程临时文件，
+        超过宽限期仍未结束的升级被强制结束；最后取消批量调度和扫描，并等待工作进程确认。
+
+        返回:
+        - {'cancelled': 被取消的升级数, 'forced': 被强制结束的升级数}
+        """
+        for scheduler in list(self._schedulers):
+            scheduler.stop(self.CANCEL_REASON)
+        upgrades = list(self._tasks.values())
+        for task in upgrades:
+            self._cancel_task(task)
+        forced = 0
+        if upgrades:
+            _, pending = await asyncio.wait(upgrades, timeout=self.cancel_config.grace_period + self.CANCEL_MARGIN)
+            for task in pending:
+                task.cancel()  # 第二次取消会中断正在进行的清理
+            forced = len(pending)
+            await asyncio.gather(*upgrades, return_exceptions=True)
+        rollouts = list(self._rollouts)
+        for task in rollouts:
+            task.cancel()
+        if rollouts:
+            await asyncio.gather(*rollouts, return_exceptions=True)
+        self._tasks.clear()
+        self._rollouts.clear()
+        if self._shards is not None:
+            # 等待工作进程确认取消，确认之前转发的事件由调用方一起丢弃
+            try:
+                await self._shards.cancel_all(self.cancel_config.grace_period + self.CANCEL_MARGIN * 2)
+            except asyncio.TimeoutError:
+                print("Warning: upgrade workers did not confirm cancellation in time.")
+        return {'cancelled': len(upgrades), 'forced': forced}
+
+    def drain_events(self, max_events=None):
+        """
+        非阻塞地取出队列中的事件。
+
+        参数:
+        - max_events: 最多取出的事件数量，None 表示全部取出。
+
+        返回:
+        - 事件列表。
+        """
+        events = []
+        while max_events is None or len(events) < max_events:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        return events
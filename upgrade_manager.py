@@ -1,55 +1,591 @@
 import asyncio
+import collections
 import os
+import posixpath
+import re
+import secrets
+import shlex
+
+from artifact import ArtifactStore
+from compression import COMPRESSORS, MIN_COMPRESS_SIZE, compressed_copy
+from concurrency import StagePools
+from metrics import HostMetrics
+from reachability import ScanConfig
+from retry_policy import SCRIPT, TIMEOUT, UPLOAD, RetryConfig, UpgradeError, classify_connect_error
+
+
+class TransferConfig:
+    """
+    文件传输参数。
+
+    参数:
+    - block_size: SFTP 每个读写请求的块大小（字节）。
+    - max_requests: SFTP 同时在途的最大块请求数量（流水线深度）。
+    - chunk_size: 断点续传的校验粒度（字节），续传总是从某个已校验的 chunk_size 整数倍处开始。
+    - compression: 传输前压缩升级文件使用的算法（gzip、bzip2 或 xz），空字符串表示不压缩。
+    - compression_level: 压缩级别。
+    - delta: 是否启用差量上传。启用后，升级成功的文件保存在远程的 delta_cache_dir 中，下次升级时按块比较，
+      只上传发生变化的块，在远程与缓存的上一版本合成新文件并校验。
+    - delta_block_size: 差量上传比较的块大小（字节），向下取整为 block_size 的整数倍。
+    - delta_cache_dir: 远程主机上保存上一版本升级文件的目录（只保留最近一个文件）。
+    """
+
+    DEFAULTS = {
+        'block_size': 65536,
+        'max_requests': 64,
+        'chunk_size': 4 * 1024 * 1024,
+        'compression': '',
+        'compression_level': 6,
+        'delta': False,
+        'delta_block_size': 1024 * 1024,
+        'delta_cache_dir': '/var/tmp/sshtool',
+    }
+
+    def __init__(self, **kwargs):
+        """
+        初始化TransferConfig实例，未指定的参数使用 DEFAULTS 中的默认值。
+        """
+        for name, default in self.DEFAULTS.items():
+            value = kwargs.get(name, default)
+            setattr(self, name, type(default)(value))
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        从配置字典创建实例，忽略未知的键。
+        """
+        return cls(**{name: value for name, value in (data or {}).items() if name in cls.DEFAULTS})
+
+    def to_dict(self):
+        """
+        转换为可写入 config.json 的字典。
+        """
+        return {name: getattr(self, name) for name in self.DEFAULTS}
+
+
+class CancelConfig:
+    """
+    取消升级时的清理参数。
+
+    参数:
+    - grace_period: 取消后等待正在进行的升级清理远程临时文件的最长时间（秒），超时后强制结束并关闭连接。
+    - remove_partial_uploads: 是否同时删除尚未执行的升级文件（包括未上传完的部分文件和压缩副本）。
+      为 false 时只删除脚本，保留升级文件供下次升级时跳过上传或断点续传。
+    """
+
+    DEFAULTS = {
+        'grace_period': 10.0,
+        'remove_partial_uploads': True,
+    }
+
+    def __init__(self, **kwargs):
+        """
+        初始化CancelConfig实例，未指定的参数使用 DEFAULTS 中的默认值。
+        """
+        for name, default in self.DEFAULTS.items():
+            value = kwargs.get(name, default)
+            setattr(self, name, type(default)(value))
+        self.grace_period = max(0.0, self.grace_period)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        从配置字典创建实例，忽略未知的键。
+        """
+        return cls(**{name: value for name, value in (data or {}).items() if name in cls.DEFAULTS})
+
+    def to_dict(self):
+        """
+        转换为可写入 config.json 的字典。
+        """
+        return {name: getattr(self, name) for name in self.DEFAULTS}
 
 
 class UpgradeManager:
-    def __init__(self, ssh_manager):
+    REMOTE_DIR = '/tmp'  # 远程主机上存放升级文件和脚本的目录
+    UPLOAD_PROGRESS_START = 10  # 上传开始时的进度
+    UPLOAD_PROGRESS_END = 50  # 上传结束时的进度
+    PHASE_PROGRESS = {'chmod': 70, 'exec': 90}  # 远程各阶段结束时的进度
+    DELTA_MIN_SAVINGS = 0.1  # 差量上传至少节省的比例，未变化的块少于该比例时直接上传整个文件
+    PHASE_MARKER = '@@SSHTOOL'  # 远程阶段标记前缀，实际标记中还包含每次随机生成的令牌
+    OUTPUT_TAIL_LINES = 100  # 升级结束后作为结果消息保留的最后输出行数
+
+    def __init__(self, ssh_manager, progress_callback=None, transfer_config=None, artifact_store=None,
+                 output_callback=None, scan_config=None, reachability_cache=None, metrics=None, retry_config=None,
+                 cancel_config=None, stage_pools=None, on_transferred=None):
         self.ssh_manager = ssh_manager
+        self.progress_callback = progress_callback
+        self.output_callback = output_callback  # 远程脚本每输出一行调用 output_callback(stream, line)
+        self.transfer_config = transfer_config or TransferConfig()
+        self.artifact_store = artifact_store  # 批量升级中共享的 ArtifactStore，为空时本次升级单独打开文件
+        self.scan_config = scan_config or ScanConfig()
+        self.reachability_cache = reachability_cache  # 可达性预扫描结果，有效期内不再重复探测
+        # 各阶段耗时，与 ssh_manager 共用同一个 HostMetrics 时连接阶段的耗时也记录在其中
+        self.metrics = metrics if metrics is not None else HostMetrics(ssh_manager.host)
+        self.retry_config = retry_config or RetryConfig()
+        self.cancel_config = cancel_config or CancelConfig()
+        # 连接、上传和执行阶段的并发限制，由同一引擎中的所有主机共享；等待名额的时间不计入阶段耗时
+        self.stage_pools = stage_pools or StagePools()
+        # 上传结束并拿到 exec 阶段的名额后调用，用于让出批量调度的名额（见 concurrency.HostSlot）
+        self.on_transferred = on_transferred
+        self.completed = set()  # 本次升级中已完成的阶段，重试时从这里继续
+        self._last_progress = None
 
     async def execute_upgrade_async(self, file_path, script_path):
-        if not await self.ssh_manager.ping_host():
-            raise Exception(f'Host {self.ssh_manager.host} is not reachable.')
+        """
+        执行升级：检查可达性、连接、上传文件和脚本、执行脚本。
+
+        失败时按 retry_config 中该失败类型的重试次数和退避时间重试，并从最后完成的阶段继续：
+        已完成上传时只确认远程升级文件仍然存在并重新上传脚本，不再重新校验和传输升级文件。
+        本地升级文件或脚本缺失、不可读时直接失败，不重试。
 
-        remote_file_path = f'/tmp/{os.path.basename(file_path)}'
-        remote_script_path = f'/tmp/{os.path.basename(script_path)}'
+        返回:
+        - 升级脚本的输出。
+        """
+        self.completed = set()
+        attempts = collections.Counter()  # 失败类型 -> 已重试次数
+        while True:
+            try:
+                return await self._attempt_upgrade_async(file_path, script_path, bool(attempts))
+            except UpgradeError as e:
+                failure_class = e.failure_class
+                if attempts[failure_class] >= self.retry_config.retries(failure_class):
+                    raise
+                delay = self.retry_config.delay(failure_class, attempts[failure_class])
+                attempts[failure_class] += 1
+                self.metrics.retries += 1
+                if self.output_callback:
+                    self.output_callback('stderr', f'Retrying in {delay:.1f}s after {failure_class} failure '
+                                                   f'in {e.phase}: {e}')
+                await asyncio.sleep(delay)
+
+    async def _attempt_upgrade_async(self, file_path, script_path, retrying=False):
+        """
+        执行一次升级尝试，跳过 completed 中已完成的阶段。
 
+        异常:
+        - UpgradeError: 附带失败类型和失败阶段。
+        """
+        if 'ping' not in self.completed:
+            with self.metrics.phase('ping'):
+                # 重试时重新探测，不使用预扫描结果
+                reachable = await self.check_reachable(use_cache=not retrying)
+            if not reachable:
+                raise UpgradeError(f'Host {self.ssh_manager.host} is not reachable.', TIMEOUT, 'ping')
+            self.completed.add('ping')
+
+        remote_file_path = self.remote_path(file_path)
+        remote_script_path = self.remote_path(script_path)
+
+        remote_executed = False
+        cancelled = False
+        phase = 'tcp_connect'
         try:
-            await self.ssh_manager.connect_async()
-            await self.report_progress(10)
+            async with self.stage_pools.slot('connect'):
+                await self.ssh_manager.connect_async()
+            self.report_progress(10)
 
-            # 上传文件和脚本
-            await self.ssh_manager.upload_file_async(file_path, remote_file_path)
-            await self.report_progress(30)
-            await self.ssh_manager.upload_file_async(script_path, remote_script_path)
-            await self.report_progress(50)
+            # 通过同一个SFTP会话，从共享的内存映射上传文件和脚本，按实际传输字节报告进度
+            phase = 'upload'
+            async with self.stage_pools.slot('upload'):
+                with self.metrics.phase('upload'):
+                    if 'upload' in self.completed:
+                        await self._resume_upload(file_path, remote_file_path, script_path, remote_script_path)
+                    else:
+                        await self.upload_async([(file_path, remote_file_path), (script_path, remote_script_path)])
+            self.completed.add('upload')
+            self.report_progress(self.UPLOAD_PROGRESS_END)
+            phase = 'exec'
 
-            # 给脚本执行权限
-            await self.ssh_manager.execute_command_async(f'chmod +x {remote_script_path}')
-            await self.report_progress(70)
+            # 授权、执行脚本和清理合并为一次远程调用，各阶段结果通过标记行返回；
+            # 输出逐行转发给 output_callback，本地只保留最后 OUTPUT_TAIL_LINES 行
+            token = secrets.token_hex(8)
+            pattern = self.phase_marker_pattern(token)
+            phases = {}
+            stdout_tail = collections.deque(maxlen=self.OUTPUT_TAIL_LINES)
+            stderr_tail = collections.deque(maxlen=self.OUTPUT_TAIL_LINES)
 
-            # 执行升级脚本
-            stdout, stderr = await self.ssh_manager.execute_command_async(f'{remote_script_path} {remote_file_path}')
-            await self.report_progress(90)
+            def on_line(stream, line):
+                if stream == 'stdout':
+                    match = pattern.search(line)
+                    if match:
+                        phases[match.group(1)] = int(match.group(2))
+                        if match.group(1) in self.PHASE_PROGRESS:
+                            self.report_progress(self.PHASE_PROGRESS[match.group(1)])
+                        # 脚本最后一行没有换行符时，标记会接在该行末尾
+                        line = line[:match.start()]
+                        if not line:
+                            return
+                    stdout_tail.append(line)
+                else:
+                    stderr_tail.append(line)
+                if self.output_callback:
+                    self.output_callback(stream, line)
 
+            cache_dir = self.transfer_config.delta_cache_dir if self.transfer_config.delta else None
+            async with self.stage_pools.slot('exec'):
+                if self.on_transferred is not None:
+                    self.on_transferred()
+                remote_executed = True
+                try:
+                    with self.metrics.phase('exec'):
+                        await self.ssh_manager.stream_command_async(
+                            self.build_remote_command(remote_file_path, remote_script_path, token, cache_dir),
+                            on_line)
+                except Exception as e:
+                    # 脚本已经报告成功后的连接错误只影响清理，不改变升级结果
+                    if phases.get('exec') != 0:
+                        stderr_tail.append(str(e))
+            stdout = '\n'.join(stdout_tail)
+            stderr = '\n'.join(stderr_tail)
+
+            # 结果只取决于授权和升级脚本的阶段标记及其错误输出，清理命令的错误输出已在远程丢弃
+            if 'chmod' not in phases:
+                raise Exception(stderr or 'Remote command did not run.')
+            if phases['chmod'] != 0:
+                raise Exception(f'Failed to make upgrade script executable: {stderr}')
+            if phases.get('exec') != 0:
+                raise Exception(stderr or f'Upgrade script exited with status {phases.get("exec")}.')
             if stderr:
                 raise Exception(stderr)
 
-            await self.report_progress(100)
+            self.report_progress(100)
             return stdout or "Successfully upgraded."
 
+        except asyncio.CancelledError:
+            cancelled = True
+            if remote_executed or self.ssh_manager.client is not None:
+                await self._cleanup_cancelled(remote_file_path, remote_script_path)
+            raise
+
+        except UpgradeError:
+            raise
+
         except Exception as e:
-            raise Exception(str(e))
+            if phase == 'upload':
+                failure_class = UPLOAD
+            elif phase == 'exec':
+                failure_class = SCRIPT
+            else:
+                failure_class = classify_connect_error(self.ssh_manager.connect_error)
+            raise UpgradeError(str(e), failure_class, phase)
+
+        finally:
+            # 远程命令未执行时（例如上传失败）只删除脚本，保留升级文件供重试时跳过上传或断点续传
+            if not remote_executed and not cancelled and self.ssh_manager.client is not None:
+                await self.ssh_manager.execute_command_async(f'rm -f {shlex.quote(remote_script_path)}')
+            # 被取消时连接上可能还有未结束的会话，不放回连接池
+            await self.ssh_manager.close_async(reuse=not cancelled)
+
+    async def _cleanup_cancelled(self, remote_file_path, remote_script_path):
+        """
+        升级被取消时，在 grace_period 内删除本次上传的远程临时文件。
+
+        远程命令执行中被取消时，关闭会话后远程命令不一定还能运行到自己的清理步骤，因此同样删除这些文件
+        （已经打开的脚本和文件不受影响）；原连接无法执行命令时改用新建的连接。
+        """
+        paths = [remote_script_path]
+        if self.cancel_config.remove_partial_uploads:
+            paths.append(remote_file_path)
+            paths += [remote_file_path + suffix for suffix, _, _ in COMPRESSORS.values()]
+            paths.append(remote_file_path + '.part')
+        command = 'rm -f ' + ' '.join(shlex.quote(path) for path in paths)
+
+        async def cleanup():
+            _, stderr = await self.ssh_manager.execute_command_async(command)
+            if stderr:
+                # 原连接已断开或不可用，不放回连接池，重新连接后再删除
+                await self.ssh_manager.close_async(reuse=False)
+                await self.ssh_manager.connect_async()
+                await self.ssh_manager.execute_command_async(command)
+
+        try:
+            await asyncio.wait_for(cleanup(), self.cancel_config.grace_period)
+        except Exception:
+            # 超时或重新连接失败时放弃清理，不影响取消
+            pass
+
+    async def _resume_upload(self, file_path, remote_file_path, script_path, remote_script_path):
+        """
+        重试时使用：上一次尝试已经上传完成，远程升级文件大小不变时只重新上传脚本（执行后脚本会被删除），
+        否则回退为 upload_async 的校验和续传。
+        """
+        try:
+            size = os.path.getsize(file_path)
+        except OSError as e:
+            raise UpgradeError(f'Cannot read local file: {e}', None, 'upload')
+        stdout, _ = await self.ssh_manager.execute_command_async(
+            f'wc -c < {shlex.quote(remote_file_path)} 2>/dev/null')
+        if stdout.strip() == str(size):
+            await self.upload_async([(script_path, remote_script_path)])
+        else:
+            await self.upload_async([(file_path, remote_file_path), (script_path, remote_script_path)])
+
+    async def check_reachable(self, use_cache=True):
+        """
+        检查主机是否可达：优先使用有效期内的预扫描结果，否则按 scan_config 的端口和超时探测一次。
+
+        参数:
+        - use_cache: 为假时忽略预扫描结果，直接探测。
+        """
+        if use_cache and self.reachability_cache is not None:
+            result = self.reachability_cache.get(self.ssh_manager.host)
+            if result is not None:
+                return result.reachable
+        return await self.ssh_manager.ping_host(self.scan_config.port, self.scan_config.timeout)
+
+    @classmethod
+    def build_remote_command(cls, remote_file_path, remote_script_path, token, cache_dir=None):
+        """
+        生成授权、执行升级脚本和清理的组合远程命令。
+
+        每个阶段结束后在标准输出中打印 "标记:令牌:阶段:退出码"；脚本成功时删除升级文件和脚本，
+        失败时只删除脚本，保留升级文件供重试时复用。指定 cache_dir 时，成功后升级文件替换该目录中的
+        上一版本，供下次差量上传使用。清理命令的错误输出被丢弃（例如 cache_dir 不可写时只是不保留该文件），
+        标准错误中只有授权和升级脚本本身的输出。
+        """
+        marker = f'{cls.PHASE_MARKER}:{token}'
+        script, upgrade_file = shlex.quote(remote_script_path), shlex.quote(remote_file_path)
+        if cache_dir:
+            cache_dir = shlex.quote(cache_dir)
+            keep = (f'mkdir -p {cache_dir} && rm -f {cache_dir}/* && mv -f {upgrade_file} {cache_dir}/ '
+                    f'|| rm -f {upgrade_file}; rm -f {script}')
+        else:
+            keep = f'rm -f {upgrade_file} {script}'
+        return (f'chmod +x {script}; rc=$?; echo "{marker}:chmod:$rc"; '
+                f'if [ $rc -eq 0 ]; then {script} {upgrade_file}; rc=$?; echo "{marker}:exec:$rc"; fi; '
+                f'{{ if [ $rc -eq 0 ]; then {keep}; else rm -f {script}; fi; }} 2>/dev/null')
+
+    @classmethod
+    def phase_marker_pattern(cls, token):
+        """
+        返回匹配本次远程调用阶段标记的正则表达式，分组为 (阶段, 退出码)。
+        """
+        return re.compile(rf'{re.escape(cls.PHASE_MARKER)}:{re.escape(token)}:(\w+):(\d+)$')
+
+    @classmethod
+    def remote_path(cls, local_path):
+        """
+        本地文件上传到远程主机后的路径。
+        """
+        return f'{cls.REMOTE_DIR}/{os.path.basename(local_path)}'
+
+    async def upload_async(self, files):
+        """
+        上传 (本地路径, 远程路径) 列表中的文件。
 
+        上传前在一次远程调用中比较所有文件的 SHA-256：远程文件完整且一致时跳过，
+        远程存在部分文件时从最后一个校验通过的分块处续传。
+
+        启用差量上传且远程没有可复用的文件时，先尝试基于远程缓存的上一版本只上传变化的块（见 _delta_upload）。
+        启用压缩时，较大的文件改为上传压缩副本（本地每个文件只压缩一次）并在远程解压；
+        远程主机缺少对应的解压命令时回退为直接上传原文件。
+        """
+        store = self.artifact_store or ArtifactStore()
+        try:
+            try:
+                artifacts = [(store.get(local_path), remote_path) for local_path, remote_path in files]
+                compressed = await self._compressed_artifacts(store, artifacts)
+            except OSError as e:
+                # 本地文件缺失或不可读，重试也不会成功
+                raise UpgradeError(f'Cannot read local file: {e}', None, 'upload')
+            probed = artifacts + [item for item in compressed if item is not None]
+            for artifact, _ in probed:
+                await artifact.ensure_digests_async(self.transfer_config.chunk_size)
+
+            algorithm = self.transfer_config.compression
+            extra_commands = []
+            if any(compressed):
+                tool = COMPRESSORS[algorithm][1]
+                extra_commands.append(f'command -v {tool} >/dev/null 2>&1 && echo yes || echo no')
+            offsets, extra_output = await self._probe(probed, extra_commands)
+            can_decompress = bool(extra_output) and extra_output[0].strip() == 'yes'
+            compressed_offsets = iter(offsets[len(artifacts):])
+
+            pending = []
+            decompress = []
+            for (artifact, remote_path), offset, packed in zip(artifacts, offsets, compressed):
+                packed_offset = next(compressed_offsets) if packed is not None else None
+                if offset is None:
+                    continue
+                if offset == 0 and not packed_offset and await self._delta_upload(artifact, remote_path):
+                    continue
+                if packed is not None and can_decompress:
+                    if packed_offset is not None:
+                        pending.append((packed[0], packed[1], packed_offset))
+                    decompress.append((packed[1], remote_path))
+                else:
+                    pending.append((artifact, remote_path, offset))
+
+            if pending:
+                await self.ssh_manager.upload_artifacts_async(
+                    pending,
+                    block_size=self.transfer_config.block_size,
+                    max_requests=self.transfer_config.max_requests,
+                    progress_handler=self.report_upload_progress)
+            if decompress:
+                await self._decompress_remote(decompress)
         finally:
-            await self.ssh_manager.execute_command_async(f'rm -f {remote_file_path} {remote_script_path}')
-            await self.ssh_manager.close_async()
+            if store is not self.artifact_store:
+                store.close()
+
+    def delta_block_size(self):
+        """
+        差量上传实际使用的块大小：delta_block_size 向下取整为 SFTP 块大小的整数倍。
+        """
+        block_size = self.transfer_config.block_size
+        return max(block_size, self.transfer_config.delta_block_size // block_size * block_size)
+
+    async def _delta_upload(self, artifact, remote_path):
+        """
+        基于远程 delta_cache_dir 中的上一版本差量上传 artifact，成功时返回 True。
+
+        在远程计算上一版本每个对齐块的 SHA-256，与本地的分块摘要逐块比较；在远程复制上一版本并调整为新文件的
+        大小，通过SFTP只写入发生变化的块，校验整个文件的 SHA-256 一致后再替换 remote_path。
+        没有上一版本、可节省的数据太少或校验失败时返回 False，由调用方上传整个文件。
+
+        只比较相同位置的块（不使用 rsync 的滚动校验和）：升级镜像的变化通常是原位修改，
+        而在 Python 中逐字节计算滚动校验和对 GB 级文件太慢。
+        """
+        delta_block_size = self.delta_block_size()
+        if not self.transfer_config.delta or artifact.size < 2 * delta_block_size:
+            return False
+        await artifact.ensure_digests_async(self.transfer_config.chunk_size)
+        local_digests = await artifact.block_digests_async(delta_block_size)
+
+        cache_dir = shlex.quote(self.transfer_config.delta_cache_dir)
+        stdout, _ = await self.ssh_manager.execute_command_async(
+            f'b=$(ls -t {cache_dir} 2>/dev/null | head -n 1); [ -n "$b" ] || exit 0; f={cache_dir}/"$b"; '
+            f'[ -f "$f" ] || exit 0; s=$(($(wc -c < "$f"))); echo "$s $b"; i=0; '
+            f'while [ $((i * {delta_block_size})) -lt "$s" ]; do '
+            f'dd if="$f" bs={delta_block_size} skip=$i count=1 2>/dev/null | sha256sum | cut -d " " -f 1; '
+            f'i=$((i + 1)); done')
+        lines = stdout.splitlines()
+        if not lines:
+            return False
+        _, _, basis_name = lines[0].partition(' ')
+        basis_path = posixpath.join(self.transfer_config.delta_cache_dir, basis_name)
+        remote_digests = lines[1:]
+        changed = [index * delta_block_size for index, digest in enumerate(local_digests)
+                   if index >= len(remote_digests) or remote_digests[index] != digest]
+        if len(changed) > len(local_digests) * (1 - self.DELTA_MIN_SAVINGS):
+            return False
+
+        part_path = shlex.quote(remote_path + '.part')
+        _, stderr = await self.ssh_manager.execute_command_async(
+            f'cp -f {shlex.quote(basis_path)} {part_path} && '
+            f'dd if=/dev/null of={part_path} bs=1 seek={artifact.size} 2>/dev/null')
+        if stderr:
+            return False
+        # 每个变化的块按 SFTP 块大小拆分为多个写请求
+        block_size = self.transfer_config.block_size
+        offsets = [offset for start in changed
+                   for offset in range(start, min(start + delta_block_size, artifact.size), block_size)]
+        if offsets:
+            await self.ssh_manager.write_blocks_async(
+                artifact, remote_path + '.part', offsets,
+                block_size=block_size,
+                max_requests=self.transfer_config.max_requests,
+                progress_handler=self.report_upload_progress)
+        stdout, _ = await self.ssh_manager.execute_command_async(
+            f'if [ "$(sha256sum < {part_path} | cut -d " " -f 1)" = {artifact.sha256} ]; '
+            f'then mv -f {part_path} {shlex.quote(remote_path)} && echo ok; else rm -f {part_path}; fi')
+        return stdout.strip() == 'ok'
+
+    async def _compressed_artifacts(self, store, artifacts):
+        """
+        返回与 artifacts 对应的列表，元素为 (压缩副本 Artifact, 远程压缩文件路径)，不压缩的文件为 None。
+        """
+        algorithm = self.transfer_config.compression
+        if algorithm not in COMPRESSORS:
+            return [None] * len(artifacts)
+        suffix = COMPRESSORS[algorithm][0]
+        result = []
+        for artifact, remote_path in artifacts:
+            if artifact.size < MIN_COMPRESS_SIZE:
+                result.append(None)
+                continue
+            path = await compressed_copy(artifact.path, algorithm, self.transfer_config.compression_level)
+            result.append((store.get(path), remote_path + suffix))
+        return result
+
+    async def _decompress_remote(self, files):
+        """
+        在一次远程调用中解压 (远程压缩文件路径, 远程目标路径) 列表中的文件，成功后删除压缩文件。
+        """
+        tool = COMPRESSORS[self.transfer_config.compression][1]
+        commands = []
+        for packed_path, remote_path in files:
+            packed_path, remote_path = shlex.quote(packed_path), shlex.quote(remote_path)
+            commands.append(f'{tool} -dc {packed_path} > {remote_path}.part && '
+                            f'mv -f {remote_path}.part {remote_path} && rm -f {packed_path}')
+        _, stderr = await self.ssh_manager.execute_command_async(' && '.join(commands))
+        if stderr:
+            raise Exception(f'Failed to decompress upgrade file: {stderr}')
+
+    async def probe_remote_files(self, artifacts):
+        """
+        在一次远程调用中获取每个远程文件可复用的前缀长度及其 SHA-256，并与本地摘要比较。
+
+        远程文件大小与本地相同时比较整个文件；否则比较去掉末尾可能未写完的流水线窗口后、
+        按 chunk_size 对齐的前缀。
+
+        返回:
+        - 与 artifacts 对应的列表，元素为 None（无需上传）或开始上传的偏移量。
+        """
+        offsets, _ = await self._probe(artifacts)
+        return offsets
+
+    async def _probe(self, artifacts, extra_commands=()):
+        """
+        执行 probe_remote_files 的远程探测，并在同一次调用中附带执行 extra_commands。
+
+        返回:
+        - (偏移量列表, extra_commands 输出的行列表)
+        """
+        chunk_size = self.transfer_config.chunk_size
+        # 并行写入时，文件末尾最多一个流水线窗口的数据可能存在空洞，续传时不信任这部分
+        margin = self.transfer_config.block_size * self.transfer_config.max_requests
+        lines = []
+        for artifact, remote_path in artifacts:
+            lines.append(
+                f'f={shlex.quote(remote_path)}; '
+                f'if [ -f "$f" ]; then s=$(wc -c < "$f"); '
+                f'if [ "$s" -eq {artifact.size} ]; then n=$s; '
+                f'else n=$(( (s - {margin}) / {chunk_size} * {chunk_size} )); '
+                f'[ "$n" -gt {artifact.size} ] && n={artifact.size // chunk_size * chunk_size}; '
+                f'[ "$n" -lt 0 ] && n=0; fi; '
+                f'echo "$n $(head -c "$n" "$f" | sha256sum 2>/dev/null)"; '
+                f'else echo "0 -"; fi')
+        stdout, _ = await self.ssh_manager.execute_command_async('\n'.join(lines + list(extra_commands)))
+
+        results = stdout.splitlines()
+        offsets = []
+        for index, (artifact, _) in enumerate(artifacts):
+            fields = results[index].split() if index < len(results) else []
+            length = int(fields[0]) if fields and fields[0].isdigit() else 0
+            remote_digest = fields[1] if len(fields) > 1 else None
+            if length == artifact.size and remote_digest == artifact.sha256:
+                offsets.append(None)
+            elif 0 < length < artifact.size and remote_digest == artifact.prefix_digests.get(length):
+                offsets.append(length)
+            else:
+                offsets.append(0)
+        return offsets, results[len(artifacts):]
+
+    def report_upload_progress(self, transferred_bytes, total_bytes):
+        """
+        将已上传字节数换算为 UPLOAD_PROGRESS_START ~ UPLOAD_PROGRESS_END 之间的进度并报告
+        """
+        span = self.UPLOAD_PROGRESS_END - self.UPLOAD_PROGRESS_START
+        ratio = transferred_bytes / total_bytes if total_bytes else 1
+        self.report_progress(self.UPLOAD_PROGRESS_START + int(span * ratio))
 
-    @staticmethod
-    async def report_progress(progress):
+    def report_progress(self, progress):
         """
-        向主线程报告升级进度
+        通过 progress_callback 报告升级进度，进度值未变化时不重复报告
         """
-        loop = asyncio.get_event_loop()
-        if hasattr(loop, 'report_progress'):
-            loop.report_progress(progress)
-        await asyncio.sleep(0.1)
+        if progress != self._last_progress:
+            self._last_progress = progress
+            if self.progress_callback:
+                self.progress_callback(progress)